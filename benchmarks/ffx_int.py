@@ -0,0 +1,57 @@
+# Compares the batched integer FFX engine with calling encrypt for every value
+# Run with: python -m benchmarks.ffx_int --rows 100000
+import argparse, logging, sys, time, os
+
+import numpy as np
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, this_dir + "/..")
+
+from ffx_helper import FFXEncrypt
+
+
+def run(rows: int, digits: int, distinct: int, scalar_rows: int, seed: int = 0) -> dict:
+    """Time both paths on the same ID column
+
+    :param rows: Number of values in the column
+    :param digits: Number of digits of the IDs
+    :param distinct: Number of distinct IDs in the column
+    :param scalar_rows: Number of values timed on the scalar path, the rate is extrapolated to rows
+    """
+    rng = np.random.RandomState(seed)
+    ids = rng.randint(10 ** (digits - 1), 10 ** digits, size=distinct, dtype=np.int64)
+    column = ids[rng.randint(0, distinct, size=rows)]
+
+    # No memo, the scalar path has to encrypt every value
+    ffx = FFXEncrypt("benchmarksecretkey", cache_size=0)
+    sample = column[:scalar_rows]
+    start = time.perf_counter()
+    expected = [ffx.encrypt(val) for val in sample]
+    scalar_time = (time.perf_counter() - start) * rows / len(sample)
+
+    start = time.perf_counter()
+    result = ffx.encrypt_int_array(column)
+    batch_time = time.perf_counter() - start
+    if list(result[:scalar_rows]) != expected:
+        raise AssertionError("Batched results differ from the scalar path")
+    return {"rows": rows, "digits": digits, "distinct": distinct,
+            "scalar_seconds": scalar_time, "batch_seconds": batch_time,
+            "scalar_rows_per_sec": rows / scalar_time, "batch_rows_per_sec": rows / batch_time,
+            "speedup": scalar_time / batch_time}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare batched and scalar integer FFX encryption")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--digits", type=int, default=9)
+    parser.add_argument("--distinct", type=int, default=None, help="Distinct IDs, defaults to rows")
+    parser.add_argument("--scalar-rows", type=int, default=10000)
+    args = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    result = run(args.rows, args.digits, args.distinct or args.rows, min(args.scalar_rows, args.rows))
+    for key, val in result.items():
+        print(f"{key}: {val:.2f}" if isinstance(val, float) else f"{key}: {val}")
+
+
+if __name__ == "__main__":
+    main()
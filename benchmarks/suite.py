@@ -0,0 +1,240 @@
+# Benchmarks each transform, each table and the whole run on a synthetic MyLA database, saving the results as JSON
+# Run with: python -m benchmarks.suite --rows 100000 --output results.json --compare last_results.json
+import argparse, datetime, json, logging, os, platform, subprocess, sys, tempfile, time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, this_dir + "/..")
+
+from faker import Faker
+from custom_provider import CustomProvider
+from ffx_helper import FFXEncrypt
+from id_mapping import IdMappingStore
+from metrics import RunMetrics
+import plan
+from transform_engine import TableTransformer
+import util_methods
+
+from benchmarks import synthetic
+
+SECRET = "benchmarksecretkey"
+# A change is reported as a regression when it is this much slower
+REGRESSION = 0.1
+
+
+def _timed(func, rows: int, repeat: int = 1) -> dict:
+    """Best time of calling func repeat times"""
+    seconds = min(_seconds(func) for _ in range(repeat))
+    return {"rows": rows, "seconds": seconds, "rows_per_sec": rows / seconds if seconds else 0.0}
+
+
+def _seconds(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _faker():
+    faker = Faker()
+    faker.add_provider(CustomProvider)
+    faker.seed_instance(util_methods.hash_string_to_int(SECRET, 16))
+    return faker
+
+
+def _transform(df: pd.DataFrame, col: dict, modules: dict, **kwargs):
+    """Run a single column from config.json over a copy of df"""
+    TableTransformer([col], modules, **kwargs).apply(df.copy())
+
+
+def transform_benchmarks(rows: int, faker_rows: int, seed: int = 0, repeat: int = 3) -> dict:
+    """Time every kind of transform on MyLA like columns
+
+    :param rows: Rows of the columns for ffx and the util_methods
+    :param faker_rows: Rows of the columns for faker, which is much slower
+    """
+    rng = np.random.RandomState(seed)
+    courses = synthetic.CANVAS_PREFIX + rng.randint(1, max(2, rows // 1000), size=rows)
+    df = pd.DataFrame({
+        "user_id": synthetic.CANVAS_PREFIX + rng.randint(1, max(2, rows // 10), size=rows),
+        "course_id": courses,
+        "assignment_id": courses * 10 + rng.randint(0, 20, size=rows),
+        "sis_name": synthetic._words(rng, rows, ["jsmith", "aturner", "kpatel", "mgarcia", "lchen"]),
+        "score": np.round(rng.uniform(0, 10, size=rows), 1),
+        "grade": np.round(np.clip(rng.normal(85, 10, size=rows), 0, 100), 2),
+        "access_time": synthetic._dates(rng, rows),
+    })
+    faker_df = df.head(faker_rows)
+
+    # A new FFXEncrypt for every run, so the memo doesn't carry over between repeats
+    def ffx():
+        return {"ffx": FFXEncrypt(SECRET)}
+
+    def faker():
+        return {"faker": _faker()}
+
+    methods = {"util_methods": util_methods}
+    results = {
+        "ffx_int": _timed(lambda: _transform(df, {"name": "user_id", "module": "ffx", "method": "encrypt"}, ffx()),
+                          rows, repeat),
+        "ffx_string": _timed(lambda: _transform(df, {"name": "sis_name", "module": "ffx", "method": "encrypt"}, ffx()),
+                             rows, repeat),
+        "redist": _timed(lambda: _transform(df, {"name": "grade", "module": "util_methods", "method": "redist",
+                                                 "index": "course_id"}, methods), rows, repeat),
+        "mean": _timed(lambda: _transform(df, {"name": "grade", "module": "util_methods", "method": "mean",
+                                               "source": "score", "index": "assignment_id"}, methods), rows, repeat),
+        "shuffle": _timed(lambda: _transform(df, {"name": "access_time", "module": "util_methods", "method": "shuffle",
+                                                  "index": "user_id"}, methods), rows, repeat),
+    }
+    for method in ("course", "assignment", "name", "user_name", "file_name", "date_time_on_date"):
+        col = {"name": "access_time" if method == "date_time_on_date" else "sis_name", "module": "faker",
+               "method": method}
+        results[f"faker_{method}"] = _timed(lambda: _transform(faker_df, col, faker()), len(faker_df), repeat)
+        if method in TableTransformer.FAKER_BATCH_METHODS:
+            # The batch versions are fast enough for all of the rows
+            results[f"faker_{method}_batch"] = _timed(lambda: _transform(df, col, faker(), faker_batch=True,
+                                                                         faker_seed=1), rows, repeat)
+    return results
+
+
+def table_benchmarks(url: str, chunk_size: int = 0) -> dict:
+    """Anonymize every table of config.json in the database and write it back, like a full run
+
+    :param url: SQLAlchemy url of a database made by benchmarks.synthetic, it is overwritten
+    :param chunk_size: CHUNK_SIZE to run with
+    :return: Dictionary of the metrics report of each table and the whole run
+    """
+    import mylasqlanon
+    engine = sqlalchemy.create_engine(url)
+    faker = _faker()
+    ffx = FFXEncrypt(SECRET)
+    modules = {"ffx": ffx, "faker": faker, "util_methods": util_methods}
+    id_store = IdMappingStore(SECRET, mylasqlanon.ID_ADDITION)
+    # tracemalloc would slow the transforms down several times, so the rates wouldn't be the loader's
+    metrics = RunMetrics(track_memory=False)
+    for table_plan in plan.compile_config(mylasqlanon.load_config()).values():
+        mylasqlanon.process_table(table_plan, engine, modules, chunk_size=chunk_size, update_database=True,
+                                  id_store=id_store, metrics=metrics)
+    metrics.close()
+    report = metrics.report()
+    return {"tables": report["tables"],
+            "end_to_end": {"rows": report["rows"], "seconds": report["seconds"],
+                           "rows_per_sec": report["rows"] / report["seconds"] if report["seconds"] else 0.0,
+                           "peak_memory_mb": report["peak_memory_mb"], "ffx_cache": ffx.cache_info()}}
+
+
+def _transform_seconds(df: pd.DataFrame, t_config: list, modules: dict) -> float:
+    """Time the ffx and util_methods transforms of a table over a copy of df, faker doesn't depend on the dtypes"""
+    t_config = [col for col in t_config if col.get("module") != "faker"]
+    df = df.copy()
+    np.random.seed(0)
+    return _seconds(lambda: TableTransformer(t_config, modules).apply(df))
+
+
+def dtype_benchmarks(url: str) -> dict:
+    """Memory of every table of config.json as it is read and with compact dtypes, and the time to transform both
+
+    :param url: SQLAlchemy url of a database made by benchmarks.synthetic
+    :return: Dictionary of the sizes in MB and transform seconds of each table
+    """
+    import mylasqlanon
+    engine = sqlalchemy.create_engine(url)
+    results = {}
+    for table, table_plan in plan.compile_config(mylasqlanon.load_config()).items():
+        sql, t_config = table_plan.sql, table_plan.t_config()
+        df = pd.read_sql(sql, engine)
+        compact = util_methods.compact_frame(df.copy(), util_methods.column_types(engine, table, t_config))
+        modules = {"ffx": FFXEncrypt(SECRET), "util_methods": util_methods}
+        raw_seconds = _transform_seconds(df, t_config, modules)
+        modules["ffx"] = FFXEncrypt(SECRET)
+        results[table] = {"rows": len(df),
+                          "raw_mb": df.memory_usage(deep=True).sum() / 2 ** 20,
+                          "compact_mb": compact.memory_usage(deep=True).sum() / 2 ** 20,
+                          "raw_transform_seconds": raw_seconds,
+                          "compact_transform_seconds": _transform_seconds(compact, t_config, modules),
+                          "dtypes": {col: str(dtype) for col, dtype in compact.dtypes.items()
+                                     if dtype != df.dtypes[col]}}
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=this_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rates(results: dict) -> dict:
+    """Flatten the rows/sec of every benchmark in a results file, keyed like transforms/ffx_int"""
+    flat = {f"transforms/{name}": values["rows_per_sec"] for name, values in results.get("transforms", {}).items()}
+    flat.update({f"tables/{name}": values["rows_per_sec"] for name, values in results.get("tables", {}).items()})
+    if "end_to_end" in results:
+        flat["end_to_end"] = results["end_to_end"]["rows_per_sec"]
+    return flat
+
+
+def compare(old: dict, new: dict) -> list:
+    """Print the change in rows/sec of every benchmark in both results
+
+    :return: Names of the benchmarks that got slower by more than REGRESSION
+    """
+    old_rates, new_rates = rates(old), rates(new)
+    regressions = []
+    print(f"Compared with {old.get('meta', {}).get('commit')}")
+    for name in sorted(set(old_rates) & set(new_rates)):
+        before, after = old_rates[name], new_rates[name]
+        change = (after - before) / before if before else 0.0
+        slower = change < -REGRESSION
+        if slower:
+            regressions.append(name)
+        print(f"{name:45} {before:14.0f} {after:14.0f} rows/sec {change:+8.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the transforms and tables on synthetic MyLA data")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows of the synthetic database and transform columns")
+    parser.add_argument("--faker-rows", type=int, default=5000, help="Rows for the faker transforms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Transform benchmarks report the best of this many runs")
+    parser.add_argument("--chunk-size", type=int, default=0, help="CHUNK_SIZE for the table benchmarks")
+    parser.add_argument("--db", default=None,
+                        help="SQLite file or SQLAlchemy url to generate into, defaults to a temporary file")
+    parser.add_argument("--skip-tables", action="store_true", help="Only run the transform benchmarks")
+    parser.add_argument("--output", default=None, help="File to save the results in as JSON")
+    parser.add_argument("--compare", default=None, help="Results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)
+
+    results = {"meta": {"commit": _commit(), "created": datetime.datetime.now().isoformat(),
+                        "python": platform.python_version(), "platform": platform.platform(),
+                        "rows": args.rows, "faker_rows": args.faker_rows, "seed": args.seed,
+                        "chunk_size": args.chunk_size}}
+    results["transforms"] = transform_benchmarks(args.rows, min(args.faker_rows, args.rows), args.seed, args.repeat)
+    if not args.skip_tables:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = args.db or os.path.join(tmp, "myla.db")
+            url = db if "://" in db else f"sqlite:///{db}"
+            results["meta"]["generated_rows"] = synthetic.build(args.rows, url, args.seed)
+            # Before the tables are anonymized in place
+            results["dtypes"] = dtype_benchmarks(url)
+            results.update(table_benchmarks(url, args.chunk_size))
+
+    for name, rate in rates(results).items():
+        print(f"{name:45} {rate:14.0f} rows/sec")
+    for table, sizes in results.get("dtypes", {}).items():
+        print(f"dtypes/{table:38} {sizes['raw_mb']:10.2f} MB -> {sizes['compact_mb']:8.2f} MB compact")
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=4, default=str)
+    if args.compare:
+        with open(args.compare) as json_data:
+            if compare(json.load(json_data), results):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
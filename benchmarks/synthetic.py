@@ -0,0 +1,193 @@
+# Seeded generator of MyLA shaped data for the tables in config.json, loaded into SQLite (or any SQLAlchemy url)
+# Run with: python -m benchmarks.synthetic --rows 100000 --db /tmp/myla.db
+import argparse, datetime, json, logging, sys, os
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, this_dir + "/..")
+
+logger = logging.getLogger()
+
+# Canvas ids are all offset by a large prefix, like ID_ADDITION
+CANVAS_PREFIX = 17700000000000000
+# Share of the rows that goes to each table, the rest of the tables are sized off these
+TABLE_SHARE = {"resource_access": 0.6, "submission": 0.3, "user": 0.04, "resource": 0.03, "assignment": 0.02}
+# Rows written at a time, so large datasets don't have to fit in memory
+WRITE_CHUNK = 500000
+FIRST_DAY = np.datetime64("2018-09-01")
+TERM_DAYS = 120
+
+
+def table_sizes(rows: int) -> dict:
+    """Number of rows of each table for a dataset of roughly rows rows"""
+    sizes = {table: max(10, int(rows * share)) for table, share in TABLE_SHARE.items()}
+    courses = max(3, sizes["assignment"] // 20)
+    sizes.update({"academic_terms": 4, "course": courses, "assignment_groups": courses * 5,
+                  "assignment_weight_consideration": courses, "course_view_option": courses,
+                  "user_default_selection": max(10, sizes["user"] // 10)})
+    return sizes
+
+
+def config_tables(db_config: dict) -> dict:
+    """Database tables and their columns from config.json, with the joined entries split up"""
+    tables = {}
+    for table, t_config in db_config.items():
+        if "|" in table:
+            for join_table in t_config.get("tables"):
+                tables[join_table.get("name")] = [col.get("name") for col in join_table.get("cols")]
+        else:
+            tables[table] = [col.get("name") for col in t_config]
+    return tables
+
+
+def _ids(rng: np.random.RandomState, n: int) -> np.ndarray:
+    """Increasing ids with gaps between them, like auto increment ids with deleted rows"""
+    return CANVAS_PREFIX + np.cumsum(rng.randint(1, 20, size=n))
+
+
+def _dates(rng: np.random.RandomState, n: int) -> np.ndarray:
+    days = rng.randint(0, TERM_DAYS * 4, size=n)
+    offsets = rng.randint(0, 86400, size=n)
+    return FIRST_DAY + days.astype("timedelta64[D]") + offsets.astype("timedelta64[s]")
+
+
+def _words(rng: np.random.RandomState, n: int, words: list, numbered: bool = True) -> np.ndarray:
+    names = np.array(words, dtype=object)[rng.randint(0, len(words), size=n)]
+    if numbered:
+        names = names + " " + rng.randint(1, 1000, size=n).astype(str).astype(object)
+    return names
+
+
+class SyntheticMyLA():
+    """Builds the tables with ids that line up between them (a submission's assignment_id is an assignment)
+
+    The same seed and rows always give the same data.
+    """
+
+    def __init__(self, rows: int, seed: int = 0):
+        """
+        :param rows: Rough total number of rows across all of the tables
+        :param seed: Seed of the random generator
+        """
+        self.rows = rows
+        self.seed = seed
+        self.sizes = table_sizes(rows)
+        rng = np.random.RandomState(seed)
+        # Ids of the entities other tables point to
+        self.ids = {table: _ids(rng, size) for table, size in self.sizes.items()}
+        # Every user is enrolled in a few courses
+        self.users = _ids(rng, max(10, self.sizes["user"] // 3))
+
+    def columns(self, table: str, rng: np.random.RandomState, start: int, n: int) -> dict:
+        """Generators for the columns of a table by column name, each called only if the table has the column"""
+        ids = self.ids[table][start:start + n]
+
+        def pick(source):
+            return source[rng.randint(0, len(source), size=n)]
+
+        def flag():
+            return rng.randint(0, 2, size=n)
+
+        logins = ["jsmith", "aturner", "kpatel", "mgarcia", "lchen"]
+        return {
+            "id": lambda: ids,
+            "canvas_id": lambda: ids,
+            "term_id": lambda: pick(self.ids["academic_terms"]),
+            "course_id": lambda: pick(self.ids["course"]),
+            "user_id": lambda: pick(self.users),
+            "resource_id": lambda: ids if table == "resource" else pick(self.ids["resource"]),
+            "assignment_id": lambda: pick(self.ids["assignment"]),
+            "assignment_group_id": lambda: pick(self.ids["assignment_groups"]),
+            "sis_id": lambda: rng.randint(10 ** 7, 10 ** 8, size=n),
+            "sis_name": lambda: _words(rng, n, logins),
+            "user_sis_name": lambda: _words(rng, n, logins),
+            "name": lambda: _words(rng, n, ["Reading", "Lecture", "Quiz", "Lab", "Essay", "Homework"]),
+            "resource_type": lambda: _words(rng, n, ["canvas", "leccap", "mivideo"], numbered=False),
+            "access_time": lambda: _dates(rng, n),
+            "due_date": lambda: _dates(rng, n),
+            "local_date": lambda: _dates(rng, n),
+            "graded_date": lambda: _dates(rng, n),
+            "date_start": lambda: FIRST_DAY + (np.arange(start, start + n) * TERM_DAYS).astype("timedelta64[D]"),
+            "date_end": lambda: FIRST_DAY + (np.arange(start + 1, start + n + 1) * TERM_DAYS).astype("timedelta64[D]"),
+            "current_grade": lambda: np.round(np.clip(rng.normal(85, 10, size=n), 0, 100), 2),
+            "final_grade": lambda: np.round(np.clip(rng.normal(83, 10, size=n), 0, 100), 2),
+            "score": lambda: np.round(rng.uniform(0, 10, size=n), 1),
+            "avg_score": lambda: np.full(n, np.nan),
+            "points_possible": lambda: rng.choice([5.0, 10.0, 20.0, 50.0, 100.0], size=n),
+            "weight": lambda: np.round(rng.uniform(0, 40, size=n), 1),
+            "group_points": lambda: rng.choice([50.0, 100.0, 200.0], size=n),
+            "drop_lowest": flag,
+            "drop_highest": flag,
+            "consider_weight": flag,
+            "show_files_accessed": flag,
+            "show_assignment_planning": flag,
+            "show_grade_distribution": flag,
+            "default_view_type": lambda: _words(rng, n, ["assignment", "grade", "resources"], numbered=False),
+            "default_view_value": lambda: _words(rng, n, ["week", "all", "graded"], numbered=False),
+        }
+
+    def frames(self, table: str, columns: list):
+        """Generate a table as dataframes of at most WRITE_CHUNK rows"""
+        size = self.sizes[table]
+        for start in range(0, size, WRITE_CHUNK):
+            # Each chunk has its own stream so it doesn't depend on the chunk size of earlier tables
+            rng = np.random.RandomState([self.seed, len(table), sum(map(ord, table)), start])
+            n = min(WRITE_CHUNK, size - start)
+            generators = self.columns(table, rng, start, n)
+            missing = [col for col in columns if col not in generators]
+            if missing:
+                raise ValueError(f"No generator for {table} columns {missing}")
+            yield pd.DataFrame({col: generators[col]() for col in columns})
+
+    def load(self, engine, tables: dict):
+        """Create the tables and fill them
+
+        :param engine: SQLAlchemy engine of the stand in database
+        :param tables: Dictionary of each table to its columns, from config_tables
+        :return: Dictionary of the number of rows written to each table
+        """
+        written = {}
+        for table, columns in tables.items():
+            with engine.begin() as conn:
+                conn.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {engine.dialect.identifier_preparer.quote(table)}"))
+            written[table] = 0
+            for df in self.frames(table, columns):
+                df.to_sql(table, engine, if_exists="append", index=False, chunksize=50000)
+                written[table] += len(df)
+            logger.info(f"Generated {written[table]} rows for {table}")
+        return written
+
+
+def build(rows: int, url: str, seed: int = 0, config_file: str = None) -> dict:
+    """Generate the dataset for config.json into a database
+
+    :param rows: Rough total number of rows
+    :param url: SQLAlchemy url of the stand in database, like sqlite:////tmp/myla.db
+    :param seed: Seed of the random generator
+    :param config_file: config.json to match, defaults to the one in the repository
+    :return: Dictionary of the number of rows written to each table
+    """
+    with open(config_file or os.path.join(this_dir, "..", "config.json")) as json_data:
+        db_config = json.load(json_data)
+    engine = sqlalchemy.create_engine(url)
+    return SyntheticMyLA(rows, seed).load(engine, config_tables(db_config))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a MyLA shaped database for the tables in config.json")
+    parser.add_argument("--rows", type=int, default=100000, help="Rough total number of rows")
+    parser.add_argument("--db", default="/tmp/myla_synthetic.db", help="SQLite file, or a SQLAlchemy url")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    url = args.db if "://" in args.db else f"sqlite:///{args.db}"
+    start = datetime.datetime.now()
+    written = build(args.rows, url, args.seed)
+    print(f"Wrote {sum(written.values())} rows to {url} in {datetime.datetime.now() - start}")
+
+
+if __name__ == "__main__":
+    main()
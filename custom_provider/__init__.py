@@ -6,26 +6,63 @@ from faker.providers import date_time
 from datetime import datetime
 from dateutil.parser import parse as date_parse
 
+import numpy as np
+import pandas as pd
+
 logger = logging.getLogger()
 
+CLASSES = ['Reading', 'Video', 'Practice', 'Random', 'English', 'Architecture', 'Information']
+CLASS_LIST = ['GEOG', 'DENT', 'LATIN', 'SI', 'PHYSICS', 'AUTO', 'EECS']
+SEMESTERS = ['SP', 'SU', 'WN', 'FA']
+SECONDS_PER_DAY = 86400
+
+
+def row_random(seed: int, rows: np.ndarray, stream: int = 0) -> np.ndarray:
+    """Uniform floats in [0, 1) that only depend on the seed, the stream and the row number (splitmix64)
+
+    :param seed: Seed of the column
+    :param rows: Row numbers
+    :param stream: Separate draws for the same row, like the different parts of a value
+    """
+    with np.errstate(over="ignore"):
+        x = np.asarray(rows, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(seed % 2 ** 64)
+        x = x + np.uint64(stream) * np.uint64(0xD1B54A32D192ED03)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) / 2 ** 53
+
+
+def row_randint(seed: int, rows: np.ndarray, stream: int, low: int, high: int) -> np.ndarray:
+    """Integers between low and high inclusive, like random_int"""
+    return low + (row_random(seed, rows, stream) * (high - low + 1)).astype(np.int64)
+
+
+def _pick(elements: list, seed: int, rows: np.ndarray, stream: int) -> np.ndarray:
+    return np.array(elements, dtype=object)[row_randint(seed, rows, stream, 0, len(elements) - 1)]
+
+
+def _text(values: np.ndarray) -> np.ndarray:
+    return values.astype(str).astype(object)
+
 # Setup the faker variable
 # Faker provider for assignment
 class CustomProvider(BaseProvider):
     def assignment(self):
-        # Fake class list
-        classes = [
-            'Reading',
-            'Video',
-            'Practice',
-            'Random',
-            'English',
-            'Architecture',
-            'Information'
-        ]
         num = self.random_number(digits=3)
-        clas = self.random_element(elements=(*classes,))
+        clas = self.random_element(elements=(*CLASSES,))
         return f'{clas} Assignment #{num}'
 
+    def assignment_batch(self, rows: np.ndarray, seed: int) -> np.ndarray:
+        """Same kind of values as assignment for many rows at once, each only depending on the seed and its row
+
+        :param rows: Row numbers within the table
+        :param seed: Seed of the column
+        :return: Object array of the names
+        """
+        clas = _pick(CLASSES, seed, rows, 0)
+        return clas + ' Assignment #' + _text(row_randint(seed, rows, 1, 0, 999))
+
     def date_time_on_date(self, date):
         """
         Input: datetime (or str that will be parsed)
@@ -45,15 +82,53 @@ class CustomProvider(BaseProvider):
             logger.info(f"Exception for date of {date}, just returning original date")
             return date
 
+    def date_time_on_date_batch(self, dates, rows: np.ndarray, seed: int):
+        """Same as date_time_on_date for many rows at once, each only depending on the seed and its row
+
+        Strings are all parsed together, anything that isn't a date is returned as it was.
+
+        :param dates: Series or list of datetimes or strings
+        :param rows: Row numbers within the table
+        :param seed: Seed of the column
+        :return: Array of the new datetimes, an object array if some values weren't dates
+        """
+        dates = pd.Series(list(dates) if not isinstance(dates, pd.Series) else dates.values)
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            parsed = dates
+        else:
+            try:
+                parsed = pd.to_datetime(dates, errors="coerce")
+            except (TypeError, ValueError):
+                # Like a mix of time zones, parse them one at a time
+                parsed = pd.Series([pd.to_datetime(date, errors="coerce") for date in dates], dtype=object)
+                parsed = pd.to_datetime(parsed.where(parsed.notna(), None), errors="coerce", utc=True)
+        seconds = row_randint(seed, rows, 0, 0, SECONDS_PER_DAY - 1)
+        moved = parsed.dt.floor("D") + pd.to_timedelta(seconds, unit="s")
+        found = parsed.notna().values
+        if found.all():
+            return moved.array
+        out = dates.astype(object).values.copy()
+        out[found] = moved[found].astype(object).values
+        return out
+
     def course(self):
         """
         Generate course id
         """
-        classList = ['GEOG', 'DENT', 'LATIN', 'SI', 'PHYSICS', 'AUTO', 'EECS']
-        semester = ['SP', 'SU', 'WN', 'FA']
         course_id = self.random_int(100, 999)
         session_id = self.random_int(1,9)
         year = self.random_int(10,99)
-        clas = self.random_element(elements=(*classList,))
-        smst = self.random_element(elements=(*semester,))
+        clas = self.random_element(elements=(*CLASS_LIST,))
+        smst = self.random_element(elements=(*SEMESTERS,))
         return f"{clas} {course_id} 00{session_id} {smst} 20{year}"
+
+    def course_batch(self, rows: np.ndarray, seed: int) -> np.ndarray:
+        """Same kind of values as course for many rows at once, each only depending on the seed and its row
+
+        :param rows: Row numbers within the table
+        :param seed: Seed of the column
+        :return: Object array of the course names
+        """
+        name = _pick(CLASS_LIST, seed, rows, 0) + " " + _text(row_randint(seed, rows, 1, 100, 999))
+        name = name + " 00" + _text(row_randint(seed, rows, 2, 1, 9)) + " " + _pick(SEMESTERS, seed, rows, 3)
+        return name + " 20" + _text(row_randint(seed, rows, 4, 10, 99))
@@ -0,0 +1,207 @@
+# Exports the anonymized tables to compressed files, one per database table, with a manifest of their rows and checksums
+import datetime, gzip, hashlib, json, logging, os, threading
+
+import pandas as pd
+
+import util_methods
+
+logger = logging.getLogger()
+
+# File extension of each format
+FORMATS = {"parquet": ".parquet", "csv.gz": ".csv.gz"}
+MANIFEST_FILE = "manifest.json"
+# Size of the blocks the files are read back in to checksum them
+HASH_BLOCK = 1024 * 1024
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CsvWriter():
+    """Appends chunks to a gzipped CSV file, the header is only written with the first one"""
+
+    def __init__(self, path: str, types: dict = None):
+        """
+        :param path: File to write
+        :param types: Not needed for CSV, see ParquetWriter
+        """
+        self.out = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        # Written straight to the file a few rows at a time, without building the whole CSV as a string
+        df.to_csv(self.out, index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.out.close()
+
+
+class ParquetWriter():
+    """Appends chunks to a Parquet file as row groups, using the schema of the first chunk for all of them
+
+    Integer columns are always written as int64 since compact dtypes can differ between chunks. Columns that are
+    empty in the first chunk get the type of their database column, or string if it isn't known. Every chunk is
+    cast to the schema.
+    """
+
+    def __init__(self, path: str, types: dict = None):
+        """
+        :param path: File to write
+        :param types: Kind of each column, from util_methods.column_types
+        """
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Exporting to parquet needs pyarrow (pip install pyarrow), "
+                              "or set EXPORT_FORMAT=csv.gz") from e
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.types = types or {}
+        self.schema = None
+        self.writer = None
+
+    def _kind_type(self, name: str):
+        """Arrow type of a column from its database kind"""
+        kinds = {"int": self.pa.int64(), "float": self.pa.float64(), "datetime": self.pa.timestamp("ns"),
+                 "date": self.pa.date32()}
+        return kinds.get(self.types.get(name), self.pa.string())
+
+    def _field(self, field, empty: bool):
+        """Field of the schema from the field of the first chunk, and whether that chunk had no values in it"""
+        if self.pa.types.is_integer(field.type):
+            return field.with_type(self.pa.int64())
+        if self.pa.types.is_dictionary(field.type):
+            # Empty categoricals have float categories whatever the column holds
+            value_type = self._kind_type(field.name) if empty else field.type.value_type
+            # Categoricals can have more categories in a later chunk
+            return field.with_type(self.pa.dictionary(self.pa.int32(), value_type))
+        if empty:
+            return field.with_type(self._kind_type(field.name))
+        return field
+
+    def write(self, df: pd.DataFrame):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            empty = df.isna().all()
+            self.schema = self.pa.schema([self._field(field, empty[field.name]) for field in table.schema])
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {"parquet": ParquetWriter, "csv.gz": CsvWriter}
+
+
+class TableExport():
+    """Streams the chunks of a config.json entry into the files of its database tables
+
+    The files are written under a temporary name and only replace the last export once the table is finished.
+    """
+
+    def __init__(self, export, mysql_tables: str, types: dict = None):
+        """
+        :param export: SnapshotExport the table belongs to
+        :param mysql_tables: Key of the entry in config.json
+        :param types: Kind of each column, from util_methods.column_types
+        """
+        self.export = export
+        self.mysql_tables = mysql_tables
+        self.types = types or {}
+        self.table_names = [mysql_table.split("@")[0] for mysql_table in mysql_tables.split("|")]
+        self.writers = {}
+        self.rows = dict.fromkeys(self.table_names, 0)
+
+    def tmp_path(self, table_name: str) -> str:
+        return self.export.path(table_name) + ".tmp"
+
+    def table_types(self, table_name: str) -> dict:
+        """Kinds of the columns of one database table, without the table name of joined entries"""
+        if "|" not in self.mysql_tables:
+            return self.types
+        prefix = table_name + "."
+        return {col[len(prefix):]: kind for col, kind in self.types.items() if col.startswith(prefix)}
+
+    def write(self, df: pd.DataFrame):
+        """Append a chunk, joined entries are split up and deduplicated like they are for the database"""
+        for table_name, df_tmp in util_methods.split_tables(self.mysql_tables, df):
+            if table_name not in self.writers:
+                self.writers[table_name] = WRITERS[self.export.format](self.tmp_path(table_name),
+                                                                       self.table_types(table_name))
+            self.writers[table_name].write(df_tmp)
+            self.rows[table_name] += len(df_tmp)
+
+    def finish(self):
+        """Close the files, move them into place and add them to the manifest"""
+        for table_name in self.table_names:
+            writer = self.writers.pop(table_name, None)
+            if writer is None:
+                # A table without any rows has no file
+                self.export.add(table_name, {"file": None, "rows": 0, "bytes": 0, "sha256": None})
+                continue
+            writer.close()
+            path = self.export.path(table_name)
+            os.replace(self.tmp_path(table_name), path)
+            self.export.add(table_name, {"file": os.path.basename(path), "rows": self.rows[table_name],
+                                         "bytes": os.path.getsize(path), "sha256": sha256_file(path)})
+            logger.info(f"Exported {self.rows[table_name]} rows of {table_name} to {path}")
+
+    def abort(self):
+        """Remove the partly written files, the last export is left as it was"""
+        for table_name, writer in self.writers.items():
+            try:
+                writer.close()
+            except Exception:
+                logger.exception(f"Problem closing the export of {table_name}")
+            if os.path.exists(self.tmp_path(table_name)):
+                os.remove(self.tmp_path(table_name))
+        self.writers = {}
+
+
+class SnapshotExport():
+    """Directory of exported tables, shared by every table of a run"""
+
+    def __init__(self, directory: str, file_format: str = "parquet"):
+        """
+        :param directory: Directory to write the files and manifest.json to
+        :param file_format: Either "parquet" or "csv.gz"
+        """
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown export format {file_format}, use one of {list(FORMATS)}")
+        self.directory = directory
+        self.format = file_format
+        os.makedirs(directory, exist_ok=True)
+        # Tables running at the same time add to the manifest
+        self._lock = threading.Lock()
+        self.tables = {}
+
+    def path(self, table_name: str) -> str:
+        return os.path.join(self.directory, table_name + FORMATS[self.format])
+
+    def table(self, mysql_tables: str, types: dict = None) -> TableExport:
+        return TableExport(self, mysql_tables, types)
+
+    def add(self, table_name: str, entry: dict):
+        with self._lock:
+            self.tables[table_name] = entry
+
+    def write_manifest(self) -> str:
+        """Save the row counts and checksums of every exported table, once the whole run worked"""
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with self._lock:
+            manifest = {"created": datetime.datetime.now().isoformat(), "format": self.format,
+                        "tables": dict(sorted(self.tables.items()))}
+        with open(path + ".tmp", "w") as out:
+            json.dump(manifest, out, indent=4)
+        os.replace(path + ".tmp", path)
+        logger.info(f"Wrote the export manifest to {path}")
+        return path
@@ -1,17 +1,36 @@
 import pyffx
 
 import string, logging, sys
-import re
+import re, hmac, math
 import numpy as np
+import pandas as pd
 from autologging import logged, traced
-import random
+import random, threading
+from collections import OrderedDict
 
 logger = logging.getLogger()
 
+# Splits a value into runs of digits, runs of letters and runs of anything else
+TOKEN_RE = re.compile(r'(\W+|\d+)')
+
+# Missing value of the nullable dtypes, pandas before 1.0 doesn't have it
+PD_NA = getattr(pd, "NA", None)
+
+# Marks a value that isn't in the memo
+_MISSING = object()
+
+# Powers of 10 that fit in an int64, used to count digits
+POW10 = np.array([10 ** i for i in range(19)], dtype=np.int64)
+INT64_MIN, INT64_MAX = int(np.iinfo(np.int64).min), int(np.iinfo(np.int64).max)
+
 @logged
 class FFXEncrypt():
 
-    def __init__(self, ffx_secret: str):
+    def __init__(self, ffx_secret: str, cache_size: int = 100000):
+        """
+        :param ffx_secret: Secret used for the encryption
+        :param cache_size: Maximum number of values and tokens remembered with their ciphertext, 0 disables it
+        """
         if len(ffx_secret) < 16:
             logger.exception("The length of the secret should be longer than 16, a random key will be used.")
             ffx_secret = ''.join(random.choices(string.ascii_lowercase, k=16))
@@ -20,6 +39,163 @@ class FFXEncrypt():
             ffx_secret = ffx_secret.encode()
         
         self.ffx_secret = ffx_secret
+        # pyffx cipher objects keyed by (kind, alphabet, length)
+        self._ciphers = {}
+        # Least recently used memo of input -> ciphertext
+        self.cache_size = cache_size
+        self._memo = OrderedDict()
+        # Tables can be processed on several threads at once
+        self._memo_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cipher(self, kind: str, alphabet: str, length: int):
+        """Get a cached pyffx cipher object
+
+        :param kind: Either "int" for pyffx.Integer or "str" for pyffx.String
+        :param alphabet: Alphabet of the cipher, ignored for integers
+        :param length: Length of the values that will be encrypted
+        """
+        key = (kind, alphabet, length)
+        e = self._ciphers.get(key)
+        if e is None:
+            if kind == "int":
+                e = pyffx.Integer(self.ffx_secret, length=length)
+            else:
+                e = pyffx.String(self.ffx_secret, alphabet=alphabet, length=length)
+            self._ciphers[key] = e
+        return e
+
+    def _memo_get(self, key):
+        if not self.cache_size:
+            return _MISSING
+        with self._memo_lock:
+            try:
+                enc = self._memo[key]
+            except KeyError:
+                self.cache_misses += 1
+                return _MISSING
+            self._memo.move_to_end(key)
+            self.cache_hits += 1
+            return enc
+
+    def _memo_put(self, key, enc):
+        if not self.cache_size:
+            return
+        with self._memo_lock:
+            self._memo[key] = enc
+            if len(self._memo) > self.cache_size:
+                self._memo.popitem(last=False)
+
+    def cache_info(self) -> dict:
+        """Statistics for the memo of encrypted values"""
+        with self._memo_lock:
+            return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self._memo),
+                    "maxsize": self.cache_size}
+
+    def clear_cache(self):
+        with self._memo_lock:
+            self._memo.clear()
+            self.cache_hits = self.cache_misses = 0
+
+    def encrypt_int_array(self, values: np.ndarray, addition: int = sys.maxsize) -> np.ndarray:
+        """ Encrypt an array of integers, giving the same results as calling encrypt on each of them.
+        The Feistel rounds of pyffx are run over all of the values with the same number of digits at once.
+        :param values: Integers to encrypt
+        :type values: numpy.ndarray
+        :param addition: Value added to an integer number, which will be subtracted first, defaults to sys.maxsize
+        :param addition: int, optional
+        :return: Encrypted integers, values that aren't positive go through encrypt and are converted back to int
+        :rtype: numpy.ndarray of int64, or of Python ints if a result doesn't fit in an int64
+        """
+        values = np.asarray(values, dtype=np.int64)
+        out = np.empty_like(values)
+        # Zero and negative numbers are encrypted as strings by encrypt, and numbers with 19 digits (or any
+        # addition that isn't positive) could overflow the int64 arithmetic, so they go through encrypt
+        scalar = values <= 0
+        if not 0 < addition <= INT64_MAX:
+            scalar[:] = True
+        scalar |= values >= POW10[-1]
+        batch = ~scalar
+        if batch.any():
+            vals = values[batch]
+            # If there's an addition do the new calculation
+            n_vals = vals - addition
+            has_addition = n_vals > 0
+            vals = np.where(has_addition, n_vals, vals)
+            # Only encrypt each distinct value once
+            uniques, inverse = np.unique(vals, return_inverse=True)
+            enc = np.empty_like(uniques)
+            lengths = np.searchsorted(POW10, uniques, side="right")
+            for length in np.unique(lengths):
+                of_length = lengths == length
+                enc[of_length] = self._encrypt_int_length(uniques[of_length], int(length))
+            enc = enc[inverse]
+            # Adding the addition back can go past the largest int64
+            overflow = has_addition & (enc > INT64_MAX - addition)
+            enc[has_addition & ~overflow] += addition
+            out[batch] = enc
+            scalar[np.flatnonzero(batch)[overflow]] = True
+        results = {pos: int(self.encrypt(int(values[pos]), addition=addition)) for pos in np.flatnonzero(scalar)}
+        if any(not INT64_MIN <= result <= INT64_MAX for result in results.values()):
+            out = out.astype(object)
+        for pos, result in results.items():
+            out[pos] = result
+        return out
+
+    def _encrypt_int_length(self, values: np.ndarray, length: int) -> np.ndarray:
+        """Run pyffx.Integer(length=length).encrypt over an array of values that all have that many digits"""
+        ffx = self.cipher("int", string.digits, length).ffx
+        radix = 10
+        chars_per_hash = int(ffx.digest_size * math.log(256, radix))
+        if int(math.ceil(length / 2)) > chars_per_hash:
+            # A round would need more than one hash, leave it to pyffx
+            e = self.cipher("int", string.digits, length)
+            return np.array([e.encrypt(int(v)) for v in values], dtype=np.int64)
+
+        place = POW10[:length][::-1]
+        digits = (values[:, None] // place) % radix
+        s = int(length / 2)
+        a, b = digits[:, :s], digits[:, s:]
+        base = hmac.new(ffx.key, digestmod=ffx.digestmod)
+        for i in range(ffx.rounds):
+            c = (a + self._round_digits(base, radix, i, b, a.shape[1])) % radix
+            a, b = b, c
+        digits = np.concatenate([a, b], axis=1)
+        return (digits * place).sum(axis=1)
+
+    @staticmethod
+    def _round_digits(base, radix: int, i: int, s: np.ndarray, count: int) -> np.ndarray:
+        """The first count digits pyffx's round function yields for every row of s
+
+        Each round hashes struct.pack('I%sI' % len(s), i, *s) + struct.pack('I', 0) and uses the digits
+        of the digest read as a big endian number, least significant first. The hash only depends on the
+        half of the digits in s, so it is only computed once for every distinct half.
+        """
+        if count == 0:
+            return np.zeros((len(s), 0), dtype=np.int64)
+        # Each row of digits read as one number, which is cheaper to find the distinct rows of
+        keys = (s * POW10[:s.shape[1]][::-1]).sum(axis=1)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        s = s[first]
+        n = len(s)
+        msg = np.zeros((n, s.shape[1] + 2), dtype=np.uintc)
+        msg[:, 0] = i
+        msg[:, 1:-1] = s
+        buf = msg.tobytes()
+        row = msg.itemsize * msg.shape[1]
+        digests = []
+        for start in range(0, n * row, row):
+            h = base.copy()
+            h.update(buf[start:start + row])
+            digests.append(h.digest())
+        # The digest modulo radix ** count, built from 16 bit words so nothing overflows
+        words = np.frombuffer(b"".join(digests), dtype=">u2").reshape(n, -1).astype(np.int64)
+        modulus = radix ** count
+        coef = np.array([pow(2, 16 * k, modulus) for k in range(words.shape[1] - 1, -1, -1)], dtype=np.int64)
+        d = ((words * coef) % modulus).sum(axis=1) % modulus
+        digits = (d[:, None] // (radix ** np.arange(count, dtype=np.int64))) % radix
+        return digits[inverse.reshape(-1)]
 
     def count_replace(self, s: str, old: str, new: str, max: int) -> (int, str):
         count = s.count(old)
@@ -35,10 +211,23 @@ class FFXEncrypt():
         :return: Encrypted number fitting same format as input
         :rtype: Either an int or a string depending on what was passed in
         """
-        n_val = 0
         # If the value is none or if its numpy and nan then just return it
-        if val == None or (isinstance(val, np.float64) and np.isnan(val)):
+        if val is PD_NA or val is None or (isinstance(val, np.float64) and np.isnan(val)):
             return val
+        # The type is part of the key so 1, 1.0 and "1" are remembered separately
+        key = ("value", type(val), val, addition)
+        try:
+            enc = self._memo_get(key)
+        except TypeError:
+            # Not hashable, so it can't be remembered
+            return self._encrypt(val, addition)
+        if enc is _MISSING:
+            enc = self._encrypt(val, addition)
+            self._memo_put(key, enc)
+        return enc
+
+    def _encrypt(self, val, addition: int):
+        n_val = 0
         # Some floats are actually integers, convert these
         # They have to be represented as float64 becaues of NaN
         if (isinstance(val, np.float64) and val.is_integer()):
@@ -54,32 +243,16 @@ class FFXEncrypt():
                 logger.debug(f"n_val = {n_val} val = {val} addition = {addition}")
                 if n_val > 0:
                    val = n_val
-                e = pyffx.Integer(self.ffx_secret, length=len(str(val)))
+                e = self.cipher("int", string.digits, len(str(val)))
                 enc = e.encrypt(val)
             else: # Either String or Decimal
                 val = str(val)
                 enc = ""
-                elems = re.split('(\W+|\d+)', val)
+                elems = TOKEN_RE.split(val)
                 for elem in elems:
                     if len(elem) == 0:
                         continue
-                    vlen = len(elem)
-                    if elem.isdigit():
-                        # encrypt integer part
-                        e = pyffx.Integer(self.ffx_secret, length=vlen)
-                        temp = str(e.encrypt(elem))
-                    elif elem.isalpha():
-                        # encrypt alphabet characters
-                        if elem.islower():
-                            e = pyffx.String(self.ffx_secret, alphabet=string.ascii_lowercase, length=vlen)
-                        elif elem.isupper():
-                            e = pyffx.String(self.ffx_secret, alphabet=string.ascii_uppercase, length=vlen)
-                        else:
-                            e = pyffx.String(self.ffx_secret, alphabet=string.ascii_letters, length=vlen)
-                        temp = e.encrypt(elem)
-                    else: # Escape special characters
-                        temp = elem
-                    enc += str(temp)
+                    enc += self._encrypt_token(elem)
 
             logger.debug(f"Out val {enc}")  
             # Return it as a string 
@@ -88,4 +261,31 @@ class FFXEncrypt():
             return enc
         except Exception as e:
             logger.exception(f"Cannot encrypt {val} {type(val)}")
-            return val
\ No newline at end of file
+            return val
+
+    def _encrypt_token(self, elem: str) -> str:
+        """Encrypt one run of digits or letters of a string, anything else is passed through"""
+        if not (elem.isdigit() or elem.isalpha()):
+            # Escape special characters
+            return elem
+        key = ("token", elem)
+        temp = self._memo_get(key)
+        if temp is not _MISSING:
+            return temp
+        vlen = len(elem)
+        if elem.isdigit():
+            # encrypt integer part
+            e = self.cipher("int", string.digits, vlen)
+            temp = str(e.encrypt(elem))
+        else:
+            # encrypt alphabet characters
+            if elem.islower():
+                e = self.cipher("str", string.ascii_lowercase, vlen)
+            elif elem.isupper():
+                e = self.cipher("str", string.ascii_uppercase, vlen)
+            else:
+                e = self.cipher("str", string.ascii_letters, vlen)
+            temp = e.encrypt(elem)
+        temp = str(temp)
+        self._memo_put(key, temp)
+        return temp
@@ -0,0 +1,131 @@
+# Run wide store of integer ids and their FFX encrypted values, shared by every table
+import hashlib, hmac, json, logging, os, threading
+from typing import Callable
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+class IdMappingStore():
+    """Remembers the encrypted value of every integer id so each distinct id is only encrypted once per run,
+    whichever table or column it shows up in
+
+    The ids are kept as sorted numpy arrays and looked up with searchsorted. With a path the mapping is saved
+    as .npy files and memory mapped on the next run. The files are tagged with a fingerprint of the secret and
+    ID_ADDITION, if either changes the saved mapping is ignored and replaced.
+
+    The saved mapping links every real id to its anonymized one, so keep it as private as the database itself.
+    """
+
+    KEYS_FILE = "ids.keys.npy"
+    VALUES_FILE = "ids.values.npy"
+    META_FILE = "ids.meta.json"
+
+    def __init__(self, ffx_secret: bytes, addition: int, path: str = None):
+        """
+        :param ffx_secret: Secret used for FFX, only a fingerprint of it is saved
+        :param addition: ID_ADDITION the values are encrypted with
+        :param path: Directory to save the mapping in, None keeps it in memory only
+        """
+        if isinstance(ffx_secret, str):
+            ffx_secret = ffx_secret.encode()
+        self.addition = addition
+        self.path = path
+        self.fingerprint = hmac.new(ffx_secret, f"id-mapping/{addition}".encode(), hashlib.sha256).hexdigest()
+        self._lock = threading.Lock()
+        # Sorted ids with their encrypted values, base is what was loaded and delta what was added since
+        self.base_keys = self.base_values = np.empty(0, dtype=np.int64)
+        self.delta_keys = self.delta_values = np.empty(0, dtype=np.int64)
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self.base_keys) + len(self.delta_keys)
+
+    def load(self):
+        """Memory map the saved mapping if it was made with the same secret and addition"""
+        meta_file = os.path.join(self.path, self.META_FILE)
+        if not os.path.exists(meta_file):
+            return
+        with open(meta_file) as meta_data:
+            meta = json.load(meta_data)
+        if meta.get("fingerprint") != self.fingerprint:
+            logger.info(f"The id mapping in {self.path} was made with a different secret or ID_ADDITION, ignoring it")
+            return
+        self.base_keys = np.load(os.path.join(self.path, self.KEYS_FILE), mmap_mode="r")
+        self.base_values = np.load(os.path.join(self.path, self.VALUES_FILE), mmap_mode="r")
+        logger.info(f"Loaded {len(self.base_keys)} ids from {self.path}")
+
+    def save(self):
+        """Write the mapping out, replacing the files atomically"""
+        if not self.path:
+            return
+        with self._lock:
+            self._merge()
+            os.makedirs(self.path, exist_ok=True)
+            for name, array in ((self.KEYS_FILE, self.base_keys), (self.VALUES_FILE, self.base_values)):
+                tmp = os.path.join(self.path, name + ".tmp")
+                with open(tmp, "wb") as out:
+                    np.save(out, np.asarray(array))
+                os.replace(tmp, os.path.join(self.path, name))
+            tmp = os.path.join(self.path, self.META_FILE + ".tmp")
+            with open(tmp, "w") as out:
+                json.dump({"fingerprint": self.fingerprint, "count": len(self.base_keys)}, out)
+            os.replace(tmp, os.path.join(self.path, self.META_FILE))
+        logger.info(f"Saved {len(self.base_keys)} ids to {self.path}")
+
+    def _merge(self):
+        """Fold the ids added since loading into the sorted base arrays"""
+        if not len(self.delta_keys):
+            return
+        keys = np.concatenate([self.base_keys, self.delta_keys])
+        values = np.concatenate([self.base_values, self.delta_values])
+        order = np.argsort(keys, kind="mergesort")
+        self.base_keys, self.base_values = keys[order], values[order]
+        self.delta_keys = self.delta_values = np.empty(0, dtype=np.int64)
+
+    @staticmethod
+    def _find(keys: np.ndarray, sorted_keys: np.ndarray):
+        """Positions of keys in sorted_keys and whether they were found"""
+        pos = np.searchsorted(sorted_keys, keys)
+        found = pos < len(sorted_keys)
+        found[found] = sorted_keys[pos[found]] == keys[found]
+        return pos, found
+
+    def lookup(self, values: np.ndarray, encrypt: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """Encrypted values for an array of positive integer ids
+
+        :param values: Ids to encrypt
+        :param encrypt: Encrypts the ids that aren't known yet, like FFXEncrypt.encrypt_int_array
+        """
+        values = np.asarray(values, dtype=np.int64)
+        uniques, inverse = np.unique(values, return_inverse=True)
+        enc = np.empty_like(uniques)
+        with self._lock:
+            pos, found = self._find(uniques, self.base_keys)
+            enc[found] = self.base_values[pos[found]]
+            missing = ~found
+            pos, found = self._find(uniques[missing], self.delta_keys)
+            in_delta = np.flatnonzero(missing)[found]
+            enc[in_delta] = self.delta_values[pos[found]]
+            missing[in_delta] = False
+            new_keys = uniques[missing]
+            self.hits += len(uniques) - len(new_keys)
+            self.misses += len(new_keys)
+        if len(new_keys):
+            new_values = np.asarray(encrypt(new_keys), dtype=np.int64)
+            enc[missing] = new_values
+            with self._lock:
+                keys = np.concatenate([self.delta_keys, new_keys])
+                order = np.argsort(keys, kind="mergesort")
+                # Another thread may have added some of the same ids, they encrypt to the same values
+                keys, first = np.unique(keys[order], return_index=True)
+                self.delta_keys = keys
+                self.delta_values = np.concatenate([self.delta_values, new_values])[order][first]
+                # Keep the delta small compared to the base so lookups stay cheap
+                if len(self.delta_keys) > max(100000, len(self.base_keys) // 4):
+                    self._merge()
+        return enc[inverse.reshape(-1)]
@@ -0,0 +1,64 @@
+# Journal of the tables and chunks a run has written back, so a run that fails can be resumed
+import json, logging, os, threading
+
+logger = logging.getLogger()
+
+
+class RunJournal():
+    """Records each table's progress in a JSON file after every chunk that is committed
+
+    Every table has an entry with its write strategy, status ("running" or "done"), the number of rows
+    read from the database for the chunks written so far and the number of those chunks.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        :param path: JSON file to keep the journal in
+        :param resume: Carry on from the journal left by the last run, otherwise it is started over
+        """
+        self.path = path
+        # Tables running at the same time update the journal
+        self._lock = threading.RLock()
+        self.tables = {}
+        if resume and os.path.exists(path):
+            with open(path) as json_data:
+                self.tables = json.load(json_data).get("tables", {})
+            logger.info(f"Resuming from {path}: {self.tables}")
+        self.save()
+
+    def save(self):
+        with self._lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as out:
+                json.dump({"tables": self.tables}, out, indent=4, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def table(self, table: str) -> dict:
+        """Entry of a table, None if this run (or the one being resumed) hasn't started it"""
+        return self.tables.get(table)
+
+    def start_table(self, table: str, strategy: str, rows_read: int = 0, chunks: int = 0):
+        with self._lock:
+            self.tables[table] = {"strategy": strategy, "status": "running", "rows_read": rows_read, "chunks": chunks}
+            self.save()
+
+    def chunk_written(self, table: str, rows_read: int):
+        """Record a chunk once it is committed
+
+        :param rows_read: Total number of rows read from the database for the table so far
+        """
+        with self._lock:
+            entry = self.tables[table]
+            entry["rows_read"] = rows_read
+            entry["chunks"] += 1
+            self.save()
+
+    def table_done(self, table: str):
+        with self._lock:
+            self.tables[table]["status"] = "done"
+            self.save()
+
+    def finish(self):
+        """The whole run worked, so there is nothing to resume"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,176 @@
+# Timing and memory use of each table, phase and column of a run, written out as a JSON report
+import json, logging, resource, sys, threading, time, tracemalloc
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+logger = logging.getLogger()
+
+
+def peak_memory_mb() -> float:
+    """High water mark of the resident memory of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class MemoryTracker():
+    """Peak memory allocated while blocks of code run, for blocks that can overlap in different threads
+
+    Uses tracemalloc, which sees numpy and pandas allocations as well as Python objects but not the worker
+    processes. It only keeps one peak for the whole process, so whenever a block starts or stops the peak
+    so far is added to every block that's running and then reset. A block's peak is the most memory that was
+    allocated above what was allocated when it started, including by anything running at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._next = 0
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+
+    def _fold(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for block in self._blocks.values():
+            block[1] = max(block[1], peak)
+        # Python 3.9 and up, before that a block's peak can include an earlier one
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def start(self) -> int:
+        """Start a block, returns the token to stop it with"""
+        with self._lock:
+            self._fold()
+            token, self._next = self._next, self._next + 1
+            current = tracemalloc.get_traced_memory()[0]
+            self._blocks[token] = [current, current]
+            return token
+
+    def stop(self, token: int) -> float:
+        """Stop a block, returns its peak in MB"""
+        with self._lock:
+            self._fold()
+            start, peak = self._blocks.pop(token)
+            return max(peak - start, 0) / 2 ** 20
+
+    def close(self):
+        if self.started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def _rate(rows: int, seconds: float) -> float:
+    return rows / seconds if seconds else 0.0
+
+
+class RunMetrics():
+    """Collects the metrics of a run, tables running at the same time can record into the same one
+
+    Every table gets the wall time and rows/sec of its read, transform and write phases, and every transformed
+    column its time, rows/sec and number of distinct values (the most seen in one chunk). With track_memory
+    they also get their peak memory, the most any one chunk of them allocated, measured by a MemoryTracker,
+    otherwise it is None. The run's peak_memory_mb is the high water mark of the whole process.
+    """
+
+    PHASES = ("read", "transform", "write")
+
+    def __init__(self, track_memory: bool = False):
+        """
+        :param track_memory: Measure the peak memory of the phases and columns, tracemalloc slows Python code
+                             down several times
+        """
+        self._lock = threading.Lock()
+        self.memory = MemoryTracker() if track_memory else None
+        self.started = time.perf_counter()
+        self.tables = {}
+        # Anything else worth reporting, like the FFX cache statistics
+        self.extra = {}
+
+    def _table(self, table: str) -> dict:
+        if table not in self.tables:
+            self.tables[table] = {"rows": 0, "chunks": 0, "columns": {},
+                                  "phases": {phase: {"seconds": 0.0, "peak_memory_mb": None} for phase in self.PHASES}}
+        return self.tables[table]
+
+    def add_rows(self, table: str, rows: int):
+        with self._lock:
+            entry = self._table(table)
+            entry["rows"] += rows
+            entry["chunks"] += 1
+
+    def add_phase(self, table: str, phase: str, seconds: float, memory_mb: float = None):
+        with self._lock:
+            entry = self._table(table)["phases"][phase]
+            entry["seconds"] += seconds
+            if memory_mb is not None:
+                entry["peak_memory_mb"] = max(entry["peak_memory_mb"] or 0.0, memory_mb)
+
+    def start_memory(self):
+        """Start measuring the memory of a block, returns the token for stop_memory"""
+        return self.memory.start() if self.memory else None
+
+    def stop_memory(self, token) -> float:
+        """Peak memory in MB of the block started with start_memory, None if memory isn't tracked"""
+        return self.memory.stop(token) if self.memory and token is not None else None
+
+    @contextmanager
+    def phase(self, table: str, phase: str):
+        """Time a block of code as part of a table's phase"""
+        token = self.start_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(table, phase, time.perf_counter() - start, self.stop_memory(token))
+
+    def timed(self, table: str, phase: str, iterable: Iterable) -> Iterator:
+        """Time getting each item of an iterable as part of a table's phase, like reading the chunks"""
+        iterator = iter(iterable)
+        while True:
+            token = self.start_memory()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(table, phase, time.perf_counter() - start, self.stop_memory(token))
+                return
+            self.add_phase(table, phase, time.perf_counter() - start, self.stop_memory(token))
+            yield item
+
+    def column(self, table: str, column: str, method: str, seconds: float, rows: int, distinct: int = None,
+               memory_mb: float = None):
+        """Record one chunk of a column's transform"""
+        with self._lock:
+            entry = self._table(table)["columns"].setdefault(column, {"method": method, "seconds": 0.0, "rows": 0,
+                                                                      "distinct": None, "peak_memory_mb": None})
+            entry["seconds"] += seconds
+            entry["rows"] += rows
+            if distinct is not None:
+                entry["distinct"] = max(entry["distinct"] or 0, distinct)
+            if memory_mb is not None:
+                entry["peak_memory_mb"] = max(entry["peak_memory_mb"] or 0.0, memory_mb)
+
+    def report(self) -> dict:
+        """The metrics as a dictionary that can be saved as JSON"""
+        with self._lock:
+            tables = {}
+            for table, entry in self.tables.items():
+                phases = {phase: dict(values, rows_per_sec=_rate(entry["rows"], values["seconds"]))
+                          for phase, values in entry["phases"].items()}
+                columns = {column: dict(values, rows_per_sec=_rate(values["rows"], values["seconds"]))
+                           for column, values in entry["columns"].items()}
+                seconds = sum(values["seconds"] for values in entry["phases"].values())
+                tables[table] = {"rows": entry["rows"], "chunks": entry["chunks"], "seconds": seconds,
+                                 "rows_per_sec": _rate(entry["rows"], seconds), "phases": phases, "columns": columns}
+            return {"seconds": time.perf_counter() - self.started, "peak_memory_mb": peak_memory_mb(),
+                    "rows": sum(entry["rows"] for entry in tables.values()), "tables": tables, **self.extra}
+
+    def close(self):
+        """Stop tracking memory"""
+        if self.memory:
+            self.memory.close()
+
+    def write(self, path: str):
+        with open(path, "w") as out:
+            json.dump(self.report(), out, indent=4, default=str)
+        logger.info(f"Wrote metrics to {path}")
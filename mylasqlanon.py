@@ -1,5 +1,6 @@
 # This script reads from a MySQL server the table structure and based on the configuration file (config.json) returns encrypted/anonymized data
-import os, logging, sys, json, inspect
+import os, logging, sys, json, argparse, cProfile, functools
+from typing import Dict, List
 
 from faker import Faker
 from custom_provider import CustomProvider
@@ -8,10 +9,22 @@ from dotenv import load_dotenv
 from decouple import config, Csv
 
 import pandas as pd
-import numpy as np
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, event, text
 
 from ffx_helper import FFXEncrypt
+from id_mapping import IdMappingStore
+from watermark import WatermarkState
+import watermark
+from journal import RunJournal
+from export import SnapshotExport
+import plan
+import subset
+from subset import SubsetFilter
+from metrics import RunMetrics
+import pipeline
+from transform_engine import TableTransformer
+from parallel import TransformPool
+import scheduler
 
 import util_methods
 
@@ -24,138 +37,454 @@ sys.path.insert(0, this_dir + "/..")
 
 load_dotenv(dotenv_path=this_dir + "/.env")
 
-with open(this_dir + "/config.json") as json_data:
-    db_config = json.load(json_data)
-    logger.info (db_config)
+# Log the config and every anonymized dataframe as CSV, only for debugging small databases
+LOG_DATA = config("LOG_DATA", cast=bool, default=False)
 
-# get the tables to run based on they keys in the config
-tables = config("TABLES", cast=Csv(), default="")
-# If the user doesn't specify specific tables just run them all
-if not(tables):
-    tables = db_config.keys()
+# Keys of the tables in config.json to run, empty runs them all
+TABLES = config("TABLES", cast=Csv(), default="")
 
 # Get the prefix and secret to use with FFX
 ID_ADDITION = config("ID_ADDITION", cast=int, default=0)
 FFX_SECRET = config("FFX_SECRET", cast=str, default="")
+# Number of distinct values (and string tokens) FFX remembers the ciphertext of
+FFX_CACHE_SIZE = config("FFX_CACHE_SIZE", cast=int, default=100000)
+# Directory to keep the mapping of integer ids to their encrypted values in between runs, empty keeps it in memory
+ID_MAP_DIR = config("ID_MAP_DIR", default="")
 
 DISABLE_FOREIGN_KEYS = config("DISABLE_FOREIGN_KEYS", cast=bool, default=False)
 
-# Connect up to the database
-engine = create_engine(f"mysql://{config('MYSQL_USER')}:{config('MYSQL_PASSWORD')}@{config('MYSQL_HOST')}:{config('MYSQL_PORT')}/{config('MYSQL_DATABASE')}?charset=utf8")
+FAKER_SEED_LENGTH = config("FAKER_SEED_LENGTH", cast=int, default=0)
+# Generate the course, assignment and date_time_on_date faker columns a whole column at a time
+FAKER_BATCH = config("FAKER_BATCH", cast=bool, default=True)
 
-#Disable foreign key checks
-if (DISABLE_FOREIGN_KEYS):
-    engine.execute('SET FOREIGN_KEY_CHECKS = 0;')
+UPDATE_DATABASE = config("UPDATE_DATABASE", cast=bool, default=False)
+
+# Number of rows to stream from the database at a time, 0 loads each table whole
+CHUNK_SIZE = config("CHUNK_SIZE", cast=int, default=0)
+
+# Only read the rows past the saved watermark of tables that have a watermark column
+INCREMENTAL = config("INCREMENTAL", cast=bool, default=False)
+# File the last watermark written back for each table is saved in
+WATERMARK_FILE = config("WATERMARK_FILE", default=this_dir + "/watermarks.json")
+
+# File recording the tables and chunks written back so far, used by --resume
+RUN_JOURNAL = config("RUN_JOURNAL", default=this_dir + "/run_journal.json")
+
+# JSON report of the time, rows/sec, distinct values and memory of every table and column, empty disables it
+METRICS_FILE = config("METRICS_FILE", default=this_dir + "/metrics.json")
+# Also measure the peak memory of every phase and column with tracemalloc, which slows the Python code down a lot
+METRICS_MEMORY = config("METRICS_MEMORY", cast=bool, default=False)
+# Run under cProfile and save the stats to this file
+PROFILE_FILE = config("PROFILE_FILE", default="")
+
+# How tables are written back, "delete" empties the table first and "staging" swaps a fully written copy in at the end
+WRITE_STRATEGY = config("WRITE_STRATEGY", default="delete")
+# Number of rows per insert batch
+WRITE_BATCH_SIZE = config("WRITE_BATCH_SIZE", cast=int, default=10000)
+
+# Directory to export the anonymized tables to as files, with a manifest of their rows and checksums
+EXPORT_DIR = config("EXPORT_DIR", default="")
+# Format of the exported files, "parquet" (needs pyarrow) or "csv.gz"
+EXPORT_FORMAT = config("EXPORT_FORMAT", default="parquet")
+
+# Run the tables of a joined entry one at a time,
+# instead of transforming a row of the first table for every row joined to it
+NORMALIZED_JOINS = config("NORMALIZED_JOINS", cast=bool, default=True)
+
+# Number of chunks that can wait between reading, transforming and writing a table, 0 does one step at a time
+PIPELINE_DEPTH = config("PIPELINE_DEPTH", cast=int, default=2)
+
+# Load ids as the smallest integer type that holds them and repetitive text as categoricals, to use less memory
+COMPACT_DTYPES = config("COMPACT_DTYPES", cast=bool, default=True)
+# Number of rows read and compacted at a time when a table is loaded whole
+COMPACT_READ_ROWS = config("COMPACT_READ_ROWS", cast=int, default=50000)
+
+# Number of worker processes for the ffx and faker transforms, 0 runs them in this process
+WORKERS = config("WORKERS", cast=int, default=0)
+
+# Number of tables that can be processed at the same time
+TABLE_CONCURRENCY = config("TABLE_CONCURRENCY", cast=int, default=1)
 
-FAKER_SEED_LENGTH = config("FAKER_SEED_LENGTH", cast=int, default=0)
 
-faker = Faker()
-faker.seed(util_methods.hash_string_to_int(FFX_SECRET, FAKER_SEED_LENGTH))   
-faker.add_provider(CustomProvider)
+def _query(sql: str, params: dict = None):
+    """Statement for pd.read_sql, lists in the params are expanded for IN :name"""
+    if not params:
+        return sql
+    query = text(sql)
+    for name, value in params.items():
+        if isinstance(value, (list, tuple)):
+            query = query.bindparams(bindparam(name, expanding=True))
+    return query
 
-# This needs the string FFX_SECRET byte encoded
-ffx = FFXEncrypt(FFX_SECRET)
 
-logger.info(f"Found table {tables}")
-for table in tables:
+def read_table(sql: str, engine, chunk_size: int = 0, group_cols=None, params: dict = None, order_cols=None,
+               skip: int = 0, types: dict = None):
+    """Read the results of the query as a generator of dataframes
+
+    When chunk_size is set the rows are streamed with a server side cursor, ordered by the group columns
+    so no group spans more than one dataframe, then by order_cols so the order is the same every time.
+    Groups for any group column after the first have to be nested inside the groups of the first one
+    (like assignment_id inside course_id).
+
+    :param sql: Select statement to run
+    :param engine: SQLAlchemy engine
+    :param chunk_size: Number of rows to fetch at a time, 0 reads everything at once
+    :param group_cols: Columns used as an index by group based transforms
+    :param params: Values of the bound :name parameters in the sql
+    :param order_cols: Columns that identify a row, like the table's key
+    :param skip: Number of rows to leave out from the start, the rows a resumed run already wrote
+    :param types: Column types to convert the rows to compact dtypes with as they are read, see column_types
+    """
+    query = _query(sql, params)
+    if not chunk_size and types is None:
+        yield from util_methods.skip_rows([pd.read_sql(query, engine, params=params)], skip)
+        return
+    if not chunk_size:
+        # Read in pieces that are compacted as they arrive, so the whole table is never held in the dtypes it's read in
+        with engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True)
+            frames = [util_methods.compact_frame(df, types)
+                      for df in pd.read_sql(query, conn, chunksize=COMPACT_READ_ROWS, params=params)]
+        df = util_methods.concat_frames(frames)
+        yield from util_methods.skip_rows([] if df is None else [util_methods.compact_frame(df, types)], skip)
+        return
+    group_cols = group_cols or []
+    order = group_cols + [col for col in order_cols or [] if col not in group_cols]
+    if order:
+        sql += " ORDER BY " + ",".join(f"`{col}`" for col in order)
+        query = _query(sql, params)
+    logger.info(sql)
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        chunks = util_methods.skip_rows(pd.read_sql(query, conn, chunksize=chunk_size, params=params), skip)
+        yield from util_methods.group_aligned_chunks(chunks, group_cols[0] if group_cols else None)
+
+
+def process_table(table_plan: plan.TablePlan, engine, modules, chunk_size: int = CHUNK_SIZE,
+                  update_database: bool = UPDATE_DATABASE, pool: TransformPool = None,
+                  id_store: IdMappingStore = None, state: WatermarkState = None,
+                  incremental: bool = INCREMENTAL, journal: RunJournal = None, metrics: RunMetrics = None,
+                  pipeline_depth: int = PIPELINE_DEPTH, compact_dtypes: bool = COMPACT_DTYPES,
+                  export: SnapshotExport = None, subset_filter: SubsetFilter = None,
+                  normalized_joins: bool = NORMALIZED_JOINS):
+    """Read, transform and optionally write back a single table entry from config.json
+
+    :param table_plan: Plan of the entry, from plan.compile_config
+    :param engine: SQLAlchemy engine
+    :param modules: Dictionary of the objects that module names in config.json refer to
+    :param chunk_size: Number of rows to process at a time, 0 processes the table whole
+    :param update_database: Whether or not to write the results back
+    :param pool: Pool of worker processes to run the transforms on, if any
+    :param id_store: Mapping of the integer ids already encrypted by any table
+    :param state: Saved watermarks, updated after the table is written back
+    :param incremental: Whether to only read the rows past the saved watermark
+    :param journal: Journal of the run, the table carries on from where it is recorded to have stopped
+    :param metrics: Metrics of the run to record the table's timings in
+    :param pipeline_depth: Number of chunks that can wait between the read, transform and write stages,
+                           0 runs them one after the other
+    :param compact_dtypes: Whether to convert the chunks to compact dtypes as they are read
+    :param export: Export to stream the anonymized rows to, along with or instead of writing them back
+    :param subset_filter: Only read the rows related to the courses of a subset
+    :param normalized_joins: Run the tables of a joined entry one at a time instead of as one joined frame,
+                             when its join allows it
+    """
+    metrics = metrics or RunMetrics()
+    table = table_plan.table
     logger.info(f"Processing {table}")
-    t_config = []
-    # There's a special syntax for joined tables!
-    if "|" in table:
-        # Figure out the tables to join and run a special query on them
-        join_tables = db_config.get(table).get("tables")
-        # Go thourhg each table building up the query string
-        tmp_cols = []
-        for join_table in join_tables:
-            join_table_name = join_table.get("name")
-            for join_col in join_table.get("cols"):
-                # Get the column name
-                join_col_name = join_col.get("name")
-                # Create a new alias
-                join_alias = f"{join_table_name}.{join_col_name}"
-                tmp_cols.append(f"{join_table_name}.{join_col_name} AS `{join_alias}`")
-                # Update the alias in the column
-                join_col["name"] = join_alias
-                t_config.append(join_col)
-        db_cols = ",".join(tmp_cols)
-        # Get the name of the first table
-        db_table = join_tables[0].get("name")
-        db_join = db_config.get(table).get("join")
-        sql = f"SELECT {db_cols} FROM {db_table} {db_join}"
-    else:
-        t_config = (db_config.get(table))
-        sql = f"SELECT * from {table}"
+    member_plans = table_plan.members if normalized_joins else ()
+    if normalized_joins and "|" in table and not member_plans:
+        logger.info(f"The join of {table} can't be run one table at a time, running it as one joined frame")
+    for run_plan in member_plans or [table_plan]:
+        _process_plan(run_plan, engine, modules, chunk_size, update_database, pool, id_store, state, incremental,
+                      journal, metrics, pipeline_depth, compact_dtypes, export, subset_filter)
+
+
+def _process_plan(table_plan: plan.TablePlan, engine, modules, chunk_size: int, update_database: bool,
+                  pool: TransformPool, id_store: IdMappingStore, state: WatermarkState, incremental: bool,
+                  journal: RunJournal, metrics: RunMetrics, pipeline_depth: int, compact_dtypes: bool,
+                  export: SnapshotExport, subset_filter: SubsetFilter):
+    """Run the plan of a config.json entry, or of one table of a joined entry, see process_table"""
+    table = table_plan.table
+    sql, t_config, group_cols = table_plan.sql, table_plan.t_config(), list(table_plan.group_cols)
+    watermark_cols = table_plan.watermark
+    conditions, params = [], {}
+    if subset_filter:
+        condition, subset_params = subset_filter.condition()
+        conditions.append(condition)
+        params.update(subset_params)
+    strategy = WRITE_STRATEGY
+    # A single key lets a staging run resume, joined entries give the loader theirs with table@key
+    key_col = table_plan.key_cols[0] if "|" not in table and len(table_plan.key_cols) == 1 else None
+    if watermark_cols:
+        watermark_col, key_col = watermark_cols
+        last = state.get(table) if state else None
+        if incremental and last is not None:
+            # Only the new and changed rows, which replace the rows with the same keys
+            conditions.append(f"`{watermark_col}` > :watermark")
+            params["watermark"] = last
+            strategy = "upsert"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
     logger.info(sql)
-    df = pd.read_sql(sql, engine)
-    total_rows=len(df.axes[0])
-    total_cols=len(df.axes[1])
-    logger.info(f"Total rows: {total_rows} cols: {total_cols}")
-    logger.info(df.columns)
-
-    # If this dataframe is empty just skip it
-    if total_rows == 0 or total_cols == 0:
-        continue
-    # First go through the dataframe looking for cell specific changes
-    # TODO: These might be able to be refactored in the future to just apply across the column!
-    for row in range(total_rows):
-        for col in t_config:
-            # Split the module from the function name
-            col_name = col.get("name")
-            mod_name = col.get("module")
-            method_name = col.get("method")
-            if mod_name and method_name:
-                dyn_func = getattr(locals().get(mod_name), method_name)
-            else:
-                logger.debug (f"No change indicated for {row} {col_name}")
-                continue
-            # Faker has no parameters
-            if mod_name == "faker":
-                logger.debug(f"Transforming {col_name} with Faker")
-                if method_name == "date_time_on_date":
-                    df.at[row, col_name] = dyn_func(df.at[row, col_name])
-                else:
-                    df.at[row, col_name] = dyn_func()
-            elif mod_name == "ffx":
-                try:
-                    logger.debug(f"Transforming {col_name} with FFX")
-                    df.at[row, col_name] = dyn_func(df.at[row, col_name], addition=ID_ADDITION)
-                except ValueError:
-                    logger.exception(f"Problem converting {df.at[row, col_name]}")
-                    logger.info(np.isnan(df.at[row, col_name]))
-            # else currently do nothing
-
-    # Now go through the columns and look for column wide changes
-    # These methods are based on using another column as an index 
-    # and applying the changes in bulk rather than individually
-    for col in t_config:
-        mod_name = col.get("module")
-        method_name = col.get("method")
-        index_name = col.get("index")
-        col_name = col.get("name")
-        source_name = col.get("source")
-        if mod_name and method_name:
-            dyn_func = getattr(locals().get(mod_name), method_name)
+    # Resolve the transforms once for the whole table
+    transformer = TableTransformer(t_config, modules, addition=ID_ADDITION, pool=pool, seed_prefix=table,
+                                   id_store=id_store, record=functools.partial(metrics.column, table),
+                                   memory=metrics.memory,
+                                   faker_batch=FAKER_BATCH,
+                                   faker_seed=util_methods.hash_string_to_int(FFX_SECRET, FAKER_SEED_LENGTH))
+    loader = util_methods.TableLoader(table, engine, strategy=strategy, batch_size=WRITE_BATCH_SIZE, key=key_col)
+    skip = 0
+    if journal and update_database:
+        entry = journal.table(table)
+        if entry and entry["status"] == "done":
+            logger.info(f"Skipping {table}, it was finished before")
+            return
+        if entry and entry["chunks"] and entry["strategy"] == strategy == "staging":
+            if loader.resume():
+                skip = entry["rows_read"]
+                # Faker values seeded by row number carry on from the same row
+                transformer.rows_seen = skip
+                logger.info(f"Resuming {table} after {skip} rows")
+            elif not loader.staged():
+                # The staged rows were swapped in but the run stopped before recording it
+                journal.table_done(table)
+                return
+        elif entry and entry["chunks"] and entry["strategy"] == "delete":
+            raise RuntimeError(f"{table} was partly written with the delete strategy and its unread rows are gone, "
+                               "restore it before running again. Use WRITE_STRATEGY=staging to be able to resume")
+        # Otherwise the table starts over, upserts replace rows by key so replaying them is safe
+        journal.start_table(table, strategy, rows_read=skip, chunks=entry["chunks"] if skip else 0)
+    rows_read = skip
+    highest = []
+    # The database types are also what the export gives columns that are empty in the first chunk
+    types = util_methods.column_types(engine, table, t_config)
+    table_export = export.table(table, types) if export else None
+
+    def transform(df: pd.DataFrame):
+        nonlocal rows_read
+        total_rows = len(df.axes[0])
+        total_cols = len(df.axes[1])
+        rows_read += total_rows
+        logger.info(f"Total rows: {total_rows} cols: {total_cols}")
+        logger.info(df.columns)
+
+        # If this dataframe is empty just skip it
+        if total_rows == 0 or total_cols == 0:
+            return None
+        raw_keys = None
+        if watermark_cols:
+            highest.append(df[watermark_col].max())
+        if strategy == "upsert":
+            # The key may be encrypted, so remember which rows were read
+            raw_keys = df[key_col].tolist()
+        metrics.add_rows(table, total_rows)
+        with metrics.phase(table, "transform"):
+            transformer.apply(df)
+        if table_plan.lookups:
+            # Only read to group by
+            df = df.drop(columns=list(table_plan.lookups))
+        return df, raw_keys, rows_read
+
+    def write(chunk: tuple):
+        df, raw_keys, chunk_rows_read = chunk
+        if (update_database):
+            with metrics.phase(table, "write"):
+                loader.write(df, keys=raw_keys)
+            if journal:
+                journal.chunk_written(table, chunk_rows_read)
+        if table_export:
+            with metrics.phase(table, "write"):
+                table_export.write(df)
+
+        if LOG_DATA:
+            logger.info(df.to_csv())
+
+    try:
+        frames = read_table(sql, engine, chunk_size, group_cols, params, order_cols=list(table_plan.key_cols),
+                            skip=skip, types=types if compact_dtypes else None)
+        if compact_dtypes and chunk_size:
+            frames = (util_methods.compact_frame(df, types) for df in frames)
+        # The next chunk is read and the last one written while this one is transformed
+        pipeline.run(metrics.timed(table, "read", frames), transform, write, depth=pipeline_depth, name=table)
+        if table_export:
+            table_export.finish()
+        if (update_database):
+            with metrics.phase(table, "write"):
+                loader.finish()
+            if state and highest:
+                state.set(table, watermark.max_value(pd.Series(highest)))
+            if journal:
+                journal.table_done(table)
+    except Exception:
+        # Keep what was staged so far for --resume
+        loader.abort(keep_staging=journal is not None)
+        if table_export:
+            table_export.abort()
+        raise
+
+
+def table_faker(table: str) -> Faker:
+    """Faker with its own random stream for a table, so tables running at the same time don't share one"""
+    faker = Faker()
+    faker.add_provider(CustomProvider)
+    faker.seed_instance(util_methods.hash_string_to_int(FFX_SECRET + table, FAKER_SEED_LENGTH))
+    return faker
+
+
+def load_config(path: str = this_dir + "/config.json") -> dict:
+    """Read config.json, it is only compiled into plans when a run starts"""
+    with open(path) as json_data:
+        db_config = json.load(json_data)
+    if LOG_DATA:
+        logger.info(db_config)
+    return db_config
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Anonymize the tables in config.json")
+    parser.add_argument("--resume", action="store_true",
+                        help="Carry on from the run journal of a run that failed, skipping the work it finished")
+    parser.add_argument("--explain", action="store_true",
+                        help="Print the query, estimated rows, transforms and cost of every table without running them")
+    parser.add_argument("--courses", default=None,
+                        help="Comma separated course ids, only run the rows related to them")
+    parser.add_argument("--course-count", type=int, default=0,
+                        help="Only run the rows related to this many courses (the lowest ids)")
+    parser.add_argument("--term", default=None, help="Only run the rows related to the courses of this term_id")
+    parser.add_argument("--rates", default=None,
+                        help="Results of python -m benchmarks.suite to estimate the cost with, for --explain")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_config = load_config()
+    # If the user doesn't specify specific tables just run them all
+    tables = list(TABLES) or list(db_config)
+    # Checked and compiled up front, so a mistake in config.json stops the run before any table is read
+    table_plans = plan.compile_config(db_config, tables)
+    # Connect up to the database, every table running at once can use a connection to read and one to write
+    engine = create_engine(f"mysql://{config('MYSQL_USER')}:{config('MYSQL_PASSWORD')}@{config('MYSQL_HOST')}:"
+                           f"{config('MYSQL_PORT')}/{config('MYSQL_DATABASE')}?charset=utf8",
+                           pool_size=max(5, 2 * TABLE_CONCURRENCY))
+    # Stop before anything is changed if config.json doesn't match the database
+    plan.validate_schema(table_plans, engine, tables)
+    if args.explain:
+        explained = plan.explain(table_plans, engine, tables, plan.load_rates(args.rates), CHUNK_SIZE,
+                                 FAKER_BATCH, NORMALIZED_JOINS)
+        print(plan.format_explain(explained))
+        return
+    courses = None
+    if args.courses or args.course_count or args.term is not None:
+        courses = subset.select_courses(engine, [int(course) for course in (args.courses or "").split(",") if course],
+                                        args.course_count, args.term)
+        if not courses:
+            raise ValueError("No courses matched the subset")
+        logger.info(f"Subset of {len(courses)} courses")
+
+    # Disable foreign key checks
+    if (DISABLE_FOREIGN_KEYS):
+        engine.execute('SET FOREIGN_KEY_CHECKS = 0;')
+
+        # The setting is per connection, so also disable them on every other connection in the pool
+        @event.listens_for(engine, "connect")
+        def disable_foreign_keys(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET FOREIGN_KEY_CHECKS = 0;')
+            cursor.close()
+
+    try:
+        if PROFILE_FILE:
+            # Only profiles this thread, so set TABLE_CONCURRENCY=1 and WORKERS=0 to see everything
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, engine, db_config, table_plans, tables, resume=args.resume, courses=courses)
+            finally:
+                profiler.dump_stats(PROFILE_FILE)
+                logger.info(f"Wrote profile to {PROFILE_FILE}, view it with python -m pstats {PROFILE_FILE}")
         else:
-            logger.debug (f"No change indicated for {col_name}")
-            continue
-        # TODO These are currently all "util_methods" but this should be refactored
-        # since these are all nearly identical
-        if method_name == "redist":
-            # If it gets here it has to be numeric
-            logger.debug(f"{index_name} {col_name}")
-            dyn_func(df, col_name, index_name)
-        elif method_name == "mean":
-            logger.debug(f"{index_name} {col_name}")
-            dyn_func(df, source_name, col_name, index_name)
-        elif method_name == "shuffle":
-            # Shuffle column inplace
-            logger.debug(f"Shuffle {col_name}")
-            dyn_func(df, shuffle_col=col_name, index_col=index_name)
-
-    if (config("UPDATE_DATABASE", cast=bool, default=False)):
-        util_methods.pandas_delete_and_insert(table, df, engine)
-
-    logger.info(df.to_csv())
-# Re-enable checks
-if (DISABLE_FOREIGN_KEYS):
-    engine.execute('SET FOREIGN_KEY_CHECKS = 1;')
\ No newline at end of file
+            run(engine, db_config, table_plans, tables, resume=args.resume, courses=courses)
+    finally:
+        # Re-enable checks, even if the run failed
+        if (DISABLE_FOREIGN_KEYS):
+            event.remove(engine, "connect", disable_foreign_keys)
+            engine.execute('SET FOREIGN_KEY_CHECKS = 1;')
+            # Close the pooled connections that still have them disabled
+            engine.dispose()
+
+
+def run(engine, db_config: dict, table_plans: Dict[str, plan.TablePlan], tables: List[str], resume: bool = False,
+        courses: list = None):
+    """Process all of the tables
+
+    :param engine: SQLAlchemy engine
+    :param db_config: The contents of config.json
+    :param table_plans: Plans of the entries of config.json, from plan.compile_config
+    :param tables: Keys of the tables to run
+    :param resume: Carry on from the run journal instead of starting over
+    :param courses: Only process the rows related to these course ids
+    """
+    # This needs the string FFX_SECRET byte encoded
+    ffx = FFXEncrypt(FFX_SECRET, cache_size=FFX_CACHE_SIZE)
+
+    # Every table adds its own faker, see run_table
+    modules = {"ffx": ffx, "util_methods": util_methods}
+
+    # Ids like user_id show up in many tables, they only get encrypted the first time
+    id_store = IdMappingStore(FFX_SECRET, ID_ADDITION, path=ID_MAP_DIR or None)
+
+    # Tables with a watermark column remember how far they got, a subset doesn't say anything about the other rows
+    state = WatermarkState(WATERMARK_FILE) if courses is None else None
+
+    # Worked out before any table is written back, since the filters look at other tables
+    filters = subset.build_filters(table_plans, engine, courses, tables) if courses is not None else {}
+
+    # Only runs that write back have anything to resume
+    journal = RunJournal(RUN_JOURNAL, resume=resume) if UPDATE_DATABASE else None
+
+    metrics = RunMetrics(track_memory=METRICS_MEMORY)
+
+    export = None
+    if EXPORT_DIR:
+        if resume:
+            # The files of the tables finished before aren't kept, and resumed tables would only have their last rows
+            raise ValueError("--resume can't be used with EXPORT_DIR, run the export again from the start")
+        export = SnapshotExport(EXPORT_DIR, EXPORT_FORMAT)
+
+    pool = None
+    if WORKERS:
+        # The workers get the secret and seed once when they start
+        pool = TransformPool(WORKERS, FFX_SECRET, FFX_CACHE_SIZE,
+                             util_methods.hash_string_to_int(FFX_SECRET, FAKER_SEED_LENGTH))
+
+    def run_table(table: str):
+        # Every table gets its own faker stream so the results are the same at any TABLE_CONCURRENCY
+        process_table(table_plans[table], engine, dict(modules, faker=table_faker(table)), pool=pool, id_store=id_store,
+                      state=state, journal=journal, metrics=metrics, export=export, subset_filter=filters.get(table))
+
+    logger.info(f"Found table {tables}")
+    # Tables that touch the same database tables run one after another, the rest at the same time
+    depends_on = scheduler.build_graph(tables, db_config)
+    logger.info(f"Table dependencies {depends_on}")
+    try:
+        scheduler.run_tables(tables, depends_on, run_table, concurrency=TABLE_CONCURRENCY)
+    finally:
+        if pool:
+            pool.shutdown()
+        # Everything in the store is correct even if a table failed
+        id_store.save()
+        metrics.extra["ffx_cache"] = ffx.cache_info()
+        metrics.extra["id_mapping"] = {"ids": len(id_store), "hits": id_store.hits, "misses": id_store.misses}
+        metrics.close()
+        if METRICS_FILE:
+            metrics.write(METRICS_FILE)
+    if export:
+        export.write_manifest()
+    if journal:
+        journal.finish()
+    logger.info(f"FFX cache {ffx.cache_info()}")
+    logger.info(f"Id mapping {len(id_store)} ids, {id_store.hits} hits, {id_store.misses} misses")
+
+
+if __name__ == "__main__":
+    main()
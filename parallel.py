@@ -0,0 +1,85 @@
+# Process pool for running the ffx and faker column transforms on all of the cores
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from faker import Faker
+
+from custom_provider import CustomProvider
+from ffx_helper import FFXEncrypt
+import transform_engine
+
+logger = logging.getLogger()
+
+# Smallest number of values or rows worth sending to a worker on its own
+MIN_TASK_SIZE = 1000
+
+# Objects built once in each worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(ffx_secret: str, cache_size: int, faker_seed: int):
+    """Set up the transforms of a worker process, this runs once when the worker starts"""
+    faker = Faker()
+    faker.add_provider(CustomProvider)
+    _worker["modules"] = {"ffx": FFXEncrypt(ffx_secret, cache_size=cache_size), "faker": faker}
+    _worker["faker_seed"] = faker_seed
+
+
+def _map_distinct(module: str, method: str, uniques: list, dtype, addition: int) -> np.ndarray:
+    func, batch_func = transform_engine.resolve(_worker["modules"], module, method)
+    return transform_engine.map_distinct(func, batch_func, uniques, dtype, addition)
+
+
+def _fake_rows(funcs: list, takes_input: list, inputs: list, seeds: list, start_row: int, rows: int) -> list:
+    seeds = [f"{_worker['faker_seed']}/{seed}" for seed in seeds]
+    return transform_engine.fake_rows(_worker["modules"]["faker"], funcs, takes_input, inputs, seeds, start_row, rows)
+
+
+def split(total: int, pieces: int, min_size: int = MIN_TASK_SIZE) -> list:
+    """Split range(total) into at most pieces (start, stop) ranges of at least min_size"""
+    pieces = max(1, min(pieces, total // min_size))
+    bounds = np.linspace(0, total, pieces + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+class TransformPool():
+    """Runs column transforms on a pool of worker processes
+
+    The workers get the secret and faker seed once when they start. Faker is reseeded for every
+    cell from the seed, table, column and row number, so the output is the same for any number of workers.
+    """
+
+    def __init__(self, workers: int, ffx_secret: str, cache_size: int, faker_seed: int):
+        """
+        :param workers: Number of worker processes
+        :param ffx_secret: Secret used for FFX
+        :param cache_size: Size of the FFX memo in each worker
+        :param faker_seed: Seed all of the per row faker seeds are derived from
+        """
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(ffx_secret, cache_size, faker_seed))
+
+    def map_distinct(self, module: str, method: str, uniques: list, dtype, addition: int) -> np.ndarray:
+        """Same as transform_engine.map_distinct, split up over the workers"""
+        futures = [self.executor.submit(_map_distinct, module, method, uniques[start:stop], dtype, addition)
+                   for start, stop in split(len(uniques), self.workers * 4)]
+        results = [future.result() for future in futures]
+        return np.concatenate(results) if results else np.empty(0, dtype=object)
+
+    def fake_rows(self, funcs: list, takes_input: list, inputs: list, seeds: list, start_row: int, rows: int) -> list:
+        """Same as transform_engine.fake_rows, split up over the workers by rows"""
+        futures = []
+        for start, stop in split(rows, self.workers * 4):
+            chunk_inputs = [values[start:stop] if values is not None else None for values in inputs]
+            futures.append(self.executor.submit(_fake_rows, funcs, takes_input, chunk_inputs, seeds,
+                                                start_row + start, stop - start))
+        outputs = [[] for _ in funcs]
+        for future in futures:
+            for i, values in enumerate(future.result()):
+                outputs[i].extend(values)
+        return outputs
+
+    def shutdown(self):
+        self.executor.shutdown()
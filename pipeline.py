@@ -0,0 +1,104 @@
+# Runs the read, transform and write stages of a table at the same time, connected by bounded queues
+import logging, queue, threading
+from typing import Callable, Iterable
+
+logger = logging.getLogger()
+
+# Marks the end of the items in a queue
+_DONE = object()
+# How often a stage blocked on a queue checks whether another stage failed
+POLL_SECONDS = 0.1
+
+
+def run(source: Iterable, transform: Callable, sink: Callable, depth: int = 0, name: str = "pipeline"):
+    """Pass every item of source through transform and then sink
+
+    With a depth the source is read on one thread and the sink called on another, while transform runs
+    on this one, so the next chunk can be read and the last one written while a chunk is transformed.
+    Each queue between the stages holds at most depth items, so a slow stage holds the others back.
+    Items reach the sink in order. If any stage raises, the other stages stop after the item they are on,
+    the source is closed and the first error is raised here.
+
+    :param source: Iterable of the items, like the dataframes from read_table
+    :param transform: Called with each item, returns what is passed to sink or None to skip it
+    :param sink: Called with each transformed item
+    :param depth: Number of items that can wait between two stages, 0 runs everything one item at a time here
+    :param name: Prefix of the thread names
+    """
+    if depth <= 0:
+        for item in source:
+            result = transform(item)
+            if result is not None:
+                sink(result)
+        return
+
+    read_queue, write_queue = queue.Queue(depth), queue.Queue(depth)
+    stop = threading.Event()
+    errors = []
+
+    def fail(error: BaseException):
+        errors.append(error)
+        stop.set()
+
+    def put(items: queue.Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(items: queue.Queue):
+        while not stop.is_set():
+            try:
+                return items.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def reader():
+        iterator = iter(source)
+        try:
+            for item in iterator:
+                if not put(read_queue, item):
+                    break
+            put(read_queue, _DONE)
+        except BaseException as e:
+            fail(e)
+        finally:
+            # Closes the database cursor of a generator that was stopped early
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    def writer():
+        try:
+            while True:
+                item = get(write_queue)
+                if item is _DONE:
+                    return
+                sink(item)
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=reader, name=f"{name}-read", daemon=True),
+               threading.Thread(target=writer, name=f"{name}-write", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(read_queue)
+            if item is _DONE:
+                break
+            result = transform(item)
+            if result is not None and not put(write_queue, result):
+                break
+        put(write_queue, _DONE)
+    except BaseException as e:
+        fail(e)
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
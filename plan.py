@@ -0,0 +1,425 @@
+# Compiles config.json into an execution plan that is checked before any table is read, and explains what a run will do
+import json, logging, math, re
+from types import MappingProxyType
+from typing import Dict, List, NamedTuple, Tuple
+
+import sqlalchemy
+
+from faker import Faker
+from custom_provider import CustomProvider
+from ffx_helper import FFXEncrypt
+from transform_engine import TableTransformer
+import util_methods
+import watermark
+
+logger = logging.getLogger()
+
+# What each module name in config.json refers to, to check the methods exist
+MODULE_TYPES = {"ffx": FFXEncrypt, "util_methods": util_methods}
+# Column wide util_methods and whether they need an index column
+INDEX_REQUIRED = {"redist": True, "mean": True, "shuffle": False}
+
+# Rough rows/sec of each kernel in a single process, replace them with a benchmark suite results file
+DEFAULT_RATES = {
+    "read": 100000, "write": 50000,
+    "ffx_int": 120000, "ffx_string": 100000,
+    "redist": 2000000, "mean": 3000000, "shuffle": 2000000,
+    "faker": 5000, "faker_course": 10000, "faker_assignment": 15000, "faker_name": 4000,
+    "faker_user_name": 3500, "faker_file_name": 7000, "faker_date_time_on_date": 10000,
+    "faker_course_batch": 400000, "faker_assignment_batch": 1000000, "faker_date_time_on_date_batch": 3000000,
+}
+
+
+# One LEFT JOIN of a joined entry on a single column, the only kind its tables can be run one at a time for
+JOIN_RE = re.compile(r"\s*LEFT\s+(?:OUTER\s+)?JOIN\s+`?(\w+)`?\s+ON\s*\(?\s*`?(\w+)`?\.`?(\w+)`?\s*=\s*"
+                     r"`?(\w+)`?\.`?(\w+)`?\s*\)?\s*", re.IGNORECASE)
+
+
+class ColumnPlan(NamedTuple):
+    """A column from config.json and the kernel that transforms it (None if it's passed through)"""
+    name: str
+    module: str
+    method: str
+    index: str
+    source: str
+    kernel: str
+    config: MappingProxyType
+
+    def as_dict(self) -> dict:
+        return dict(self.config)
+
+
+class TablePlan(NamedTuple):
+    """Everything needed to run a config.json entry, worked out once before the run starts"""
+    table: str
+    sql: str
+    columns: Tuple[ColumnPlan, ...]
+    group_cols: Tuple[str, ...]
+    key_cols: Tuple[str, ...]
+    # Watermark and key column, or None
+    watermark: Tuple[str, str]
+    # Database tables read and written back, with the config.json column names of each
+    db_tables: MappingProxyType
+    # Plans to run the tables of a joined entry one at a time, in the order to run them, empty if it has to run joined
+    members: Tuple["TablePlan", ...] = ()
+    # Columns of the first table of a joined entry that one of its other tables is grouped by, they aren't written
+    lookups: Tuple[str, ...] = ()
+
+    def t_config(self) -> List[dict]:
+        """Column configurations for the transforms, a new copy each time so the plan can't be changed"""
+        return [col.as_dict() for col in self.columns]
+
+
+def build_table_query(table: str, t_config):
+    """Build the select statement and column configuration for a table entry in config.json
+
+    :param table: Key of the table in config.json, may use the joined table syntax
+    :param t_config: Value of the table in config.json
+    :return: Tuple of the sql, the list of column configurations and the columns the rows have to be grouped by
+    """
+    if "|" in table:
+        # There's a special syntax for joined tables!
+        # Figure out the tables to join and run a special query on them
+        join_tables = t_config.get("tables")
+        # Go through each table building up the query string
+        tmp_cols = []
+        col_config = []
+        for join_table in join_tables:
+            join_table_name = join_table.get("name")
+            for join_col in join_table.get("cols"):
+                # Create a new alias for the column
+                join_alias = f"{join_table_name}.{join_col.get('name')}"
+                tmp_cols.append(f"{join_table_name}.{join_col.get('name')} AS `{join_alias}`")
+                col_config.append(dict(join_col, name=join_alias))
+        db_cols = ",".join(tmp_cols)
+        # Get the name of the first table
+        db_table = join_tables[0].get("name")
+        sql = f"SELECT {db_cols} FROM {db_table} {t_config.get('join')}"
+    else:
+        col_config = list(t_config)
+        sql = f"SELECT * from {table}"
+
+    # Group based transforms need all of the rows of a group together
+    group_cols = []
+    for col in col_config:
+        index_name = col.get("index")
+        if index_name and index_name not in group_cols:
+            group_cols.append(index_name)
+    if "|" in table:
+        # The rows of the first table are deduplicated on write, so keep those together too
+        first_table, first_key = (table.split("|")[0].split("@") + [None] * 2)[:2]
+        if first_key and f"{first_table}.{first_key}" not in group_cols:
+            group_cols.append(f"{first_table}.{first_key}")
+    return sql, col_config, group_cols
+
+
+_faker = None
+
+
+def _has_method(module: str, method: str) -> bool:
+    global _faker
+    if module == "faker":
+        if _faker is None:
+            _faker = Faker()
+            _faker.add_provider(CustomProvider)
+        return hasattr(_faker, method)
+    return hasattr(MODULE_TYPES[module], method)
+
+
+def _kernel(module: str, method: str) -> str:
+    if module == "faker":
+        return f"faker_{method}"
+    return module if module == "ffx" else method
+
+
+def _column_problems(table: str, col: dict, names: List[str]) -> List[str]:
+    """Everything wrong with a column's configuration"""
+    name, module, method = col.get("name"), col.get("module"), col.get("method")
+    if col.get("references") and len(str(col.get("references")).split(".")) != 2:
+        return [f"{table}.{name}: references should look like table.column"]
+    if not module:
+        return []
+    if module not in MODULE_TYPES and module != "faker":
+        return [f"{table}.{name}: unknown module {module}"]
+    if not method or not _has_method(module, method):
+        return [f"{table}.{name}: {module} has no method {method}"]
+    problems = []
+    if module == "util_methods":
+        if method not in TableTransformer.COLUMN_METHODS:
+            problems.append(f"{table}.{name}: util_methods.{method} can't be used as a column transform")
+        if INDEX_REQUIRED.get(method) and not col.get("index"):
+            problems.append(f"{table}.{name}: {method} needs an index column")
+        if method == "mean" and col.get("source") not in names:
+            problems.append(f"{table}.{name}: mean source {col.get('source')} isn't a column of the table")
+        if col.get("index") and col.get("index") not in names:
+            problems.append(f"{table}.{name}: index {col.get('index')} isn't a column of the table")
+    elif module == "ffx" and (module, method) not in TableTransformer.BATCH_METHODS:
+        problems.append(f"{table}.{name}: ffx.{method} isn't supported")
+    return problems
+
+
+def _column_plan(col: dict) -> ColumnPlan:
+    module, method = col.get("module"), col.get("method")
+    return ColumnPlan(col.get("name"), module, method, col.get("index"), col.get("source"),
+                      _kernel(module, method) if module else None, MappingProxyType(dict(col)))
+
+
+def compile_table(table: str, t_config) -> Tuple[TablePlan, List[str]]:
+    """Compile one config.json entry
+
+    :return: Tuple of the plan (None if it couldn't be built) and the problems found with the entry
+    """
+    if "|" in table:
+        if not isinstance(t_config, dict) or not t_config.get("join") or not t_config.get("tables"):
+            return None, [f"{table}: joined entries need a join and a list of tables"]
+        db_tables = {join_table.get("name"): [col.get("name") for col in join_table.get("cols", [])]
+                     for join_table in t_config.get("tables")}
+        if set(db_tables) != {name.split("@")[0] for name in table.split("|")}:
+            return None, [f"{table}: the tables don't match the name of the entry"]
+    elif not isinstance(t_config, list):
+        return None, [f"{table}: expected a list of columns"]
+    else:
+        db_tables = {table: [col.get("name") for col in t_config]}
+    if any(not name for names in db_tables.values() for name in names):
+        return None, [f"{table}: every column needs a name"]
+
+    sql, col_config, group_cols = build_table_query(table, t_config)
+    names = [col.get("name") for col in col_config]
+    problems = [f"{table}: {name} is in the config more than once" for name in set(names) if names.count(name) > 1]
+    columns = []
+    for col in col_config:
+        problems += _column_problems(table, col, names)
+        columns.append(_column_plan(col))
+    try:
+        watermark_cols = watermark.table_columns(table, col_config)
+    except ValueError as e:
+        problems.append(str(e))
+        watermark_cols = None
+    table_plan = TablePlan(table, sql, tuple(columns), tuple(group_cols),
+                           tuple(util_methods.key_columns(table, col_config)), watermark_cols,
+                           MappingProxyType({name: tuple(cols) for name, cols in db_tables.items()}))
+    if "|" in table and not problems:
+        table_plan = table_plan._replace(members=compile_members(table, t_config))
+    return table_plan, problems
+
+
+def join_keys(first_table: str, join: str) -> Dict[str, Tuple[str, str]]:
+    """Columns a joined entry's join clause joins each table on
+
+    :param first_table: Name of the first table of the entry, the one the others are joined to
+    :param join: The join clause from config.json
+    :return: Dictionary of each joined table to its column and the column of the first table it's joined on,
+             None if the clause isn't only LEFT JOINs on one column of the first table
+    """
+    keys, pos = {}, 0
+    while pos < len(join):
+        match = JOIN_RE.match(join, pos)
+        if not match:
+            return None
+        table_name, left_table, left_col, right_table, right_col = match.groups()
+        sides = {left_table: left_col, right_table: right_col}
+        if len(sides) != 2 or set(sides) != {table_name, first_table}:
+            return None
+        keys[table_name] = (sides[table_name], sides[first_table])
+        pos = match.end()
+    return keys or None
+
+
+def compile_members(table: str, t_config: dict) -> Tuple[TablePlan, ...]:
+    """Plans to run the tables of a joined entry one at a time instead of as one joined frame
+
+    A LEFT JOIN on the key of the first table reads every row of it and the rows of the other tables joined
+    to one of them. The other tables run first, each joined to the first table while it still has its original
+    rows, which also reads the columns of the first table their transforms use as an index. The first table
+    runs last. Those columns can only be passed through or encrypted with ffx, so they have the same groups
+    as the values the joined frame would have. The columns are named as in the database.
+
+    :param table: Key of the entry in config.json
+    :param t_config: Value of the entry in config.json
+    :return: Plan of each table in the order to run them, empty if the entry has to be run joined
+    """
+    join_tables = t_config.get("tables")
+    first_table = join_tables[0].get("name")
+    specs = dict((spec.split("@") + [None])[:2] for spec in table.split("|"))
+    keys = join_keys(first_table, t_config.get("join") or "")
+    if keys is None or set(keys) != {join_table.get("name") for join_table in join_tables[1:]}:
+        return ()
+    if any(parent_col != specs[first_table] for _, parent_col in keys.values()):
+        return ()
+    first_cols = {col.get("name"): col for col in join_tables[0].get("cols")}
+    members = []
+    for join_table in join_tables[1:] + join_tables[:1]:
+        table_name = join_table.get("name")
+        own_names = [col.get("name") for col in join_table.get("cols")]
+        # Aliased so the rows can be ordered by them, and by the columns of the first table, by name
+        selects = [f"{table_name}.{name} AS `{name}`" for name in own_names]
+        col_config, lookups = [], []
+        for join_col in join_table.get("cols"):
+            col = dict(join_col)
+            for ref in ("index", "source"):
+                if not col.get(ref):
+                    continue
+                ref_table, _, ref_name = col[ref].partition(".")
+                if ref_table == table_name:
+                    col[ref] = ref_name
+                    continue
+                ref_col = first_cols.get(ref_name, {}) if ref_table == first_table else {}
+                if ref != "index" or not ref_col or ref_col.get("module") not in (None, "ffx"):
+                    return ()
+                if col[ref] not in lookups:
+                    lookups.append(col[ref])
+                    selects.append(f"{col[ref]} AS `{col[ref]}`")
+            col_config.append(col)
+        sql = f"SELECT {','.join(selects)} FROM {table_name}"
+        if table_name != first_table:
+            column, parent_col = keys[table_name]
+            sql += f" JOIN {first_table} ON ({first_table}.{parent_col} = {table_name}.{column})"
+        group_cols = list(dict.fromkeys(col.get("index") for col in col_config if col.get("index")))
+        key_cols = [specs[table_name]] if specs[table_name] else util_methods.key_columns(table_name, col_config)
+        spec = f"{table_name}@{specs[table_name]}" if specs[table_name] else table_name
+        members.append(TablePlan(spec, sql, tuple(_column_plan(col) for col in col_config), tuple(group_cols),
+                                 tuple(key_cols), None, MappingProxyType({table_name: tuple(own_names)}),
+                                 lookups=tuple(lookups)))
+    return tuple(members)
+
+
+def compile_config(db_config: dict, tables: List[str] = None) -> Dict[str, TablePlan]:
+    """Compile every entry of config.json, raising a ValueError with all of the problems found
+
+    :param db_config: The contents of config.json
+    :param tables: Keys of the tables that will be run, they have to be in config.json
+    :return: Read only dictionary of the key of every entry to its plan, in config order
+    """
+    plans, problems = {}, []
+    for table, t_config in db_config.items():
+        table_plan, table_problems = compile_table(table, t_config)
+        problems += table_problems
+        if table_plan:
+            plans[table] = table_plan
+    problems += [f"{table} isn't in config.json" for table in tables or [] if table not in db_config]
+    if problems:
+        raise ValueError("Problems with config.json:\n" + "\n".join(problems))
+    return MappingProxyType(plans)
+
+
+def validate_schema(plans: Dict[str, TablePlan], engine, tables: List[str] = None):
+    """Check that the tables and columns of the plans exist in the database, raising a ValueError if any don't
+
+    :param plans: Plans from compile_config
+    :param engine: SQLAlchemy engine
+    :param tables: Keys of the tables that will be run, defaults to all of them
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing = set(inspector.get_table_names())
+    problems = []
+    for table in tables or list(plans):
+        for table_name, names in plans[table].db_tables.items():
+            if table_name not in existing:
+                problems.append(f"{table}: table {table_name} doesn't exist")
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table_name)}
+            problems += [f"{table}: column {table_name}.{name} doesn't exist" for name in names if name not in columns]
+    if problems:
+        raise ValueError("config.json doesn't match the database:\n" + "\n".join(problems))
+
+
+def load_rates(path: str = None) -> dict:
+    """Rows/sec of each kernel, from a benchmark suite results file if there is one
+
+    :param path: JSON saved by python -m benchmarks.suite --output
+    """
+    rates = dict(DEFAULT_RATES)
+    if not path:
+        return rates
+    with open(path) as json_data:
+        results = json.load(json_data)
+    rates.update({name: values["rows_per_sec"] for name, values in results.get("transforms", {}).items()
+                  if values.get("rows_per_sec")})
+    tables = results.get("tables", {}).values()
+    for phase in ("read", "write"):
+        rows = sum(entry["rows"] for entry in tables)
+        seconds = sum(entry["phases"][phase]["seconds"] for entry in tables)
+        if rows and seconds:
+            rates[phase] = rows / seconds
+    return rates
+
+
+def estimate_rows(engine, table_names: List[str]) -> Dict[str, int]:
+    """Number of rows of each database table, from the statistics in information_schema on MySQL
+    (fast but approximate for InnoDB) and by counting them anywhere else
+    """
+    if engine.dialect.name == "mysql":
+        query = sqlalchemy.text("SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES "
+                                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN :names")
+        query = query.bindparams(sqlalchemy.bindparam("names", expanding=True))
+        with engine.connect() as conn:
+            counts = {name: int(rows or 0) for name, rows in conn.execute(query, {"names": list(table_names)})}
+        return {name: counts.get(name, 0) for name in table_names}
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect() as conn:
+        return {name: conn.execute(sqlalchemy.text(f"SELECT COUNT(*) FROM {quote(name)}")).scalar()
+                for name in table_names}
+
+
+def explain(plans: Dict[str, TablePlan], engine, tables: List[str] = None, rates: dict = None,
+            chunk_size: int = 0, faker_batch: bool = False, normalized_joins: bool = False) -> List[dict]:
+    """Estimate the rows, kernels and time of every table of a run
+
+    A joined entry is estimated at the rows of its largest table, or of all of its tables when they run one
+    at a time. The time is the sum of reading, every
+    column's kernel and writing the rows at the given rates, without any WORKERS or TABLE_CONCURRENCY.
+
+    :param plans: Plans from compile_config
+    :param engine: SQLAlchemy engine
+    :param tables: Keys of the tables that will be run, defaults to all of them
+    :param rates: Rows/sec of each kernel, from load_rates
+    :param chunk_size: CHUNK_SIZE of the run
+    :param faker_batch: FAKER_BATCH of the run
+    :param normalized_joins: NORMALIZED_JOINS of the run
+    :return: List of a dictionary for each table
+    """
+    rates = rates or DEFAULT_RATES
+    tables = tables or list(plans)
+    rows = estimate_rows(engine, sorted({name for table in tables for name in plans[table].db_tables}))
+    explained = []
+    for table in tables:
+        table_plan = plans[table]
+        members = table_plan.members if normalized_joins else ()
+        if members:
+            table_rows = sum(rows[name] for name in table_plan.db_tables)
+        else:
+            table_rows = max(rows[name] for name in table_plan.db_tables)
+        types = util_methods.column_types(engine, table, table_plan.t_config())
+        kernels = {}
+        for col in table_plan.columns:
+            if col.kernel == "ffx":
+                kernels[col.name] = "ffx_int" if types.get(col.name) in ("int", "float") else "ffx_string"
+            elif faker_batch and col.module == "faker" and col.method in TableTransformer.FAKER_BATCH_METHODS:
+                kernels[col.name] = col.kernel + "_batch"
+            elif col.kernel:
+                kernels[col.name] = col.kernel
+        seconds = {"read": table_rows / rates["read"], "write": table_rows / rates["write"],
+                   "transform": sum(table_rows / rates.get(kernel, rates["faker"]) for kernel in kernels.values())}
+        sql = "; ".join(member.sql for member in members) if members else table_plan.sql
+        explained.append({"table": table, "sql": sql, "rows": table_rows,
+                          "chunks": math.ceil(table_rows / chunk_size) if chunk_size else 1,
+                          "kernels": kernels, "seconds": seconds, "total_seconds": sum(seconds.values())})
+    return explained
+
+
+def format_explain(explained: List[dict]) -> str:
+    """Text report of explain"""
+    lines = []
+    for entry in explained:
+        lines.append(entry["table"])
+        lines.append(f"  sql:     {entry['sql']}")
+        lines.append(f"  rows:    ~{entry['rows']} in {entry['chunks']} chunk(s)")
+        kernels = ", ".join(f"{name}={kernel}" for name, kernel in entry["kernels"].items())
+        lines.append(f"  kernels: {kernels or 'none, copied as is'}")
+        seconds = entry["seconds"]
+        lines.append(f"  cost:    ~{entry['total_seconds']:.1f}s (read {seconds['read']:.1f}s, "
+                     f"transform {seconds['transform']:.1f}s, write {seconds['write']:.1f}s)")
+    total_rows = sum(entry["rows"] for entry in explained)
+    total = sum(entry["total_seconds"] for entry in explained)
+    lines.append(f"Total: ~{total_rows} rows, ~{total:.1f}s")
+    return "\n".join(lines)
@@ -0,0 +1,79 @@
+# Runs the tables from config.json concurrently when they don't touch the same database tables
+import logging, re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Set
+
+logger = logging.getLogger()
+
+# Table names referenced in a join clause
+JOIN_RE = re.compile(r"\bJOIN\s+`?(\w+)`?", re.IGNORECASE)
+
+
+def table_resources(table: str, t_config) -> Set[str]:
+    """Database tables a config.json entry reads or writes back
+
+    :param table: Key of the table in config.json, like resource or assignment@id|submission@id
+    :param t_config: Value of the table in config.json
+    """
+    resources = {name.split("@")[0] for name in table.split("|")}
+    if isinstance(t_config, dict):
+        resources.update(join_table.get("name") for join_table in t_config.get("tables", []))
+        resources.update(JOIN_RE.findall(t_config.get("join", "")))
+    return resources
+
+
+def build_graph(tables: List[str], db_config: dict) -> Dict[str, Set[str]]:
+    """Build the dependencies between the tables of a run
+
+    A table depends on every table before it in the list that touches one of the same database tables,
+    so they run in config order and never at the same time. Everything else is independent.
+
+    :param tables: Keys of the tables to run in config.json, in order
+    :param db_config: The contents of config.json
+    :return: Dictionary of each table to the set of tables that have to finish first
+    """
+    resources = {table: table_resources(table, db_config.get(table)) for table in tables}
+    depends_on = {}
+    for i, table in enumerate(tables):
+        depends_on[table] = {earlier for earlier in tables[:i] if resources[earlier] & resources[table]}
+    return depends_on
+
+
+def run_tables(tables: List[str], depends_on: Dict[str, Set[str]], func: Callable[[str], None], concurrency: int = 1):
+    """Call func for every table, running up to concurrency of them at a time once their dependencies are done
+
+    If a table fails no new tables are started, the running ones are waited for and the first error is raised.
+
+    :param tables: Tables in the order they should be started
+    :param depends_on: Dependencies from build_graph
+    :param func: Called with the name of each table
+    :param concurrency: Maximum number of tables running at once
+    """
+    pending = list(tables)
+    done = set()
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        while running or (pending and error is None):
+            if error is None:
+                for table in list(pending):
+                    if len(running) >= concurrency:
+                        break
+                    if depends_on.get(table, set()) <= done:
+                        logger.info(f"Starting {table}")
+                        running[executor.submit(func, table)] = table
+                        pending.remove(table)
+            if not running:
+                raise ValueError(f"Tables {pending} depend on each other")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                try:
+                    future.result()
+                    done.add(table)
+                    logger.info(f"Finished {table}")
+                except Exception as e:
+                    logger.exception(f"Error processing {table}")
+                    error = error or e
+    if error is not None:
+        raise error
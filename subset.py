@@ -0,0 +1,133 @@
+# Narrows a run down to a few courses and the rows related to them,
+# for small snapshots that still satisfy the foreign keys
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+
+import sqlalchemy
+
+logger = logging.getLogger()
+
+# Every subset starts from rows of this table
+ROOT_TABLE, ROOT_KEY = "course", "id"
+# Tables with this column are filtered on it directly
+ROOT_COLUMN = "course_id"
+
+
+class SubsetFilter(NamedTuple):
+    """Keeps the rows of a table whose column is one of the values"""
+    column: str
+    values: Tuple
+
+    def condition(self, param: str = "subset") -> Tuple[str, dict]:
+        """SQL condition and bound parameters for the WHERE clause, the values are an expanding IN parameter"""
+        return f"{self.column} IN :{param}", {param: list(self.values)}
+
+
+def _select(engine, sql: str, params: dict = None) -> List:
+    query = sqlalchemy.text(sql)
+    for name, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            query = query.bindparams(sqlalchemy.bindparam(name, expanding=True))
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(query, params or {})]
+
+
+def select_courses(engine, course_ids: List = None, count: int = 0, term=None) -> List:
+    """Ids of the courses a subset starts from
+
+    :param engine: SQLAlchemy engine
+    :param course_ids: Specific course ids
+    :param count: Take this many courses, the ones with the lowest ids so it's the same every time
+    :param term: Take every course of this term_id
+    :return: List of the course ids, from any of the selections
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    courses = list(course_ids or [])
+    if term is not None:
+        courses += _select(engine, f"SELECT {quote(ROOT_KEY)} FROM {quote(ROOT_TABLE)} WHERE term_id = :term",
+                           {"term": term})
+    if count:
+        courses += _select(engine, f"SELECT {quote(ROOT_KEY)} FROM {quote(ROOT_TABLE)} "
+                                   f"ORDER BY {quote(ROOT_KEY)} LIMIT {int(count)}")
+    return list(dict.fromkeys(courses))
+
+
+def references(plans: dict) -> Dict[str, List[Tuple[str, str, str]]]:
+    """Foreign keys implied by config.json
+
+    A column marked "references": "table.column" points at that column, and any other column named
+    <table>_id points at the <table>_id column of that table if it has one, otherwise at its id.
+
+    :param plans: Plans from plan.compile_config
+    :return: Dictionary of each database table to a list of its (column, table, column) references
+    """
+    db_tables = {}
+    for table_plan in plans.values():
+        for table_name, names in table_plan.db_tables.items():
+            db_tables.setdefault(table_name, set()).update(names)
+    refs = {table_name: [] for table_name in db_tables}
+    for table_plan in plans.values():
+        for col in table_plan.columns:
+            table_name, name = col.name.split(".") if "|" in table_plan.table else (table_plan.table, col.name)
+            target = col.config.get("references")
+            if target:
+                refs[table_name].append((name, *target.split(".")))
+            elif name.endswith("_id") and name[:-3] in db_tables and name[:-3] != table_name:
+                target_table = name[:-3]
+                refs[table_name].append((name, target_table, name if name in db_tables[target_table] else "id"))
+    return {table_name: list(dict.fromkeys(table_refs)) for table_name, table_refs in refs.items()}
+
+
+def build_filters(plans: dict, engine, courses: List, tables: List[str] = None) -> Dict[str, SubsetFilter]:
+    """Filters that keep only the rows related to the courses
+
+    The course table is filtered by its id and every table with a course_id column by that. Tables without one
+    keep the rows that a table already filtered points at, like the resources of the selected courses'
+    resource_access rows or the terms of the courses. The values are all looked up now, before any table is
+    written back, so it doesn't matter which order the tables run in. Joined entries are filtered on their
+    first table and keep the rows of the other tables joined to them.
+
+    :param plans: Plans from plan.compile_config
+    :param engine: SQLAlchemy engine
+    :param courses: Course ids from select_courses
+    :param tables: Keys of the tables that will be run, defaults to all of them
+    :return: Dictionary of each table key to its filter, tables that aren't related to the courses aren't in it
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    refs = references(plans)
+    # Filter on the first database table of every entry, by that table's own column name
+    own = {}
+    first_tables = {}
+    for table, table_plan in plans.items():
+        first_table = list(table_plan.db_tables)[0]
+        first_tables[table] = first_table
+        if first_table == ROOT_TABLE:
+            own[first_table] = (ROOT_KEY, tuple(courses))
+        elif ROOT_COLUMN in table_plan.db_tables[first_table]:
+            own[first_table] = (ROOT_COLUMN, tuple(courses))
+    # Follow the references from the filtered tables to the ones that aren't
+    changed = True
+    while changed:
+        changed = False
+        for table_name, table_refs in refs.items():
+            if table_name not in own:
+                continue
+            column, values = own[table_name]
+            for name, target_table, target_column in table_refs:
+                if target_table in own or target_table not in first_tables.values():
+                    continue
+                found = _select(engine, f"SELECT DISTINCT {quote(name)} FROM {quote(table_name)} "
+                                        f"WHERE {quote(column)} IN :values", {"values": list(values)})
+                own[target_table] = (target_column, tuple(value for value in found if value is not None))
+                logger.info(f"Subset of {target_table} by {table_name}.{name}: {len(own[target_table])} keys")
+                changed = True
+    filters = {}
+    for table in tables or list(plans):
+        first_table = first_tables[table]
+        if first_table not in own:
+            logger.warning(f"{table} isn't related to the courses, all of its rows are kept")
+            continue
+        column, values = own[first_table]
+        qualified = f"{first_table}.{column}" if "|" in table else quote(column)
+        filters[table] = SubsetFilter(qualified, values)
+    return filters
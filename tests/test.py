@@ -7,12 +7,29 @@ this_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, this_dir + "/..")
 
 from ffx_helper import FFXEncrypt
+from id_mapping import IdMappingStore
+from watermark import WatermarkState
+import watermark
+from journal import RunJournal
+from export import SnapshotExport
+import export
+import plan
+import subset
+from metrics import RunMetrics
+import pipeline
+from benchmarks import synthetic
+from transform_engine import TableTransformer
+from parallel import TransformPool
+import scheduler
+import sqlalchemy
 from custom_provider import CustomProvider
 import util_methods
+from util_methods import TableLoader
 import pandas as pd
 import numpy as np
 
-import datetime
+import copy, datetime, functools, json, string, tempfile, threading, time
+from unittest import mock
 
 from faker import Faker
 
@@ -64,6 +81,76 @@ class TestAnonymizer(unittest.TestCase):
         self.assertEqual(self.ffx.encrypt('test@example.com'), 'cafw@uegmpnf.vxj')
         self.assertEqual(self.ffx.encrypt('test@@@@gmail.colll099m'), 'cafw@@@@nyzav.ddzvu628k')
         self.assertEqual(self.ffx.encrypt('123abc.456.bda123'), '680hzc.605.qfu680')
+
+    def test_ffx_cache(self):
+        ffx = FFXEncrypt("passwordpassword", cache_size=3)
+        self.assertEqual(ffx.encrypt(995), 643)
+        self.assertEqual(ffx.encrypt(995), 643)
+        self.assertEqual(ffx.cache_info()["hits"], 1)
+        # Tokens are remembered separately from the whole values
+        self.assertEqual(ffx.encrypt("test@example.com"), "cafw@uegmpnf.vxj")
+        self.assertEqual(ffx.encrypt("ABC"), "HZC")
+        self.assertEqual(ffx.cache_info()["size"], 3)
+        # The oldest entries were evicted but still give the same result
+        self.assertEqual(ffx.encrypt(995), 643)
+        self.assertEqual(ffx.encrypt("test@example.com"), "cafw@uegmpnf.vxj")
+        # Cipher objects are shared for the same length
+        self.assertIs(ffx.cipher("int", string.digits, 3), ffx.cipher("int", string.digits, 3))
+        uncached = FFXEncrypt("passwordpassword", cache_size=0)
+        self.assertEqual(uncached.encrypt(995), 643)
+        self.assertEqual(uncached.cache_info()["size"], 0)
+
+    def test_ffx_int_array(self):
+        self.assertEqual(list(self.ffx.encrypt_int_array(np.array([995, 995]))), [643, 643])
+        vals = np.array([1, 9, 10, 456, 995, 123456, 123995, 98765432101, 10 ** 17 + 3, 0, -42], dtype=np.int64)
+        for addition in (sys.maxsize, 123000):
+            expected = [int(self.ffx.encrypt(val, addition=addition)) for val in vals]
+            self.assertEqual(list(self.ffx.encrypt_int_array(vals, addition=addition)), expected)
+        # 19 digit numbers and additions that would overflow an int64 give the same results too
+        vals = np.array([10 ** 18 - 1] + list(range(10 ** 18, 10 ** 18 + 50)) + [9 * 10 ** 18 + 7], dtype=np.int64)
+        for addition in (sys.maxsize, 123000, 9 * 10 ** 18):
+            expected = [int(self.ffx.encrypt(int(val), addition=addition)) for val in vals]
+            self.assertEqual([int(val) for val in self.ffx.encrypt_int_array(vals, addition=addition)], expected)
+
+    def test_id_mapping(self):
+        encrypted = []
+
+        def encrypt(vals):
+            encrypted.extend(vals)
+            return self.ffx.encrypt_int_array(vals, addition=0)
+        enc17, enc23 = int(self.ffx.encrypt(17, addition=0)), int(self.ffx.encrypt(23, addition=0))
+        with tempfile.TemporaryDirectory() as path:
+            store = IdMappingStore("passwordpassword", 0, path=path)
+            self.assertEqual(list(store.lookup(np.array([995, 17, 995]), encrypt)), [643, enc17, 643])
+            self.assertEqual(list(store.lookup(np.array([17, 23]), encrypt)), [enc17, enc23])
+            # Each id is only encrypted once
+            self.assertEqual(sorted(encrypted), [17, 23, 995])
+            store.save()
+            self.assertNotIn("passwordpassword", open(os.path.join(path, store.META_FILE)).read())
+
+            # A new run picks the mapping back up
+            store = IdMappingStore("passwordpassword", 0, path=path)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(list(store.lookup(np.array([23, 995]), encrypt)), [enc23, 643])
+            self.assertEqual(len(encrypted), 3)
+            # but not with a different secret or addition
+            self.assertEqual(len(IdMappingStore("otherpassword", 0, path=path)), 0)
+            self.assertEqual(len(IdMappingStore("passwordpassword", 1000, path=path)), 0)
+
+        # Tables share the store
+        store = IdMappingStore("passwordpassword", 0)
+        t_config = [{"name": "id", "module": "ffx", "method": "encrypt"}]
+        df = pd.DataFrame({"id": [17.0, np.nan, 995.0, 1.5]})
+        TableTransformer(t_config, {"ffx": self.ffx}, addition=0, id_store=store).apply(df)
+        self.assertEqual(df["id"].tolist()[0::2], [float(enc17), 643.0])
+        self.assertTrue(np.isnan(df["id"][1]))
+        self.assertEqual(df["id"][3], self.ffx.encrypt(1.5, addition=0))
+        df = pd.DataFrame({"user_id": [995, 17]})
+        TableTransformer([{"name": "user_id", "module": "ffx", "method": "encrypt"}], {"ffx": self.ffx},
+                         addition=0, id_store=store).apply(df)
+        self.assertEqual(df["user_id"].tolist(), [643, enc17])
+        self.assertEqual((store.hits, store.misses), (2, 2))
+
     def test_assignment_custom(self):
         self.faker.seed(util_methods.hash_string_to_int("testpasstestpass", 16))
         # pylint: disable=no-member
@@ -85,6 +172,39 @@ class TestAnonymizer(unittest.TestCase):
         self.assertEqual(self.faker.course(),"AUTO 296 006 FA 2073") #pylint: disable=no-member
         self.assertEqual(self.faker.course(), "AUTO 273 007 SP 2026") #pylint: disable=no-member
 
+    def test_faker_batch(self):
+        rows = np.arange(1000)
+        courses = self.faker.course_batch(rows, 42)
+        self.assertTrue(pd.Series(courses).str.fullmatch(r"[A-Z]+ [1-9]\d\d 00[1-9] (SP|SU|WN|FA) 20[1-9]\d").all())
+        assignments = pd.Series(self.faker.assignment_batch(rows, 42))
+        self.assertTrue(assignments.str.fullmatch(r"[A-Za-z]+ Assignment #\d+").all())
+        # Each value only depends on the seed and its row
+        self.assertEqual(list(self.faker.course_batch(rows[500:], 42)), list(courses[500:]))
+        self.assertNotEqual(list(self.faker.course_batch(rows, 43)), list(courses))
+        self.assertGreater(len(set(courses)), 900)
+
+        dates = [datetime.datetime(2019, 1, 1, 1, 1, 1), "2019-05-01 13:14:15", None, "not a date"]
+        moved = self.faker.date_time_on_date_batch(dates, np.arange(4), 42)
+        self.assertEqual([moved[0].date(), moved[1].date()], [datetime.date(2019, 1, 1), datetime.date(2019, 5, 1)])
+        self.assertNotEqual(moved[0], pd.Timestamp(dates[0]))
+        self.assertEqual(list(moved[2:]), [None, "not a date"])
+        column = pd.Series(pd.date_range("2019-01-01", periods=1000, freq="7h"))
+        moved = pd.Series(self.faker.date_time_on_date_batch(column, rows, 42))
+        self.assertTrue((moved.dt.date == column.dt.date).all())
+        self.assertGreater(moved.dt.hour.nunique(), 20)
+
+        # Chunks give the same values as the whole table
+        t_config = [{"name": "name", "module": "faker", "method": "assignment"},
+                    {"name": "due_date", "module": "faker", "method": "date_time_on_date"}]
+        df = pd.DataFrame({"name": ["a"] * 1000, "due_date": column})
+        whole = df.copy()
+        TableTransformer(t_config, {"faker": self.faker}, seed_prefix="t", faker_batch=True, faker_seed=1).apply(whole)
+        transformer = TableTransformer(t_config, {"faker": self.faker}, seed_prefix="t", faker_batch=True, faker_seed=1)
+        first, second = df.iloc[:300].reset_index(drop=True), df.iloc[300:].reset_index(drop=True)
+        transformer.apply(first)
+        transformer.apply(second)
+        pd.testing.assert_frame_equal(pd.concat([first, second], ignore_index=True), whole)
+
     def test_resample(self):
         # These will always be different values returnsd, just verify that the length is the same and they are within the original range
         test_vals = [21, 129, 123, 94]
@@ -93,6 +213,60 @@ class TestAnonymizer(unittest.TestCase):
         self.assertTrue(min(test_vals) <= min(map_sample))
         self.assertTrue(max(test_vals) >= max(map_sample))
 
+    def test_group_index(self):
+        df = self.sampleAccessDF()
+        groups = util_methods.group_index(df, 'user_id')
+        # Computed once and shared
+        self.assertIs(util_methods.group_index(df, 'user_id'), groups)
+        self.assertEqual(list(groups.keys), ['user0', 'user1', 'user2'])
+        self.assertEqual(list(groups.sizes), [7, 7, 6])
+        self.assertEqual(list(groups.order[:7]), [0, 3, 6, 9, 12, 15, 18])
+        util_methods.clear_group_cache(df)
+        self.assertIsNot(util_methods.group_index(df, 'user_id'), groups)
+
+        df = pd.DataFrame({"assignment_id": [1, 1, 2, None], "score": [1.0, 3.0, np.nan, 4.0]})
+        util_methods.mean(df, "score", "avg_score", "assignment_id")
+        self.assertEqual(list(df["avg_score"][:3]), [2.0, 2.0, 0.0])
+        self.assertTrue(np.isnan(df.at[3, "avg_score"]))
+
+        # Tables running at the same time share the cache while their dataframes come and go
+        errors = []
+
+        def run():
+            try:
+                for _ in range(200):
+                    frame = self.sampleAccessDF()
+                    util_methods.group_index(frame, 'user_id')
+                    util_methods.clear_group_cache(frame)
+                    util_methods.group_index(frame, 'file_type')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # A dataframe is forgotten once it's gone
+        df_id = id(df)
+        self.assertIn(df_id, util_methods._finalized)
+        del df
+        self.assertNotIn(df_id, util_methods._finalized)
+
+    def test_redist(self):
+        np.random.seed(util_methods.hash_string_to_int("testpasstestpass", 8))
+        df = pd.DataFrame({"course_id": [1, 1, 1, 1, 2, 3, 3, None],
+                           "grade": [21, 129, 123, 94, 50, 7, 7, 60]})
+        orig = df.copy()
+        util_methods.redist(df, "grade", "course_id")
+        # Every group stays within its own range
+        course1 = df["grade"][:4]
+        self.assertTrue(course1.min() >= 21 and course1.max() <= 129)
+        # Groups gaussian_kde can't handle (one value, no variance) are left alone
+        self.assertEqual(list(df["grade"][4:7]), list(orig["grade"][4:7]))
+        # Rows without an index aren't in any group
+        self.assertTrue(np.isnan(df.at[7, "grade"]))
+
     def test_shuffle(self):
         df = self.sampleAccessDF()
         # Seed the randomizer so it's predictable for test
@@ -107,9 +281,646 @@ class TestAnonymizer(unittest.TestCase):
         # Verify the same grouping before and after for a value with time 45 minutes
         self.assertEqual(df.at[9, 'user_id'], 'user0')
         self.assertEqual(df.at[9, 'access_time'], pd.Timestamp('2018-01-01 00:45:00'))
+        self.assertEqual(df.at[0, 'access_time'], pd.Timestamp('2018-01-01 00:00:00'))
         util_methods.shuffle(df, shuffle_col='access_time', index_col='user_id')
-        self.assertEqual(df.at[15, 'access_time'], pd.Timestamp('2018-01-01 00:45:00'))
-        self.assertEqual(df.at[15, 'user_id'], 'user0')
-        
+        # The groups are shuffled together with one draw of random keys, so the same seed moves different rows
+        # than shuffling each group on its own did. 45 minutes happens to stay put, the first access moves
+        self.assertEqual(df.at[9, 'access_time'], pd.Timestamp('2018-01-01 00:45:00'))
+        self.assertEqual(df.at[6, 'access_time'], pd.Timestamp('2018-01-01 00:00:00'))
+        self.assertEqual(df.at[0, 'access_time'], pd.Timestamp('2018-01-01 01:15:00'))
+        self.assertEqual(df.at[6, 'user_id'], 'user0')
+        # Every user keeps their own access times, just in a different order
+        orig = self.sampleAccessDF()
+        self.assertFalse(df['access_time'].equals(orig['access_time']))
+        for user_id, times in df.groupby('user_id')['access_time']:
+            self.assertEqual(sorted(times), sorted(orig[orig['user_id'] == user_id]['access_time']))
+
+    def test_group_aligned_chunks(self):
+        df = pd.DataFrame({'course_id': [1, 1, 1, 2, 2, 3, 3, 3, 3, 4], 'grade': range(10)})
+        # Split it up like a streamed read would
+        chunks = [df.iloc[i:i + 3] for i in range(0, len(df), 3)]
+        aligned = list(util_methods.group_aligned_chunks(chunks, 'course_id'))
+        # No rows are lost and no group spans more than one chunk
+        self.assertEqual(sum(len(chunk) for chunk in aligned), len(df))
+        seen = set()
+        for chunk in aligned:
+            self.assertEqual(list(chunk.index), list(range(len(chunk))))
+            self.assertFalse(seen & set(chunk['course_id']))
+            seen |= set(chunk['course_id'])
+        # Without a group column the chunks are passed through
+        self.assertEqual(len(list(util_methods.group_aligned_chunks(chunks))), len(chunks))
+
+    def test_table_transformer(self):
+        t_config = [
+            {"name": "id", "module": "ffx", "method": "encrypt"},
+            {"name": "name", "module": "faker", "method": "assignment"},
+            {"name": "due_date", "module": "faker", "method": "date_time_on_date"},
+            {"name": "score", "module": "ffx", "method": "encrypt"},
+            {"name": "course", "module": "faker", "method": "course"},
+            {"name": "note", "module": None},
+        ]
+        df = pd.DataFrame({
+            "id": [17, 23, 17, 995, 23],
+            "name": ["a", "b", "c", "d", "e"],
+            "due_date": [datetime.datetime(2019, 1, 1, 1, 1, 1), datetime.datetime(2019, 1, 2), pd.NaT,
+                         datetime.datetime(2019, 1, 1, 1, 1, 1), datetime.datetime(2019, 3, 5, 7, 8)],
+            "score": [1.0, np.nan, 12.5, 3.0, 1.0],
+            "course": ["x"] * 5,
+            "note": ["keep"] * 5,
+        })
+        # The old cell by cell loop is the reference
+        expected = df.copy().astype(object)
+        self.faker.seed(util_methods.hash_string_to_int("testpasstestpass", 16))
+        for row in range(len(df)):
+            for col in t_config:
+                if col["module"] == "ffx":
+                    expected.at[row, col["name"]] = self.ffx.encrypt(df.at[row, col["name"]], addition=0)
+                elif col["module"] == "faker" and col["method"] == "date_time_on_date":
+                    expected.at[row, col["name"]] = getattr(self.faker, col["method"])(df.at[row, col["name"]])
+                elif col["module"] == "faker":
+                    expected.at[row, col["name"]] = getattr(self.faker, col["method"])()
+
+        self.faker.seed(util_methods.hash_string_to_int("testpasstestpass", 16))
+        TableTransformer(t_config, {"ffx": self.ffx, "faker": self.faker}, addition=0).apply(df)
+        for col in df.columns:
+            self.assertEqual([None if pd.isna(v) else v for v in df[col]],
+                             [None if pd.isna(v) else v for v in expected[col]], col)
+
+    def test_transform_pool(self):
+        t_config = [
+            {"name": "id", "module": "ffx", "method": "encrypt"},
+            {"name": "name", "module": "faker", "method": "assignment"},
+            {"name": "due_date", "module": "faker", "method": "date_time_on_date"},
+        ]
+        df = pd.DataFrame({
+            "id": np.arange(1, 2501),
+            "name": ["a"] * 2500,
+            "due_date": [datetime.datetime(2019, 1, 1) + datetime.timedelta(hours=i) for i in range(2500)],
+        })
+        results = []
+        for workers in (1, 3):
+            pool = TransformPool(workers, "passwordpassword", 1000, 1234)
+            try:
+                out = df.copy()
+                transformer = TableTransformer(t_config, {"ffx": self.ffx, "faker": self.faker}, pool=pool,
+                                               seed_prefix="t")
+                # Also split the rows up like chunks would
+                first, second = out.iloc[:1000].reset_index(drop=True), out.iloc[1000:].reset_index(drop=True)
+                transformer.apply(first)
+                transformer.apply(second)
+                results.append(pd.concat([first, second], ignore_index=True))
+            finally:
+                pool.shutdown()
+        # The same whatever the number of workers
+        pd.testing.assert_frame_equal(results[0], results[1])
+        self.assertEqual(results[0].at[994, "id"], 643)
+        self.assertTrue((results[0]["due_date"].dt.date == df["due_date"].dt.date).all())
+
+    def test_scheduler(self):
+        db_config = {
+            "assignment@id|submission@id": {
+                "join": "LEFT JOIN submission on (assignment.id = submission.assignment_id)",
+                "tables": [{"name": "assignment", "cols": []}, {"name": "submission", "cols": []}]},
+            "submission": [], "course": [], "user": [], "assignment": [],
+        }
+        tables = list(db_config.keys())
+        depends_on = scheduler.build_graph(tables, db_config)
+        self.assertEqual(depends_on["submission"], {"assignment@id|submission@id"})
+        self.assertEqual(depends_on["assignment"], {"assignment@id|submission@id"})
+        self.assertEqual(depends_on["course"], set())
+
+        lock = threading.Lock()
+        running, order = set(), []
+
+        def work(table):
+            with lock:
+                # Tables that share a database table never run together
+                self.assertFalse(any(depends_on[table] & {other} for other in running))
+                running.add(table)
+            time.sleep(0.2)
+            with lock:
+                running.remove(table)
+                order.append(table)
+        start = time.time()
+        scheduler.run_tables(tables, depends_on, work, concurrency=3)
+        # Two rounds of tables instead of five
+        self.assertLess(time.time() - start, 0.7)
+        self.assertEqual(sorted(order), sorted(tables))
+        self.assertLess(order.index("assignment@id|submission@id"), order.index("submission"))
+
+        def fail(table):
+            if table == "course":
+                raise RuntimeError("lost connection")
+        with self.assertRaises(RuntimeError):
+            scheduler.run_tables(tables, depends_on, fail, concurrency=2)
+
+    @staticmethod
+    def sampleJoinDB():
+        """Create a SQLite stand in with an assignment and submission table"""
+        engine = sqlalchemy.create_engine("sqlite://")
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE assignment (id INTEGER PRIMARY KEY, name TEXT)"))
+            conn.execute(sqlalchemy.text("CREATE TABLE submission (id INTEGER PRIMARY KEY, assignment_id INTEGER, "
+                                         "score REAL)"))
+            conn.execute(sqlalchemy.text("INSERT INTO assignment VALUES (1, 'a'), (2, 'b')"))
+        return engine
+
+    def test_table_loader(self):
+        # Joined frame like the assignment|submission query gives, assignment 30 has no submissions
+        df = pd.DataFrame({"assignment.id": [10, 10, 20, 30], "assignment.name": ["x", "x", "y", "z"],
+                           "submission.id": [1, 2, 3, None], "submission.assignment_id": [10, 10, 20, None],
+                           "submission.score": [1.0, 2.0, 3.0, None]})
+        for strategy in ("delete", "staging"):
+            engine = self.sampleJoinDB()
+            loader = TableLoader("assignment@id|submission@id", engine, strategy=strategy, batch_size=1)
+            loader.write(df.iloc[:2])
+            if strategy == "staging":
+                # Nothing changes until the end
+                self.assertEqual(pd.read_sql("SELECT id FROM assignment", engine)["id"].tolist(), [1, 2])
+            loader.write(df.iloc[2:])
+            loader.finish()
+            self.assertEqual(pd.read_sql("SELECT id FROM assignment ORDER BY id", engine)["id"].tolist(), [10, 20, 30])
+            self.assertEqual(pd.read_sql("SELECT id FROM submission ORDER BY id", engine)["id"].tolist(), [1, 2, 3])
+            self.assertEqual(loader.rows, {"assignment": 3, "submission": 3})
+            tables = pd.read_sql("SELECT name FROM sqlite_master WHERE type = 'table'", engine)["name"].tolist()
+            self.assertEqual(sorted(tables), ["assignment", "submission"])
+
+        # A failed staging run leaves the table alone
+        engine = self.sampleJoinDB()
+        loader = TableLoader("assignment", engine, strategy="staging")
+        loader.write(pd.DataFrame({"id": [7], "name": ["q"]}))
+        loader.abort()
+        self.assertEqual(pd.read_sql("SELECT id FROM assignment", engine)["id"].tolist(), [1, 2])
+        util_methods.pandas_delete_and_insert("assignment", pd.DataFrame({"id": [7], "name": ["q"]}), engine)
+        self.assertEqual(pd.read_sql("SELECT id FROM assignment", engine)["id"].tolist(), [7])
+
+    def test_watermark(self):
+        t_config = [{"name": "id", "module": None, "watermark": True},
+                    {"name": "name", "module": "faker", "method": "name"}]
+        self.assertEqual(watermark.table_columns("assignment", t_config), ("id", "id"))
+        self.assertIsNone(watermark.table_columns("assignment@id|submission@id", {"tables": []}))
+        with self.assertRaises(ValueError):
+            watermark.table_columns("assignment",
+                                    [{"name": "id", "module": "ffx", "method": "encrypt", "watermark": True}])
+        self.assertEqual(watermark.max_value(pd.Series([3, 9, np.nan])), 9.0)
+        self.assertEqual(watermark.max_value(pd.Series(pd.to_datetime(["2019-01-02", "2019-01-01"]))),
+                         "2019-01-02 00:00:00")
+        with tempfile.TemporaryDirectory() as path:
+            state = WatermarkState(os.path.join(path, "watermarks.json"))
+            self.assertIsNone(state.get("assignment"))
+            state.set("assignment", 2)
+            self.assertEqual(WatermarkState(os.path.join(path, "watermarks.json")).get("assignment"), 2)
+
+        # Rows read past the watermark replace the rows they were read as and any earlier version of themselves
+        engine = self.sampleJoinDB()
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("INSERT INTO assignment VALUES (3, 'c'), (12, 'old')"))
+        loader = TableLoader("assignment", engine, strategy="upsert", key="id", batch_size=1)
+        loader.write(pd.DataFrame({"id": [11, 12], "name": ["b2", "c2"]}), keys=[2, 3])
+        loader.finish()
+        rows = pd.read_sql("SELECT id, name FROM assignment ORDER BY id", engine)
+        self.assertEqual(rows.values.tolist(), [[1, "a"], [11, "b2"], [12, "c2"]])
+        with self.assertRaises(ValueError):
+            TableLoader("assignment", engine, strategy="upsert")
+
+    def test_resume(self):
+        chunks = [pd.DataFrame({"id": range(start, start + 3)}) for start in (0, 3, 6)]
+        self.assertEqual([df["id"].tolist() for df in util_methods.skip_rows(chunks, 4)], [[4, 5], [6, 7, 8]])
+        self.assertEqual(util_methods.key_columns("assignment@id|submission@id",
+                                                  [{"name": "assignment.id"}, {"name": "submission.id"}]),
+                         ["assignment.id", "submission.id"])
+        self.assertEqual(util_methods.key_columns("course", [{"name": "id"}, {"name": "name"}]), ["id"])
+
+        with tempfile.TemporaryDirectory() as path:
+            journal = RunJournal(os.path.join(path, "journal.json"))
+            journal.start_table("assignment", "staging")
+            journal.chunk_written("assignment", 2)
+            journal = RunJournal(os.path.join(path, "journal.json"), resume=True)
+            self.assertEqual(journal.table("assignment"),
+                             {"strategy": "staging", "status": "running", "rows_read": 2, "chunks": 1})
+            self.assertIsNone(RunJournal(os.path.join(path, "journal.json")).table("assignment"))
+
+        # The run stopped after staging a chunk, but before recording it in the journal
+        engine = self.sampleJoinDB()
+        loader = TableLoader("assignment@id", engine, strategy="staging")
+        loader.write(pd.DataFrame({"id": [10, 20], "name": ["x", "y"]}))
+        loader.abort(keep_staging=True)
+        loader = TableLoader("assignment@id", engine, strategy="staging")
+        self.assertTrue(loader.resume())
+        loader.write(pd.DataFrame({"id": [10, 20], "name": ["x", "y"]}))
+        loader.write(pd.DataFrame({"id": [30], "name": ["z"]}))
+        loader.finish()
+        self.assertEqual(pd.read_sql("SELECT id FROM assignment ORDER BY id", engine)["id"].tolist(), [10, 20, 30])
+        self.assertFalse(loader.staged())
+
+        # A resumed table carries on from the row it stopped at, so its faker values are the ones a whole run gives
+        t_config = [{"name": "name", "module": "faker", "method": "assignment"}]
+        modules = {"faker": self.faker}
+        whole = pd.DataFrame({"name": ["x"] * 6})
+        TableTransformer(t_config, modules, faker_batch=True, faker_seed=5).apply(whole)
+        resumed = TableTransformer(t_config, modules, faker_batch=True, faker_seed=5)
+        resumed.rows_seen = 3
+        rest = pd.DataFrame({"name": ["x"] * 3})
+        resumed.apply(rest)
+        self.assertEqual(rest["name"].tolist(), whole["name"].tolist()[3:])
+
+        # A plain table keyed on id carries on from its last chunk too
+        import mylasqlanon
+        course_config = [{"name": "id"}, {"name": "name", "module": "ffx", "method": "encrypt"}]
+        course_plan = plan.compile_config({"course": course_config})["course"]
+        with tempfile.TemporaryDirectory() as path:
+            engine = sqlalchemy.create_engine(f"sqlite:///{path}/myla.db")
+            with engine.begin() as conn:
+                # Lets the chunks be written while the rest of the table is still being read
+                conn.execute(sqlalchemy.text("PRAGMA journal_mode=WAL"))
+                conn.execute(sqlalchemy.text("CREATE TABLE course (id INTEGER PRIMARY KEY, name TEXT)"))
+                values = ", ".join(f"({i}, 'course {i}')" for i in range(1, 11))
+                conn.execute(sqlalchemy.text(f"INSERT INTO course VALUES {values}"))
+            expected = pd.read_sql("SELECT * FROM course ORDER BY id", engine)
+            expected["name"] = expected["name"].map(self.ffx.encrypt)
+            write = TableLoader.write
+            writes = []
+
+            def fail_second(loader, df, keys=None):
+                writes.append(len(df))
+                if len(writes) == 2:
+                    raise RuntimeError("lost connection")
+                return write(loader, df, keys=keys)
+            journal_file = os.path.join(path, "journal.json")
+            run = functools.partial(mylasqlanon.process_table, course_plan, engine, {"ffx": self.ffx}, chunk_size=5,
+                                    update_database=True, pipeline_depth=0)
+            with mock.patch.object(mylasqlanon, "WRITE_STRATEGY", "staging"):
+                with mock.patch.object(TableLoader, "write", fail_second):
+                    with self.assertRaisesRegex(RuntimeError, "lost connection"):
+                        run(journal=RunJournal(journal_file))
+                self.assertEqual(RunJournal(journal_file, resume=True).table("course")["rows_read"], 5)
+                metrics = RunMetrics()
+                run(journal=RunJournal(journal_file, resume=True), metrics=metrics)
+            # Only the rows after the first chunk were read again
+            self.assertEqual(metrics.report()["tables"]["course"]["rows"], 5)
+            pd.testing.assert_frame_equal(pd.read_sql("SELECT * FROM course ORDER BY id", engine), expected)
+
+    def test_pipeline(self):
+        read, written = [], []
+
+        def source():
+            for i in range(20):
+                read.append(i)
+                # Back pressure keeps the reader at most a couple of chunks ahead of the writer
+                self.assertLessEqual(len(read) - len(written), 2 * 2 + 3)
+                yield i
+
+        def slow_sink(item):
+            time.sleep(0.001)
+            written.append(item)
+        pipeline.run(source(), lambda i: i * 10, slow_sink, depth=2)
+        self.assertEqual(written, [i * 10 for i in range(20)])
+        for depth in (0, 2):
+            written.clear()
+            pipeline.run(range(6), lambda i: i if i % 2 else None, written.append, depth=depth)
+            self.assertEqual(written, [1, 3, 5])
+
+        # An error in any stage stops the others and is raised, and the source is closed
+        closed = []
+
+        def endless():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.append(True)
+
+        def fail_at(n):
+            def func(i):
+                if i == n:
+                    raise RuntimeError(f"failed at {n}")
+                return i
+            return func
+        with self.assertRaisesRegex(RuntimeError, "failed at 3"):
+            pipeline.run(endless(), fail_at(3), lambda i: None, depth=2)
+        with self.assertRaisesRegex(RuntimeError, "failed at 5"):
+            pipeline.run(endless(), lambda i: i, fail_at(5), depth=2)
+        self.assertEqual(closed, [True, True])
+        written.clear()
+        with self.assertRaisesRegex(ValueError, "lost connection"):
+            pipeline.run((i if i < 4 else int("lost connection") for i in range(10)), lambda i: i, written.append,
+                         depth=1)
+        self.assertTrue(set(written) <= {0, 1, 2, 3})
+
+    def test_compact_frame(self):
+        engine = sqlalchemy.create_engine("sqlite://")
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE resource (id INTEGER, course_id BIGINT, "
+                                         "resource_type VARCHAR(20), name TEXT, score FLOAT, due DATETIME)"))
+        config = [{"name": "id"}, {"name": "course_id", "module": "ffx", "method": "encrypt"},
+                  {"name": "resource_type", "module": "util_methods", "method": "shuffle", "index": "course_id"},
+                  {"name": "name", "dtype": "object"}, {"name": "score"}]
+        types = util_methods.column_types(engine, "resource", config)
+        self.assertEqual(types, {"id": "int", "course_id": "int", "resource_type": "text", "name": "object",
+                                 "score": "float", "due": "datetime"})
+        n = 60
+        df = pd.DataFrame({"id": np.arange(1, n + 1), "course_id": [1770001.0, 1770002.0, np.nan] * 20,
+                           "resource_type": ["canvas", "leccap", None] * 20, "name": ["Reading"] * n,
+                           "score": np.linspace(0, 10, n)})
+        # A missing value in a course is shuffled as 0, categorical or not
+        df.loc[1, "resource_type"] = None
+        compact = util_methods.compact_frame(df.copy(), types)
+        self.assertEqual(compact["id"].dtype, np.int8)
+        self.assertEqual(str(compact["course_id"].dtype), "Int32")
+        self.assertEqual(compact["course_id"].iloc[0], 1770001)
+        self.assertTrue(isinstance(compact["resource_type"].dtype, pd.CategoricalDtype))
+        self.assertEqual(compact["name"].dtype, object)
+        self.assertEqual(compact["score"].dtype, np.float64)
+        self.assertLess(compact.memory_usage(deep=True).sum(), df.memory_usage(deep=True).sum())
+
+        # The transforms give the same values on the compact columns
+        modules = {"ffx": self.ffx, "util_methods": util_methods}
+        np.random.seed(3)
+        TableTransformer(config, modules).apply(df)
+        np.random.seed(3)
+        TableTransformer(config, modules).apply(compact)
+        # Encrypted ids get the widest nullable type
+        self.assertEqual(str(compact["course_id"].dtype), "Int64")
+        self.assertTrue(isinstance(compact["resource_type"].dtype, pd.CategoricalDtype))
+        for col in df.columns:
+            self.assertEqual(df[col].astype(object).where(df[col].notna(), None).tolist(),
+                             compact[col].astype(object).where(compact[col].notna(), None).tolist())
+        self.assertEqual((compact["resource_type"] == 0).sum(), 1)
+        compact.to_sql("resource", engine, if_exists="append", index=False)
+        written = pd.read_sql("select * from resource", engine)
+        self.assertEqual(written["course_id"].isna().sum(), 20)
+
+        # Compacted pieces of a table keep their dtypes when they're put together
+        pieces = [util_methods.compact_frame(df.iloc[start:start + 20].copy(), types) for start in (0, 20, 40)]
+        pieces[2]["resource_type"] = pieces[2]["resource_type"].cat.remove_categories(["leccap"])
+        whole = util_methods.concat_frames(pieces)
+        self.assertEqual(len(whole), n)
+        self.assertTrue(isinstance(whole["resource_type"].dtype, pd.CategoricalDtype))
+        self.assertEqual(whole["id"].dtype, np.int8)
+        self.assertIsNone(util_methods.concat_frames([]))
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as path:
+            snapshot = SnapshotExport(path, "csv.gz")
+            table_export = snapshot.table("assignment@id|submission@id")
+            # Each assignment is repeated for its submissions and only exported once
+            for ids in ([1, 1, 2], [3, 4, 4]):
+                table_export.write(pd.DataFrame({"assignment.id": ids, "assignment.name": [f"a{i}" for i in ids],
+                                                 "submission.id": [i * 10 + n for n, i in enumerate(ids)]}))
+            self.assertTrue(os.path.exists(snapshot.path("assignment") + ".tmp"))
+            table_export.finish()
+            with open(snapshot.write_manifest()) as json_data:
+                manifest = json.load(json_data)
+            self.assertEqual(manifest["format"], "csv.gz")
+            self.assertEqual({name: entry["rows"] for name, entry in manifest["tables"].items()},
+                             {"assignment": 4, "submission": 6})
+            assignments = pd.read_csv(snapshot.path("assignment"))
+            self.assertEqual(assignments["id"].tolist(), [1, 2, 3, 4])
+            self.assertEqual(list(assignments.columns), ["id", "name"])
+            entry = manifest["tables"]["submission"]
+            self.assertEqual(entry["sha256"], export.sha256_file(os.path.join(path, entry["file"])))
+
+            # A table that fails leaves the last export alone
+            table_export = snapshot.table("assignment@id|submission@id")
+            table_export.write(pd.DataFrame({"assignment.id": [9], "assignment.name": ["b"], "submission.id": [90]}))
+            table_export.abort()
+            self.assertEqual(sorted(os.listdir(path)), ["assignment.csv.gz", "manifest.json", "submission.csv.gz"])
+            self.assertEqual(len(pd.read_csv(snapshot.path("assignment"))), 4)
+        with self.assertRaises(ValueError):
+            SnapshotExport(path, "xlsx")
+
+    def test_export_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow isn't installed")
+        types = {"assignment.id": "int", "assignment.due": "datetime", "submission.id": "int",
+                 "submission.score": "int", "submission.grader": "text"}
+        with tempfile.TemporaryDirectory() as path:
+            snapshot = SnapshotExport(path, "parquet")
+            table_export = snapshot.table("assignment@id|submission@id", types)
+            # Everything but the ids is empty in the first chunk, so the schema comes from the database types
+            table_export.write(pd.DataFrame({"assignment.id": [1, 2], "assignment.due": [None, None],
+                                             "submission.id": [10, 20], "submission.score": [None, None],
+                                             "submission.grader": pd.Categorical([None, None])}))
+            table_export.write(pd.DataFrame({"assignment.id": pd.array([3, 4], dtype="Int8"),
+                                             "assignment.due": pd.to_datetime(["2020-01-01 10:00", None]),
+                                             "submission.id": [30, 40], "submission.score": [7, 9],
+                                             "submission.grader": pd.Categorical(["a", "b"])}))
+            table_export.finish()
+            assignments = pd.read_parquet(snapshot.path("assignment"))
+            self.assertEqual(assignments["id"].tolist(), [1, 2, 3, 4])
+            self.assertEqual(assignments["due"].dtype, "datetime64[ns]")
+            self.assertEqual(assignments["due"].iloc[2], pd.Timestamp("2020-01-01 10:00"))
+            submissions = pd.read_parquet(snapshot.path("submission"))
+            self.assertEqual(submissions["score"].tolist()[2:], [7, 9])
+            self.assertEqual(submissions["grader"].astype(object).tolist()[2:], ["a", "b"])
+
+    def test_plan(self):
+        db_config = {
+            "course": [{"name": "id", "module": "ffx", "method": "encrypt"},
+                       {"name": "name", "module": "faker", "method": "course"}],
+            "assignment@id|submission@id": {
+                "join": "LEFT JOIN submission on (assignment.id = submission.assignment_id)",
+                "tables": [{"name": "assignment", "cols": [{"name": "id", "module": "ffx", "method": "encrypt"}]},
+                           {"name": "submission", "cols": [
+                               {"name": "assignment_id", "module": "ffx", "method": "encrypt"},
+                               {"name": "score", "module": None, "method": None},
+                               {"name": "avg_score", "module": "util_methods", "method": "mean",
+                                "source": "submission.score", "index": "submission.assignment_id"}]}]},
+        }
+        plans = plan.compile_config(db_config)
+        joined = plans["assignment@id|submission@id"]
+        self.assertEqual(joined.group_cols, ("submission.assignment_id", "assignment.id"))
+        self.assertEqual(joined.key_cols, ("assignment.id",))
+        self.assertEqual([col.kernel for col in joined.columns], ["ffx", "ffx", None, "mean"])
+        # The plan can't be changed through the configurations it hands out
+        joined.t_config()[0]["name"] = "changed"
+        self.assertEqual(joined.t_config()[0]["name"], "assignment.id")
+        self.assertEqual(db_config["assignment@id|submission@id"]["tables"][0]["cols"][0]["name"], "id")
+
+        # Every problem is reported at once
+        bad = dict(db_config, course=[{"name": "id", "module": "ffx", "method": "decrypt"},
+                                      {"name": "name", "module": "util_methods", "method": "redist"}])
+        with self.assertRaisesRegex(ValueError, "(?s)ffx has no method decrypt.*redist needs an index.*other"):
+            plan.compile_config(bad, ["course", "other"])
+
+        engine = sqlalchemy.create_engine("sqlite://")
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE course (id BIGINT, name TEXT)"))
+            conn.execute(sqlalchemy.text("INSERT INTO course VALUES (1, 'a'), (2, 'b'), (3, 'c')"))
+            conn.execute(sqlalchemy.text("CREATE TABLE assignment (id BIGINT)"))
+        plan.validate_schema(plans, engine, ["course"])
+        with self.assertRaisesRegex(ValueError, "submission doesn't exist"):
+            plan.validate_schema(plans, engine)
+        explained = plan.explain(plans, engine, ["course"], dict(plan.DEFAULT_RATES, ffx_int=3, faker_course=1),
+                                 chunk_size=2)
+        self.assertEqual(explained[0]["rows"], 3)
+        self.assertEqual(explained[0]["chunks"], 2)
+        self.assertEqual(explained[0]["kernels"], {"id": "ffx_int", "name": "faker_course"})
+        self.assertAlmostEqual(explained[0]["seconds"]["transform"], 3 / 3 + 3 / 1)
+        self.assertIn("course", plan.format_explain(explained))
+
+        # config.json is only read and compiled when a run starts, importing the script doesn't touch it
+        import mylasqlanon
+        self.assertFalse(hasattr(mylasqlanon, "table_plans"))
+        with tempfile.TemporaryDirectory() as path:
+            with self.assertRaises(FileNotFoundError):
+                mylasqlanon.load_config(os.path.join(path, "config.json"))
+        self.assertEqual(set(plan.compile_config(mylasqlanon.load_config())), set(mylasqlanon.load_config()))
+
+    def test_normalized_joins(self):
+        key = "assignment@id|submission@id"
+        t_config = {
+            "join": "LEFT JOIN submission on (assignment.id = submission.assignment_id)",
+            "tables": [{"name": "assignment", "cols": [{"name": "id", "module": "ffx", "method": "encrypt"},
+                                                       {"name": "course_id", "module": "ffx", "method": "encrypt"}]},
+                       {"name": "submission", "cols": [
+                           {"name": "id"}, {"name": "assignment_id", "module": "ffx", "method": "encrypt"},
+                           {"name": "score"},
+                           {"name": "avg_score", "module": "util_methods", "method": "mean",
+                            "source": "submission.score", "index": "assignment.course_id"}]}]}
+        joined = plan.compile_config({key: t_config})[key]
+        submission, assignment = joined.members
+        self.assertEqual((submission.table, assignment.table), ("submission@id", "assignment@id"))
+        self.assertEqual(submission.lookups, ("assignment.course_id",))
+        self.assertEqual(submission.group_cols, ("assignment.course_id",))
+        self.assertEqual(submission.columns[3].source, "score")
+
+        engine = sqlalchemy.create_engine("sqlite://")
+        with engine.begin() as conn:
+            for statement in ("CREATE TABLE assignment (id INTEGER, course_id INTEGER)",
+                              "INSERT INTO assignment VALUES (1, 10), (2, 10), (3, 20)",
+                              "CREATE TABLE submission (id INTEGER, assignment_id INTEGER, score REAL, avg_score REAL)",
+                              # Submission 5 isn't joined to an assignment, so it isn't read either way
+                              "INSERT INTO submission VALUES (1, 1, 1.0, 0), (2, 2, 3.0, 0), (3, 3, 5.0, 0), "
+                              "(5, 9, 7.0, 0)"):
+                conn.execute(sqlalchemy.text(statement))
+        modules = {"ffx": self.ffx, "util_methods": util_methods}
+        df = pd.read_sql(joined.sql, engine)
+        TableTransformer(joined.t_config(), modules).apply(df)
+        expected = util_methods.split_tables(key, df)
+        for member, (table_name, expected_df) in zip((assignment, submission), expected):
+            df = pd.read_sql(member.sql, engine)
+            TableTransformer(member.t_config(), modules).apply(df)
+            df = df.drop(columns=list(member.lookups))
+            pd.testing.assert_frame_equal(df.reset_index(drop=True), expected_df.reset_index(drop=True),
+                                          check_dtype=False)
+        self.assertEqual(df["avg_score"].tolist(), [2.0, 2.0, 5.0])
+
+        # Anything else is run joined
+        inner = dict(t_config, join="JOIN submission on (assignment.id = submission.assignment_id)")
+        self.assertEqual(plan.compile_config({key: inner})[key].members, ())
+        faked = copy.deepcopy(t_config)
+        faked["tables"][0]["cols"][1] = {"name": "course_id", "module": "faker", "method": "course"}
+        self.assertEqual(plan.compile_config({key: faked})[key].members, ())
+
+    def test_subset(self):
+        db_config = {
+            "academic_terms": [{"name": "id"}],
+            "course": [{"name": "id"}, {"name": "term_id", "references": "academic_terms.id"}],
+            "resource_access": [{"name": "id"}, {"name": "resource_id"}, {"name": "course_id"}],
+            "resource": [{"name": "id"}, {"name": "resource_id"}],
+            "assignment@id|submission@id": {
+                "join": "LEFT JOIN submission on (assignment.id = submission.assignment_id)",
+                "tables": [{"name": "assignment", "cols": [{"name": "id"}, {"name": "course_id"}]},
+                           {"name": "submission", "cols": [{"name": "id"}, {"name": "assignment_id"}]}]},
+            "settings": [{"name": "id"}],
+        }
+        plans = plan.compile_config(db_config)
+        refs = subset.references(plans)
+        self.assertEqual(refs["course"], [("term_id", "academic_terms", "id")])
+        self.assertEqual(refs["resource_access"],
+                         [("resource_id", "resource", "resource_id"), ("course_id", "course", "id")])
+        self.assertEqual(refs["submission"], [("assignment_id", "assignment", "id")])
+
+        engine = sqlalchemy.create_engine("sqlite://")
+        with engine.begin() as conn:
+            for statement in ("CREATE TABLE academic_terms (id INTEGER)", "INSERT INTO academic_terms VALUES (1), (2)",
+                              "CREATE TABLE course (id INTEGER, term_id INTEGER)",
+                              "INSERT INTO course VALUES (10, 1), (11, 2), (12, 2)",
+                              "CREATE TABLE resource_access (id INTEGER, resource_id INTEGER, course_id INTEGER)",
+                              "INSERT INTO resource_access VALUES (1, 100, 10), (2, 101, 11), (3, 100, 12), "
+                              "(4, NULL, 12)",
+                              "CREATE TABLE resource (id INTEGER, resource_id INTEGER)",
+                              "INSERT INTO resource VALUES (1, 100), (2, 101)"):
+                conn.execute(sqlalchemy.text(statement))
+        self.assertEqual(subset.select_courses(engine, count=2), [10, 11])
+        self.assertEqual(subset.select_courses(engine, [12], term=2), [12, 11])
+
+        filters = subset.build_filters(plans, engine, [12])
+        self.assertEqual(filters["course"], ("id", (12,)))
+        self.assertEqual(filters["academic_terms"].values, (2,))
+        self.assertEqual(filters["resource"], ("resource_id", (100,)))
+        self.assertEqual(filters["assignment@id|submission@id"].column, "assignment.course_id")
+        # Tables not related to any course are run whole
+        self.assertNotIn("settings", filters)
+        condition, params = filters["resource"].condition()
+        self.assertEqual(condition, "resource_id IN :subset")
+        query = sqlalchemy.text(f"SELECT id FROM resource WHERE {condition}").bindparams(
+            sqlalchemy.bindparam("subset", expanding=True))
+        with engine.connect() as conn:
+            self.assertEqual([row[0] for row in conn.execute(query, params)], [1])
+
+    def test_metrics(self):
+        metrics = RunMetrics(track_memory=True)
+        self.addCleanup(metrics.close)
+        t_config = [{"name": "user_id", "module": "ffx", "method": "encrypt"},
+                    {"name": "access_time", "module": "util_methods", "method": "shuffle", "index": "user_id"}]
+        transformer = TableTransformer(t_config, {"ffx": self.ffx, "util_methods": util_methods},
+                                       record=functools.partial(metrics.column, "resource_access"),
+                                       memory=metrics.memory)
+        for df in (self.sampleAccessDF(), self.sampleAccessDF().head(5)):
+            metrics.add_rows("resource_access", len(df))
+            with metrics.phase("resource_access", "transform"):
+                transformer.apply(df)
+        self.assertEqual(list(metrics.timed("resource_access", "read", [1, 2])), [1, 2])
+        # Each phase gets the peak of its own allocations, 8MB for the read and 40MB for the write
+        chunks = list(metrics.timed("resource", "read", (np.ones(10 ** 6) for _ in range(2))))
+        with metrics.phase("resource", "write"):
+            written = np.ones(5 * 10 ** 6)
+            del written
+        metrics.close()
+        report = json.loads(json.dumps(metrics.report()))
+        phases = report["tables"]["resource"]["phases"]
+        self.assertAlmostEqual(phases["read"]["peak_memory_mb"], 8 / 1.048576, delta=1)
+        self.assertAlmostEqual(phases["write"]["peak_memory_mb"], 40 / 1.048576, delta=1)
+        # The resource table was never transformed
+        self.assertIsNone(phases["transform"]["peak_memory_mb"])
+        self.assertEqual(len(chunks), 2)
+        table = report["tables"]["resource_access"]
+        self.assertEqual((report["rows"], table["rows"], table["chunks"]), (25, 25, 2))
+        self.assertEqual(table["columns"]["user_id"]["distinct"], 3)
+        self.assertEqual(table["columns"]["access_time"]["method"], "shuffle")
+        self.assertEqual(table["columns"]["access_time"]["rows"], 25)
+        self.assertGreater(table["phases"]["transform"]["seconds"], 0)
+        self.assertGreater(table["phases"]["transform"]["peak_memory_mb"], 0)
+        self.assertLess(table["phases"]["transform"]["peak_memory_mb"], phases["read"]["peak_memory_mb"])
+        self.assertGreater(table["columns"]["access_time"]["peak_memory_mb"], 0)
+
+        # Memory is only tracked when asked for, tracemalloc slows everything down
+        metrics = RunMetrics()
+        self.assertIsNone(metrics.memory)
+        with metrics.phase("resource", "write"):
+            pass
+        self.assertIsNone(metrics.report()["tables"]["resource"]["phases"]["write"]["peak_memory_mb"])
+
+    def test_synthetic_data(self):
+        with open(os.path.join(this_dir, "..", "config.json")) as json_data:
+            tables = synthetic.config_tables(json.load(json_data))
+        engine = sqlalchemy.create_engine("sqlite://")
+        written = synthetic.SyntheticMyLA(2000, seed=1).load(engine, tables)
+        self.assertEqual(set(written), set(tables))
+        submission = pd.read_sql("SELECT * FROM submission", engine)
+        self.assertEqual(list(submission.columns), tables["submission"])
+        # Foreign keys point at rows that exist
+        assignments = pd.read_sql("SELECT id FROM assignment", engine)["id"]
+        self.assertTrue(submission["assignment_id"].isin(assignments).all())
+        again = next(synthetic.SyntheticMyLA(2000, seed=1).frames("submission", tables["submission"]))
+        self.assertTrue(again["user_id"].equals(submission["user_id"]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,334 @@
+# Column wise transform engine for the depersonalizer
+import logging, time
+
+import pandas as pd
+import numpy as np
+
+import util_methods
+
+logger = logging.getLogger()
+
+# Integers the batch transforms can take, anything with more digits goes through the scalar version
+POW10_LIMIT = 10 ** 18
+
+
+def _distinct_values(series: pd.Series):
+    """Factorize a column into codes and the distinct values
+
+    The distinct values are the same scalar types that df.at returns for a cell
+    (numpy scalars for numeric columns, Timestamps for dates), missing values get the code -1
+
+    :param series: Column to factorize
+    :return: Tuple of the codes and a list of the distinct values
+    """
+    codes, uniques = pd.factorize(series.values)
+    if series.dtype.kind in "mM":
+        uniques = list(pd.Index(uniques))
+    else:
+        uniques = list(uniques)
+    return codes, uniques
+
+
+def _as_column(values: np.ndarray, like: pd.Series) -> pd.Series:
+    """Build a new column out of an object array of transformed values, keeping floating point columns
+    floating point like a cell by cell assignment would, and nullable integer columns nullable
+    """
+    result = pd.Series(values, index=like.index, name=like.name).infer_objects()
+    if like.dtype.kind == "f" and result.dtype.kind in "iu":
+        result = result.astype(like.dtype)
+    elif pd.api.types.is_extension_array_dtype(like.dtype) and like.dtype.kind in "iu" and result.dtype.kind in "Of":
+        try:
+            # Encrypted ids can be wider than the originals, so they get the widest type
+            result = result.astype("Int64")
+        except (TypeError, ValueError):
+            pass
+    return result
+
+
+def _object_array(values: list) -> np.ndarray:
+    """Make a 1d object array without numpy trying to look inside the values"""
+    out = np.empty(len(values), dtype=object)
+    out[:] = values
+    return out
+
+
+def resolve(modules: dict, module: str, method: str):
+    """Look up the function for a module and method name from config.json
+
+    :return: Tuple of the function and the batch version of it for arrays of positive integers (or None)
+    """
+    func = getattr(modules.get(module), method)
+    batch_func = None
+    batch_method = TableTransformer.BATCH_METHODS.get((module, method))
+    if batch_method:
+        batch_func = getattr(modules.get(module), batch_method, None)
+    return func, batch_func
+
+
+def batch_values(uniques: list, dtype):
+    """Find the distinct values a batch transform can take, the positive whole numbers
+
+    :param uniques: Distinct values of a column
+    :param dtype: dtype of the column the values came from
+    :return: Tuple of the mask of those values and them as an int64 array
+    """
+    # Nullable integer columns are batched like int64
+    dtype = getattr(dtype, "numpy_dtype", dtype)
+    if dtype.kind not in "if" or not len(uniques):
+        return np.zeros(len(uniques), dtype=bool), np.empty(0, dtype=np.int64)
+    nums = np.asarray(uniques, dtype=dtype)
+    batch = (nums > 0) & (nums < POW10_LIMIT)
+    if dtype.kind == "f":
+        batch &= np.floor(nums) == nums
+    return batch, nums[batch].astype(np.int64)
+
+
+def map_distinct(func, batch_func, uniques: list, dtype, addition: int) -> np.ndarray:
+    """Run a deterministic transform over a list of distinct values
+
+    :param func: Transform taking a single value and the addition
+    :param batch_func: Version of func taking an array of positive integers, or None
+    :param uniques: Distinct values of a column
+    :param dtype: dtype of the column the values came from
+    :param addition: ID_ADDITION passed to the transform
+    :return: Object array of the transformed values, values that couldn't be converted are left as they were
+    """
+    results = _object_array(uniques)
+    batch = np.zeros(len(uniques), dtype=bool)
+    if batch_func is not None:
+        # Positive whole numbers all go through the batch version at once
+        batch, nums = batch_values(uniques, dtype)
+        if batch.any():
+            results[batch] = list(batch_func(nums, addition=addition))
+    for pos in np.flatnonzero(~batch):
+        val = uniques[pos]
+        try:
+            results[pos] = func(val, addition=addition)
+        except ValueError:
+            logger.exception(f"Problem converting {val}")
+    return results
+
+
+def fake_rows(faker, funcs: list, takes_input: list, inputs: list, seeds: list, start_row: int, rows: int) -> list:
+    """Generate fake values with the generator reseeded for every cell, so each value only depends
+    on its seed and row number and not on what was generated before it
+
+    :param faker: Faker generator
+    :param funcs: Names of the faker methods, one per column
+    :param takes_input: Whether each method takes the current value of the cell
+    :param inputs: Current values of each column, starting at start_row
+    :param seeds: Seed prefix for each column
+    :param start_row: Row number of the first row within the table
+    :param rows: Number of rows to generate
+    :return: List of the generated values for each column
+    """
+    methods = [getattr(faker, func) for func in funcs]
+    outputs = [[None] * rows for _ in funcs]
+    for row in range(rows):
+        for i, method in enumerate(methods):
+            faker.seed_instance(f"{seeds[i]}/{start_row + row}")
+            outputs[i][row] = method(inputs[i][row]) if takes_input[i] else method()
+    return outputs
+
+
+class ColumnTransform():
+    """A single column from config.json with its transform resolved to a callable"""
+
+    def __init__(self, col: dict, modules: dict):
+        self.name = col.get("name")
+        self.module = col.get("module")
+        self.method = col.get("method")
+        self.index = col.get("index")
+        self.source = col.get("source")
+        self.func = None
+        self.batch_func = None
+        if self.module and self.method:
+            self.func, self.batch_func = resolve(modules, self.module, self.method)
+
+
+class TableTransformer():
+    """Applies the transforms of a table to whole columns at once
+
+    Each column's transform is resolved once. Deterministic transforms (ffx) only run on the distinct
+    values of a column and are mapped back, faker draws from a shared random stream so it is called
+    row by row in the same order the cell by cell loop used to, and the group based util_methods
+    work on the whole dataframe.
+    """
+
+    # Modules whose methods always give the same output for the same input
+    MAPPED_MODULES = ("ffx",)
+    # Modules whose methods take no input (or only the cell) and consume a random stream
+    STREAM_MODULES = ("faker",)
+    # Methods that have a version taking an array of positive integers
+    BATCH_METHODS = {("ffx", "encrypt"): "encrypt_int_array"}
+    # Faker methods that take the current value of the cell
+    STREAM_INPUT_METHODS = ("date_time_on_date",)
+    # Faker methods that have a version generating a whole column from the row numbers and a seed
+    FAKER_BATCH_METHODS = {"assignment": "assignment_batch", "course": "course_batch",
+                           "date_time_on_date": "date_time_on_date_batch"}
+    # How each of the column wide util_methods is called
+    COLUMN_METHODS = {
+        "redist": lambda func, df, col: func(df, col.name, col.index),
+        "mean": lambda func, df, col: func(df, col.source, col.name, col.index),
+        "shuffle": lambda func, df, col: func(df, shuffle_col=col.name, index_col=col.index),
+    }
+
+    def __init__(self, t_config: list, modules: dict, addition: int = 0, pool=None, seed_prefix: str = "",
+                 id_store=None, record=None, faker_batch: bool = False, faker_seed: int = 0, memory=None):
+        """
+        :param t_config: List of the column configurations
+        :param modules: Dictionary of the objects that module names in config.json refer to
+        :param addition: ID_ADDITION passed to ffx
+        :param pool: parallel.TransformPool to run the ffx and faker columns on, faker is then seeded per row
+        :param seed_prefix: Prefix of the per row faker seeds, usually the table name
+        :param id_store: id_mapping.IdMappingStore shared by every table, the integer ids of the batch
+                         transforms are looked up there first
+        :param record: Called with the column, method, seconds, rows, distinct values (or None) and peak memory
+                       in MB (or None) after each column is transformed, like a partial of metrics.RunMetrics.column
+        :param faker_batch: Generate the faker columns that have a batch version a whole column at a time,
+                            from a seed per column and the row numbers instead of the faker random stream
+        :param faker_seed: Seed the batch faker columns' seeds are derived from
+        :param memory: metrics.MemoryTracker to measure the peak memory of each column with
+        """
+        self.addition = addition
+        self.pool = pool
+        # The store only holds values for one addition
+        self.id_store = id_store if id_store is not None and id_store.addition == addition else None
+        self.seed_prefix = seed_prefix
+        # Row number of the next row within the table, used for the per row faker seeds
+        self.rows_seen = 0
+        self.record = record
+        self.memory = memory
+        self.columns = [ColumnTransform(col, modules) for col in t_config]
+        self.mapped = [c for c in self.columns if c.func and c.module in self.MAPPED_MODULES]
+        self.stream = [c for c in self.columns if c.func and c.module in self.STREAM_MODULES]
+        self.faker_batch = []
+        if faker_batch:
+            faker = modules.get("faker")
+            self.faker_batch = [(c, getattr(faker, self.FAKER_BATCH_METHODS[c.method]),
+                                 util_methods.hash_string_to_int(f"{faker_seed}/{seed_prefix}/{c.name}", 18))
+                                for c in self.stream if hasattr(faker, self.FAKER_BATCH_METHODS.get(c.method, "-"))]
+            self.stream = [c for c in self.stream if c not in [batch[0] for batch in self.faker_batch]]
+        self.column_wide = [c for c in self.columns if c.func and c.method in self.COLUMN_METHODS]
+
+    def apply(self, df: pd.DataFrame):
+        """Transform a dataframe inplace
+
+        :param df: Dataframe holding the rows
+        """
+        if len(df) == 0:
+            return
+        for col in self.mapped:
+            logger.debug(f"Transforming {col.name} with {col.module}")
+            start = self._start()
+            df[col.name], distinct = self.apply_mapped(df[col.name], col)
+            self._record(col.name, col.method, start, len(df), distinct)
+        for col, batch_func, seed in self.faker_batch:
+            start = self._start()
+            self.apply_faker_batch(df, col, batch_func, seed)
+            self._record(col.name, "faker", start, len(df))
+        if self.stream:
+            start = self._start()
+            if self.pool:
+                self.apply_stream_seeded(df)
+            else:
+                self.apply_stream(df)
+            # The stream columns are generated together, row by row
+            self._record(",".join(col.name for col in self.stream), "faker", start, len(df))
+        self.rows_seen += len(df)
+        # Now go through the columns and look for column wide changes
+        # These methods are based on using another column as an index
+        # and applying the changes in bulk rather than individually.
+        # They share the grouping of each index column, which may have just been encrypted
+        util_methods.clear_group_cache(df)
+        for col in self.column_wide:
+            logger.debug(f"{col.method} {col.name} by {col.index}")
+            start = self._start()
+            self.COLUMN_METHODS[col.method](col.func, df, col)
+            self._record(col.name, col.method, start, len(df))
+
+    def _start(self) -> tuple:
+        return time.perf_counter(), self.memory.start() if self.memory else None
+
+    def _record(self, column: str, method: str, start: tuple, rows: int, distinct: int = None):
+        """Record a column that was started with _start"""
+        seconds = time.perf_counter() - start[0]
+        memory_mb = self.memory.stop(start[1]) if self.memory else None
+        if self.record:
+            self.record(column, method, seconds, rows, distinct, memory_mb)
+
+    def apply_mapped(self, series: pd.Series, col: ColumnTransform):
+        """Run a deterministic transform once per distinct value of the column
+
+        :return: Tuple of the new column and the number of distinct values
+        """
+        codes, uniques = _distinct_values(series)
+        if self.id_store is not None and col.batch_func is not None:
+            results = self.map_stored(col, uniques, series.dtype)
+        else:
+            results = self.map_distinct(col, uniques, series.dtype)
+        # Missing values are passed through untouched
+        values = series.astype(object).values.copy()
+        found = codes >= 0
+        values[found] = results[codes[found]]
+        result = _as_column(values, series)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Every distinct value still has its own, so the column is as repetitive as before
+            result = result.astype("category")
+        return result, len(uniques)
+
+    def map_distinct(self, col: ColumnTransform, uniques: list, dtype) -> np.ndarray:
+        """Run a column's transform over its distinct values, on the pool if there is one"""
+        if self.pool:
+            return self.pool.map_distinct(col.module, col.method, uniques, dtype, self.addition)
+        return map_distinct(col.func, col.batch_func, uniques, dtype, self.addition)
+
+    def map_stored(self, col: ColumnTransform, uniques: list, dtype) -> np.ndarray:
+        """Look the integer ids up in the id store, only encrypting the ones no table has seen yet"""
+        batch, nums = batch_values(uniques, dtype)
+        results = _object_array(uniques)
+        if batch.any():
+            def encrypt(new: np.ndarray) -> np.ndarray:
+                return self.map_distinct(col, list(new), new.dtype).astype(np.int64)
+            results[batch] = list(self.id_store.lookup(nums, encrypt))
+        rest = np.flatnonzero(~batch)
+        if len(rest):
+            results[rest] = self.map_distinct(col, [uniques[pos] for pos in rest], dtype)
+        return results
+
+    def apply_faker_batch(self, df: pd.DataFrame, col: ColumnTransform, batch_func, seed: int):
+        """Generate a faker column at once, every value only depends on the seed and its row within the table"""
+        rows = np.arange(self.rows_seen, self.rows_seen + len(df))
+        if col.method in self.STREAM_INPUT_METHODS:
+            values = batch_func(df[col.name], rows, seed)
+        else:
+            values = batch_func(rows, seed)
+        if isinstance(values, np.ndarray) and values.dtype == object:
+            values = _as_column(values, df[col.name])
+        df[col.name] = values
+
+    def apply_stream(self, df: pd.DataFrame):
+        """Run the random stream transforms row by row across all of the stream columns,
+        so the values are drawn in the same order as the cell by cell loop
+        """
+        inputs = [df[col.name].tolist() for col in self.stream]
+        outputs = [[None] * len(df) for _ in self.stream]
+        takes_input = [col.method in self.STREAM_INPUT_METHODS for col in self.stream]
+        funcs = [col.func for col in self.stream]
+        for row in range(len(df)):
+            for i, func in enumerate(funcs):
+                outputs[i][row] = func(inputs[i][row]) if takes_input[i] else func()
+        for col, values in zip(self.stream, outputs):
+            df[col.name] = _as_column(_object_array(values), df[col.name])
+
+    def apply_stream_seeded(self, df: pd.DataFrame):
+        """Run the random stream transforms on the pool with a seed per row, so the values don't depend
+        on how the rows are split up between the workers
+        """
+        funcs = [col.method for col in self.stream]
+        takes_input = [col.method in self.STREAM_INPUT_METHODS for col in self.stream]
+        inputs = [df[col.name].tolist() if takes_input[i] else None for i, col in enumerate(self.stream)]
+        seeds = [f"{self.seed_prefix}/{col.name}" for col in self.stream]
+        outputs = self.pool.fake_rows(funcs, takes_input, inputs, seeds, self.rows_seen, len(df))
+        for col, values in zip(self.stream, outputs):
+            df[col.name] = _as_column(_object_array(values), df[col.name])
@@ -1,11 +1,10 @@
 # Utility methods for depersonalizer
 
-import hashlib, logging
-import scipy.stats
+import hashlib, logging, threading, time, weakref
 import pandas as pd
 import sqlalchemy
 import numpy as np
-from typing import List
+from typing import Iterable, Iterator, List
 
 logger = logging.getLogger()
 
@@ -14,76 +13,569 @@ def hash_string_to_int(s: str, length: int):
     return int(hashlib.sha1(s.encode('utf-8')).hexdigest(), 16) % (10 ** length)
 
 
-def pandas_delete_and_insert(mysql_tables: str, df: pd.DataFrame, engine: sqlalchemy.engine.Engine):
-    """Delete from the named table and insert
+def split_tables(mysql_tables: str, df: pd.DataFrame) -> List[tuple]:
+    """Split a dataframe into the dataframes of each table it will be written back to
 
     :param mysql_tables: Either a single value or | separated list of tables that will be inserted
-    :type mysql_tables: str
     :param df: Either a single dataframe or one that has column names split by table_name.column_name
-    :type df: pandas.DataFrame
-    :param engine: SQLAlchemy engine
-    :type engine: sqlalchemy.engine.Engine
+    :return: List of (table_name, dataframe) tuples
     """
     mysql_tables = mysql_tables.split("|")
+    if len(mysql_tables) == 1:
+        return [(mysql_tables[0].split("@")[0], df)]
+    tables = []
     for mysql_table in mysql_tables:
         # Try to split off the index
         table_name, index_name = (mysql_table.split("@") + [None] * 2)[:2]
-        # Go though each table in the array
-        query = f"delete from {table_name}"
-        engine.execute(query)
-
-        # write to MySQL
-        if len(mysql_tables) > 1:
-            table_prefix = table_name + "."
-            # Filter and Remove the table name from  column so it can be written back
-            df_tmp = df.filter(like=table_prefix)
-            df_tmp.rename(columns=lambda x: str(x)[
-                                   len(table_prefix):], inplace=True)
-            if index_name:
-                # Drop anything na then drop the duplicates if any
-                df_tmp.dropna(subset=index_name.split(), inplace=True)
-                df_tmp.drop_duplicates(subset=index_name, inplace=True)
-        else:
-            df_tmp = df
+        table_prefix = table_name + "."
+        # Select the table's columns and remove the table name from them so it can be written back
+        cols = [col for col in df.columns if str(col).startswith(table_prefix)]
+        df_tmp = df[cols]
+        df_tmp.columns = [str(col)[len(table_prefix):] for col in cols]
+        if index_name:
+            # Drop anything na then drop the duplicates if any
+            keep = df_tmp[index_name].notna().values & ~df_tmp.duplicated(subset=index_name).values
+            df_tmp = df_tmp[keep]
+        tables.append((table_name, df_tmp))
+    return tables
+
+
+# A text column is loaded as a categorical when it has at most this share of distinct values
+CATEGORY_RATIO = 0.5
+# Nullable integer types from smallest to largest, Int64 isn't used since it takes more memory than float64
+NULLABLE_INTS = ("Int8", "Int16", "Int32")
+
+
+def column_types(engine: sqlalchemy.engine.Engine, mysql_tables: str, col_config: list = None) -> dict:
+    """Kind of every column of a config.json entry, from the database schema and any "dtype" hints in config.json
+
+    The kinds are "int", "float", "category", "text" (a categorical if few of the values are distinct),
+    "datetime", "date" and "object". Only int, category and text columns are compacted, the rest are left
+    as they were read.
+
+    :param engine: SQLAlchemy engine
+    :param mysql_tables: Key of the entry in config.json
+    :param col_config: Column configurations of the entry, with joined columns named table.column
+    :return: Dictionary of the dataframe column names to their kind
+    """
+    inspector = sqlalchemy.inspect(engine)
+    joined = "|" in mysql_tables
+    types = {}
+    for mysql_table in mysql_tables.split("|"):
+        table_name = mysql_table.split("@")[0]
+        for column in inspector.get_columns(table_name):
+            sql_type = column["type"]
+            if isinstance(sql_type, (sqlalchemy.types.Integer, sqlalchemy.types.Boolean)):
+                kind = "int"
+            elif isinstance(sql_type, sqlalchemy.types.Enum):
+                kind = "category"
+            elif isinstance(sql_type, sqlalchemy.types.String):
+                kind = "text"
+            elif isinstance(sql_type, sqlalchemy.types.Float):
+                kind = "float"
+            elif isinstance(sql_type, sqlalchemy.types.DateTime):
+                kind = "datetime"
+            elif isinstance(sql_type, sqlalchemy.types.Date):
+                kind = "date"
+            else:
+                kind = "object"
+            types[f"{table_name}.{column['name']}" if joined else column["name"]] = kind
+    for col in col_config or []:
+        if col.get("dtype"):
+            types[col.get("name")] = col.get("dtype")
+    return types
+
+
+def _compact_ints(series: pd.Series) -> pd.Series:
+    """Smallest integer dtype that holds the values, nullable if any are missing"""
+    values = pd.to_numeric(series)
+    present = values.dropna()
+    if len(present) and not (np.floor(present) == present).all():
+        # Not actually whole numbers, leave them alone
+        return series
+    if not values.isna().any():
+        return pd.to_numeric(values.astype(np.int64), downcast="integer")
+    low, high = (present.min(), present.max()) if len(present) else (0, 0)
+    for dtype in NULLABLE_INTS:
+        info = np.iinfo(dtype.lower())
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return series
+
+
+def compact_frame(df: pd.DataFrame, types: dict) -> pd.DataFrame:
+    """Convert the columns of a dataframe to compact dtypes inplace
+
+    Integer columns become the smallest integer dtype (nullable like Int32 when some are missing, instead of
+    float64, unless they need 64 bits), text and enum columns with few distinct values become categoricals.
+    Floating point columns are kept as float64 so they are written back exactly as they were read.
+
+    :param df: Dataframe as read from the database
+    :param types: Kind of each column, from column_types
+    :return: The same dataframe
+    """
+    for col, kind in types.items():
+        if col not in df.columns or len(df) == 0:
+            continue
+        series = df[col]
         try:
-            df_tmp.to_sql(con=engine, name=table_name,
-                          if_exists='append', index=False)
-        except Exception:
-            logger.exception(f"Error running to_sql on table {table_name}")
-            raise
+            if kind == "int" and series.dtype.kind in "iuf":
+                df[col] = _compact_ints(series)
+            elif kind in ("category", "text") and series.dtype == object:
+                if kind == "category" or series.nunique() <= CATEGORY_RATIO * len(series):
+                    df[col] = series.astype("category")
+        except (TypeError, ValueError, OverflowError):
+            logger.debug(f"Keeping {col} as {series.dtype}", exc_info=True)
+    return df
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate compacted dataframes, categoricals stay categoricals even if their categories differ
+
+    :param frames: Dataframes with the same columns, as returned by compact_frame
+    :return: One dataframe with all of the rows, None if there weren't any dataframes
+    """
+    if len(frames) <= 1:
+        return frames[0] if frames else None
+    for col in frames[0].columns:
+        if all(isinstance(df[col].dtype, pd.CategoricalDtype) for df in frames):
+            categories = pd.Index(pd.unique(np.concatenate([df[col].cat.categories.astype(object) for df in frames])))
+            for df in frames:
+                df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+class TableLoader():
+    """Writes dataframes back to one or more tables, chunk by chunk
+
+    With the "delete" strategy the table is emptied and the first chunk inserted in one transaction,
+    later chunks are appended. With the "staging" strategy every chunk goes into an empty copy of the table
+    and finish() replaces the table's rows with the staged ones in one transaction, so the table is
+    never seen half written and is left untouched if the run fails. With the "upsert" strategy each chunk
+    replaces only the rows with the same keys, both the keys the rows were read with and their new ones.
+    Rows are inserted in batches of batch_size rows.
+    """
+
+    STRATEGIES = ("delete", "staging", "upsert")
+    STAGING_SUFFIX = "_anon_staging"
+
+    def __init__(self, mysql_tables: str, engine: sqlalchemy.engine.Engine, strategy: str = "delete",
+                 batch_size: int = 10000, method: str = None, key: str = None):
+        """
+        :param mysql_tables: Either a single value or | separated list of tables that will be inserted
+        :param engine: SQLAlchemy engine
+        :param strategy: One of "delete", "staging" or "upsert"
+        :param batch_size: Number of rows per insert batch
+        :param method: Insert method passed to DataFrame.to_sql, None uses executemany
+        :param key: Key column of the table, needed by "upsert"
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown write strategy {strategy}, expected one of {self.STRATEGIES}")
+        if strategy == "upsert" and (not key or "|" in mysql_tables):
+            raise ValueError("The upsert strategy needs a single table with a key column")
+        self.key = key
+        self.mysql_tables = mysql_tables
+        self.table_names = [mysql_table.split("@")[0] for mysql_table in mysql_tables.split("|")]
+        # Key of each table, from the table@key syntax or the key argument
+        self.table_keys = {}
+        for mysql_table in mysql_tables.split("|"):
+            table_name, index_name = (mysql_table.split("@") + [None] * 2)[:2]
+            self.table_keys[table_name] = index_name or key
+        # Whether the next chunk may already have been staged by an earlier run
+        self.replay = False
+        self.engine = engine
+        self.strategy = strategy
+        self.batch_size = batch_size or None
+        self.method = method
+        self.started = False
+        self.rows = {table_name: 0 for table_name in self.table_names}
+        self.seconds = {table_name: 0.0 for table_name in self.table_names}
+
+    def quote(self, name: str) -> str:
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def target(self, table_name: str) -> str:
+        """Name of the table the rows are inserted into"""
+        if self.strategy == "staging":
+            return table_name + self.STAGING_SUFFIX
+        return table_name
+
+    def _execute(self, conn, query: str):
+        conn.execute(sqlalchemy.text(query))
+
+    def start(self):
+        """Empty the table, or create the empty staging tables"""
+        with self.engine.begin() as conn:
+            for table_name in self.table_names:
+                if self.strategy == "staging":
+                    staging = self.quote(self.target(table_name))
+                    self._execute(conn, f"DROP TABLE IF EXISTS {staging}")
+                    self._execute(conn, f"CREATE TABLE {staging} AS SELECT * FROM {self.quote(table_name)} WHERE 1=0")
+        self.started = True
+
+    def resume(self) -> bool:
+        """Carry on writing to the staging tables left by an earlier run of the same table
+
+        The first chunk written after resuming replaces any of its rows that were already staged,
+        so the staging tables need a key.
+
+        :return: Whether there were staging tables to carry on with
+        """
+        if self.strategy != "staging" or not all(self.table_keys.values()):
+            return False
+        existing = set(sqlalchemy.inspect(self.engine).get_table_names())
+        if not all(self.target(table_name) in existing for table_name in self.table_names):
+            return False
+        self.started = True
+        self.replay = True
+        return True
+
+    def staged(self) -> bool:
+        """Whether any of the staging tables exist"""
+        existing = set(sqlalchemy.inspect(self.engine).get_table_names())
+        return any(self.target(table_name) in existing for table_name in self.table_names)
+
+    def delete_keys(self, conn, table_name: str, keys: list, key: str = None):
+        """Delete the rows with any of the keys, batch_size keys at a time"""
+        key = key or self.key
+        query = sqlalchemy.text(f"DELETE FROM {self.quote(table_name)} WHERE {self.quote(key)} IN :keys")
+        query = query.bindparams(sqlalchemy.bindparam("keys", expanding=True))
+        step = self.batch_size or len(keys)
+        for start in range(0, len(keys), step):
+            conn.execute(query, {"keys": keys[start:start + step]})
+
+    def write(self, df: pd.DataFrame, keys: list = None):
+        """Insert a chunk, the first chunk also empties the table (delete) in the same transaction
+
+        :param df: Rows to insert
+        :param keys: Keys the rows had when they were read, replaced along with the current keys (upsert)
+        """
+        first = not self.started
+        if first and self.strategy == "staging":
+            self.start()
+        with self.engine.begin() as conn:
+            for table_name, df_tmp in split_tables(self.mysql_tables, df):
+                start = time.perf_counter()
+                if first and self.strategy == "delete":
+                    self._execute(conn, f"delete from {self.quote(table_name)}")
+                if self.strategy == "upsert":
+                    replaced = pd.unique(pd.concat([pd.Series(keys or [], dtype=object),
+                                                    df_tmp[self.key].astype(object)]).dropna())
+                    self.delete_keys(conn, table_name, [v.item() if hasattr(v, "item") else v for v in replaced])
+                if self.replay:
+                    key = self.table_keys[table_name]
+                    staged = [v.item() if hasattr(v, "item") else v for v in pd.unique(df_tmp[key].dropna())]
+                    self.delete_keys(conn, self.target(table_name), staged, key=key)
+                try:
+                    df_tmp.to_sql(con=conn, name=self.target(table_name), if_exists='append', index=False,
+                                  chunksize=self.batch_size, method=self.method)
+                except Exception:
+                    logger.exception(f"Error running to_sql on table {table_name}")
+                    raise
+                self.rows[table_name] += len(df_tmp)
+                self.seconds[table_name] += time.perf_counter() - start
+        self.started = True
+        self.replay = False
+
+    def finish(self):
+        """Swap the staged rows in and report the write rate of each table"""
+        if self.strategy == "staging" and self.started:
+            with self.engine.begin() as conn:
+                for table_name in self.table_names:
+                    start = time.perf_counter()
+                    table, staging = self.quote(table_name), self.quote(self.target(table_name))
+                    self._execute(conn, f"DELETE FROM {table}")
+                    self._execute(conn, f"INSERT INTO {table} SELECT * FROM {staging}")
+                    self._execute(conn, f"DROP TABLE {staging}")
+                    self.seconds[table_name] += time.perf_counter() - start
+        for table_name, rows in self.rows.items():
+            seconds = self.seconds[table_name]
+            rate = rows / seconds if seconds else 0
+            logger.info(f"Wrote {rows} rows to {table_name} in {seconds:.2f}s ({rate:.0f} rows/sec)")
+
+    def abort(self, keep_staging: bool = False):
+        """Drop the staging tables after a failure, the tables themselves weren't changed
+
+        :param keep_staging: Leave the staging tables so a resumed run can carry on with them
+        """
+        if self.strategy == "staging" and self.started and not keep_staging:
+            with self.engine.begin() as conn:
+                for table_name in self.table_names:
+                    self._execute(conn, f"DROP TABLE IF EXISTS {self.quote(self.target(table_name))}")
+
+
+def pandas_delete_and_insert(mysql_tables: str, df: pd.DataFrame, engine: sqlalchemy.engine.Engine, delete: bool = True,
+                             batch_size: int = 10000):
+    """Delete from the named table and insert
+
+    :param mysql_tables: Either a single value or | separated list of tables that will be inserted
+    :type mysql_tables: str
+    :param df: Either a single dataframe or one that has column names split by table_name.column_name
+    :type df: pandas.DataFrame
+    :param engine: SQLAlchemy engine
+    :type engine: sqlalchemy.engine.Engine
+    :param delete: Whether to delete the existing rows first, False appends (used for every chunk after the first)
+    :type delete: bool
+    :param batch_size: Number of rows per insert batch
+    :type batch_size: int
+    """
+    loader = TableLoader(mysql_tables, engine, strategy="delete", batch_size=batch_size)
+    # Appending is the same as a chunk after the first
+    loader.started = not delete
+    loader.write(df)
+    loader.finish()
+
+
+def key_columns(mysql_tables: str, col_config: list) -> List[str]:
+    """Columns that identify a row of a config.json entry, used to read the rows in a repeatable order
+
+    Joined entries use the table@key syntax, single tables the column marked "key": true or id
+
+    :param mysql_tables: Key of the entry in config.json
+    :param col_config: Column configurations of the entry, with joined columns named table.column
+    :return: List of column names, empty if there isn't a key
+    """
+    names = [col.get("name") for col in col_config]
+    if "|" in mysql_tables:
+        keys = []
+        for mysql_table in mysql_tables.split("|"):
+            table_name, index_name = (mysql_table.split("@") + [None] * 2)[:2]
+            if index_name and f"{table_name}.{index_name}" in names:
+                keys.append(f"{table_name}.{index_name}")
+        return keys
+    keys = [col.get("name") for col in col_config if col.get("key")]
+    if not keys and "id" in names:
+        keys = ["id"]
+    return keys
+
+
+def skip_rows(chunks: Iterable[pd.DataFrame], rows: int) -> Iterator[pd.DataFrame]:
+    """Drop the first rows of a stream of dataframes
+
+    :param chunks: Dataframes in order
+    :param rows: Number of rows to drop
+    """
+    for chunk in chunks:
+        if rows >= len(chunk):
+            rows -= len(chunk)
+            continue
+        if rows:
+            chunk = chunk.iloc[rows:].reset_index(drop=True)
+            rows = 0
+        yield chunk
+
+
+def group_aligned_chunks(chunks: Iterable[pd.DataFrame], group_col: str = None) -> Iterator[pd.DataFrame]:
+    """Regroup a stream of chunks sorted by group_col so that no group spans more than one chunk
+
+    The trailing group of every chunk is held back and prepended to the next one, so a chunk can be
+    larger than the requested size by up to the size of the largest group.
+
+    :param chunks: Dataframes in order, sorted by group_col
+    :param group_col: Column the rows are grouped by, if None the chunks are passed through
+    :return: Dataframes indexed 0..n-1
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+            carry = None
+        if group_col and len(chunk):
+            keys = chunk[group_col]
+            last_key = keys.iloc[-1]
+            if pd.isna(last_key):
+                same = keys.isna().values
+            else:
+                same = (keys == last_key).values
+            # Position where the trailing group starts
+            different = np.flatnonzero(~same)
+            boundary = different[-1] + 1 if len(different) else 0
+            carry = chunk.iloc[boundary:]
+            chunk = chunk.iloc[:boundary]
+        if len(chunk):
+            yield chunk.reset_index(drop=True)
+    if carry is not None and len(carry):
+        yield carry.reset_index(drop=True)
+
+
+def kde_bandwidth(n: np.ndarray, bw_method="silverman") -> np.ndarray:
+    """Bandwidth factor scipy.stats.gaussian_kde uses for one dimensional data of n points"""
+    n = np.asarray(n, dtype=float)
+    if bw_method == "silverman":
+        return (n * 3 / 4.) ** (-1. / 5)
+    if bw_method == "scott":
+        return n ** (-1. / 5)
+    if np.isscalar(bw_method) and not isinstance(bw_method, str):
+        return np.full(n.shape, float(bw_method))
+    raise ValueError(f"Unsupported bw_method {bw_method}")
+
+
+def grouped_kde_resample(values: np.ndarray, codes: np.ndarray, bw_method="silverman", map_to_range=True) -> np.ndarray:
+    """Resample every group of values from its own gaussian kernel density estimate, all groups at once
+
+    This draws the same way scipy.stats.gaussian_kde(...).resample does (a random point of the group plus
+    normal noise scaled by the bandwidth) using numpy's global random state. Groups where gaussian_kde
+    would fail (fewer than 2 points or no variance) keep their original values without calling scipy.
+
+    :param values: Numeric values
+    :param codes: Group of each value from 0..k-1, -1 for values that don't belong to a group (left as is)
+    :param bw_method: "silverman", "scott" or a number, like gaussian_kde
+    :param map_to_range: Map each group's sample back into the range of its original values, truncated to int
+    :return: Float array with the resampled values
+    """
+    values = np.asarray(values, dtype=float)
+    codes = np.asarray(codes)
+    result = values.copy()
+    grouped = np.flatnonzero(codes >= 0)
+    if len(grouped) == 0:
+        return result
+    # Sort by group so every group is a contiguous run
+    order = grouped[np.argsort(codes[grouped], kind="mergesort")]
+    group_codes = codes[order]
+    x = values[order]
+    starts = np.flatnonzero(np.r_[True, group_codes[1:] != group_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(x)])
+    # Group statistics, computed once
+    sums = np.add.reduceat(x, starts)
+    means = sums / sizes
+    sq_dev = np.add.reduceat((x - np.repeat(means, sizes)) ** 2, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = sq_dev / (sizes - 1)
+    ok = (sizes >= 2) & np.isfinite(variance) & (variance > 0)
+    if not ok.any():
+        return result
+    bandwidth = np.sqrt(variance) * kde_bandwidth(sizes, bw_method)
+
+    row_ok = np.repeat(ok, sizes)
+    row_starts = np.repeat(starts, sizes)[row_ok]
+    row_sizes = np.repeat(sizes, sizes)[row_ok]
+    # Pick a random point of the group for each value and add the kernel's noise to it
+    offsets = (np.random.random_sample(len(row_starts)) * row_sizes).astype(np.int64)
+    picks = row_starts + np.minimum(offsets, row_sizes - 1)
+    sample = x[picks] + np.random.standard_normal(len(row_starts)) * np.repeat(bandwidth, sizes)[row_ok]
+
+    if map_to_range:
+        ok_starts = np.flatnonzero(np.r_[True, np.diff(group_codes[row_ok]) != 0])
+        ok_sizes = np.diff(np.r_[ok_starts, len(sample)])
+        x_ok = x[row_ok]
+        orig_min = np.repeat(np.minimum.reduceat(x_ok, ok_starts), ok_sizes)
+        orig_max = np.repeat(np.maximum.reduceat(x_ok, ok_starts), ok_sizes)
+        raw_min = np.repeat(np.minimum.reduceat(sample, ok_starts), ok_sizes)
+        raw_max = np.repeat(np.maximum.reduceat(sample, ok_starts), ok_sizes)
+        sample = np.trunc((sample - raw_min) * (orig_max - orig_min) / (raw_max - raw_min) + orig_min)
+    result[order[row_ok]] = sample
+    return result
 
 
 def kde_resample(orig_data, bw_method="silverman", map_to_range=True):
     logger.debug(orig_data)
     try:
-        kde = scipy.stats.gaussian_kde(orig_data, bw_method=bw_method)
-    except Exception:
+        data = np.asarray(orig_data, dtype=float)
+        if data.ndim != 1:
+            raise ValueError("Only one dimensional data can be resampled")
+    except (TypeError, ValueError):
         logger.info("gaussian_kde could not handle this data, original data returned.", exc_info=True)
         return orig_data
+    if len(data) < 2 or not np.var(data) > 0:
+        logger.info("gaussian_kde could not handle this data, original data returned.")
+        return orig_data
+    sample = grouped_kde_resample(data, np.zeros(len(data), dtype=np.int64), bw_method, map_to_range)
+    if map_to_range:
+        return [int(val) for val in sample]
+    return sample
 
 
-    # Generate data from kde
-    raw_sample = kde.resample(len(orig_data)).T[:, 0]
+class GroupIndex():
+    """Rows of a dataframe grouped by an index column
+
+    codes has the group of every row (numbered in sorted key order like groupby, -1 for a missing key),
+    order lists the grouped rows sorted by group, and every group is the run starts[i]:starts[i]+sizes[i] of order.
+    """
+
+    def __init__(self, keys: pd.Series):
+        self.codes, self.keys = pd.factorize(keys, sort=True)
+        grouped = np.flatnonzero(self.codes >= 0)
+        self.order = grouped[np.argsort(self.codes[grouped], kind="mergesort")]
+        self.sorted_codes = self.codes[self.order]
+        self.sizes = np.bincount(self.sorted_codes, minlength=len(self.keys))
+        self.starts = np.r_[0, np.cumsum(self.sizes)[:-1]]
+
+
+# GroupIndex objects by the id of the dataframe, then by index column. Tables running at the same time and the
+# finalizers (which can run on any thread) only get, set and pop whole entries, it's never iterated
+_group_cache = {}
+# Ids of the dataframes that have a finalizer to forget them, so each only gets one
+_finalized = set()
+_finalize_lock = threading.Lock()
 
-    # Map the value into range if the user wants this (though it's a little slow)
-    if map_to_range:
-        map_sample = [int(((val - min(raw_sample)) * (max(orig_data) - min(orig_data))) / (max(raw_sample)
-                                                                                           - min(raw_sample)) + min(orig_data)) for val in raw_sample]
-        return map_sample
-    return raw_sample
+
+def _forget(df_id: int):
+    _group_cache.pop(df_id, None)
+    _finalized.discard(df_id)
+
+
+def group_index(df: pd.DataFrame, index_col: str) -> GroupIndex:
+    """Get the GroupIndex of a dataframe by a column, computed once and shared by all of the column wide methods
+
+    Call clear_group_cache if the values of the index column change.
+    """
+    df_id = id(df)
+    cached = _group_cache.get(df_id, {}).get(index_col)
+    if cached is not None and cached[0]() is df and len(cached[1].codes) == len(df):
+        return cached[1]
+    groups = GroupIndex(df[index_col])
+    with _finalize_lock:
+        if df_id not in _finalized:
+            # Forget about the dataframe once it's gone
+            _finalized.add(df_id)
+            weakref.finalize(df, _forget, df_id)
+    _group_cache.setdefault(df_id, {})[index_col] = (weakref.ref(df), groups)
+    return groups
+
+
+def clear_group_cache(df=None):
+    """Forget the GroupIndex objects of a dataframe (or its id), or all of them"""
+    if df is None:
+        _group_cache.clear()
+        return
+    _group_cache.pop(df if isinstance(df, int) else id(df), None)
+
+
+def grouped_permutation(groups: GroupIndex) -> np.ndarray:
+    """Positions that shuffle every group independently, in one pass
+
+    Sorting by group and then by a random key puts each group's rows in random order.
+    :return: Array of length len(groups.order), the grouped rows in order are replaced by the rows at these positions
+    """
+    random_keys = np.random.random_sample(len(groups.order))
+    return groups.order[np.lexsort((random_keys, groups.sorted_codes))]
 
 
 def shuffle(df:pd.DataFrame, shuffle_col:str, index_col:str=None):
     """
     Shuffle a dataframe column inplace
     """
-    df[shuffle_col].fillna(value=0, inplace=True)
+    column = df[shuffle_col]
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        if column.isna().any() and 0 not in column.cat.categories:
+            # A categorical can only be filled with one of its categories
+            column = column.cat.add_categories([0])
+        df[shuffle_col] = column.fillna(0)
+    else:
+        df[shuffle_col].fillna(value=0, inplace=True)
     if index_col:
         # Shuffle shuffle_col by groupCol
-        df[shuffle_col] = df.groupby(index_col)[shuffle_col].transform(np.random.permutation)
+        groups = group_index(df, index_col)
+        values = df[shuffle_col].values
+        shuffled = df[shuffle_col].copy()
+        shuffled.iloc[groups.order] = values[grouped_permutation(groups)]
+        # Rows without an index aren't in any group
+        shuffled[groups.codes < 0] = None
+        df[shuffle_col] = shuffled
     else:
         # Shuffle shuffle_col independently
-        df[shuffle_col] = np.random.permutation(df[shuffle_col].values)
+        # take keeps the dtype of categorical and nullable integer columns
+        df[shuffle_col] = df[shuffle_col].values.take(np.random.permutation(len(df)))
 
 def mean(df:pd.DataFrame, avg_col:str, result_col:str, index_col:str):
     """ Calculates the mean of one column grouped by another index column 
@@ -96,10 +588,19 @@ def mean(df:pd.DataFrame, avg_col:str, result_col:str, index_col:str):
     """
     df[avg_col] = pd.to_numeric(df[avg_col])
     df[avg_col].fillna(value=0, inplace=True)
-    df[avg_col].replace('None', pd.np.nan, inplace=True)
-    # Interesting bug here with this
-    # https://github.com/pandas-dev/pandas/issues/17093
-    df[result_col] = df.groupby([index_col])[avg_col].transform('mean')
+    df[avg_col].replace('None', np.nan, inplace=True)
+    groups = group_index(df, index_col)
+    values = df[avg_col].astype(float).values
+    grouped = groups.codes >= 0
+    # Missing values don't count towards the mean, like groupby
+    present = grouped & ~np.isnan(values)
+    sums = np.bincount(groups.codes[present], weights=values[present], minlength=len(groups.keys))
+    counts = np.bincount(groups.codes[present], minlength=len(groups.keys))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / counts
+    result = np.full(len(df), np.nan)
+    result[grouped] = means[groups.codes[grouped]]
+    df[result_col] = result
 
 def redist(df:pd.DataFrame, redist_col:str, index_col:str):
     """Redistributes scores within an indexed column inplace
@@ -110,4 +611,13 @@ def redist(df:pd.DataFrame, redist_col:str, index_col:str):
     """
     df[redist_col] = pd.to_numeric(df[redist_col], errors='ignore')
     df[redist_col].fillna(value=0, inplace=True)
-    df[redist_col] = df.groupby([index_col])[redist_col].transform(lambda x: kde_resample(x))
\ No newline at end of file
+    if not pd.api.types.is_numeric_dtype(df[redist_col]):
+        logger.info(f"{redist_col} is not numeric, original data kept.")
+        return
+    codes = group_index(df, index_col).codes
+    sample = grouped_kde_resample(df[redist_col].astype(float).values, codes)
+    # Rows without an index don't belong to a group
+    sample[codes < 0] = np.nan
+    if pd.api.types.is_integer_dtype(df[redist_col]) and (codes >= 0).all():
+        sample = sample.astype(np.int64)
+    df[redist_col] = sample
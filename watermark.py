@@ -0,0 +1,72 @@
+# Keeps track of how far each table has been anonymized so later runs only read the new rows
+import json, logging, os, threading
+
+import pandas as pd
+
+import util_methods
+
+logger = logging.getLogger()
+
+
+def table_columns(table: str, t_config):
+    """Find the watermark and key columns of a table entry in config.json
+
+    The watermark is the column marked with "watermark": true, it has to increase for new and changed rows
+    and can't be transformed. The key is the column marked with "key": true, or id.
+    Joined entries are always processed whole.
+
+    :param table: Key of the table in config.json
+    :param t_config: Value of the table in config.json
+    :return: Tuple of the watermark and key column names, or None if the table has no watermark
+    """
+    if "|" in table:
+        return None
+    watermark = [col for col in t_config if col.get("watermark")]
+    if not watermark:
+        return None
+    if len(watermark) > 1 or watermark[0].get("module"):
+        raise ValueError(f"{table} needs a single watermark column without a transform")
+    keys = util_methods.key_columns(table, t_config)
+    if len(keys) != 1:
+        raise ValueError(f"{table} has a watermark column but no single key column")
+    return watermark[0].get("name"), keys[0]
+
+
+def max_value(series: pd.Series):
+    """Largest value of a watermark column in a form that can be saved as JSON and compared in SQL"""
+    value = series.max()
+    if pd.isna(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return str(value)
+    return value.item() if hasattr(value, "item") else value
+
+
+class WatermarkState():
+    """Last watermark value written back for each table, saved in a JSON file"""
+
+    def __init__(self, path: str):
+        """
+        :param path: JSON file holding the watermarks, it doesn't have to exist yet
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.values = {}
+        if os.path.exists(path):
+            with open(path) as json_data:
+                self.values = json.load(json_data)
+
+    def get(self, table: str):
+        return self.values.get(table)
+
+    def set(self, table: str, value):
+        """Record the watermark of a table and save the file right away"""
+        if value is None:
+            return
+        with self._lock:
+            self.values[table] = value
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as out:
+                json.dump(self.values, out, indent=4, sort_keys=True)
+            os.replace(tmp, self.path)
+        logger.info(f"Watermark of {table} is now {value}")